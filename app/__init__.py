@@ -1,17 +1,13 @@
 '''This module contains all application initialization.'''
 import os
 from flask import Flask
-from flask_bootstrap import Bootstrap
-from flask_migrate import Migrate
 
 from config import DevelopmentConfig
 from app.db import db
+from app import core, clicks, storage, metrics, profiling, httpcache
+from app.cli import cli
+from app.redirect import RedirectFastPath
 from app.api import bp as api_bp
-from app.webapp import bp as webapp_bp
-
-
-bootstrap = Bootstrap()
-migrate = Migrate()
 
 
 def create_app(config=DevelopmentConfig):
@@ -20,6 +16,11 @@ def create_app(config=DevelopmentConfig):
     This function is the application factory, which creates an instance of
     the application with the specified configuration class. This includes
     initializing all flask extensions and registering blueprints and routes.
+
+    Flask-Migrate (and thus alembic), and the web interface (and thus
+    Flask-Bootstrap), are only imported if enabled by the MIGRATIONS and
+    WEB_UI options, respectively, which keeps the startup of API-only
+    workers fast.
     """
 
     # create application with specified config
@@ -30,12 +31,32 @@ def create_app(config=DevelopmentConfig):
         app.config.from_envvar('FLASK_CONFIG')
 
     # register extensions
-    bootstrap.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    if app.config['MIGRATIONS']:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    metrics.init_app(app)
+    storage.init_app(app)
+    core.init_app(app)
+    clicks.init_app(app)
+    httpcache.init_app(app)
+
+    # register CLI commands
+    app.cli.add_command(cli)
 
     # register blueprints
     app.register_blueprint(api_bp, url_prefix='/api/v1')
-    app.register_blueprint(webapp_bp)
+    if app.config['WEB_UI']:
+        from flask_bootstrap import Bootstrap
+        from app.webapp import bp as webapp_bp
+        Bootstrap(app)
+        app.register_blueprint(webapp_bp)
+
+    # serve short URL redirects ahead of flask's request dispatching
+    if app.config['REDIRECT_FAST_PATH']:
+        app.wsgi_app = RedirectFastPath(app, app.wsgi_app)
+
+    # profile some requests, outermost so that the fast path is profiled too
+    profiling.init_app(app)
 
     return app
@@ -0,0 +1,431 @@
+'''Asynchronous core operations.
+
+Contains asyncio variants of the core operations which do I/O, for the
+ASGI application (see app.asgi). URL validation, key derivation and key
+picking are those of app.core, as are the lookup cache and key filter;
+only the reads and writes of short URLs differ. With the ``'sqlalchemy'``
+STORAGE_BACKEND, they are made through SQLAlchemy's asyncio engine, with
+the asyncpg (PostgreSQL) or aiosqlite (SQLite) driver, so that a single
+process can wait on many lookups at once. The other backends are called
+in a thread pool.
+
+Like their synchronous counterparts, these coroutines must be run within
+an application context. Each asyncio task has an application context of
+its own, so concurrent requests can each push theirs.
+'''
+
+import asyncio
+import datetime
+import functools
+
+from flask import current_app
+from sqlalchemy import select, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import make_url
+
+from app import core, storage, metrics
+from app.models import ShortURL, url_digest
+
+
+# the async drivers of the databases supported by SQLALCHEMY_DATABASE_URI
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+class AsyncStorage:
+    '''The interface of an asynchronous store of short URLs. The methods
+    are coroutine variants of those of storage.Storage.'''
+
+    async def get(self, key: str):
+        '''Return the URL of key, or None if key doesn't exist or expired.'''
+        raise NotImplementedError
+
+    async def get_entry(self, key: str):
+        '''Return the (url,expires_at) pair of key, or None if key doesn't
+        exist or expired.'''
+        raise NotImplementedError
+
+    async def get_many(self, keys) -> dict:
+        '''Return a dict mapping each of the given keys which exists, and
+        hasn't expired, to its URL.'''
+        raise NotImplementedError
+
+    async def get_taken(self, keys) -> dict:
+        '''Return a dict mapping each of the given keys which exists, expired
+        or not, to its URL if it never expires, or else to None.'''
+        raise NotImplementedError
+
+    async def keys_from(self, start: str, limit: int) -> list:
+        '''Return up to limit of the keys, expired or not, of the same
+        length as start and not lower than it, in ascending bytewise
+        order.'''
+        raise NotImplementedError
+
+    async def find_key(self, url: str):
+        '''Return a key of url which never expires, or None if there is
+        none.'''
+        raise NotImplementedError
+
+    async def insert_if_absent(self, key: str, url: str, expires_at=None) -> bool:
+        '''Atomically insert a (key,url) pair, expiring at expires_at,
+        unless the key already exists. Return whether the pair was
+        inserted.'''
+        raise NotImplementedError
+
+    async def dispose(self):
+        '''Release the resources held by the storage.'''
+        pass
+
+
+class AsyncSQLAlchemyStorage(AsyncStorage):
+    '''Stores short URLs in the ShortURL table of a database, through an
+    asyncio engine.
+
+    Args:
+        engine (sqlalchemy.ext.asyncio.AsyncEngine): The engine of the
+                                                     application's database
+    '''
+
+    table = ShortURL.__table__
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def get(self, key):
+        entry = await self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    async def get_entry(self, key):
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                select(self.table.c.url, self.table.c.expires_at)
+                .where(self.table.c.key == key)
+                .where(self._live()))).first()
+        return tuple(row) if row is not None else None
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        if not keys:
+            return found
+        live = self._live()
+        async with self.engine.connect() as conn:
+            for i in range(0, len(keys), storage.IN_QUERY_CHUNK_SIZE):
+                chunk = keys[i:i+storage.IN_QUERY_CHUNK_SIZE]
+                found.update((await conn.execute(
+                    select(self.table.c.key, self.table.c.url)
+                    .where(self.table.c.key.in_(chunk))
+                    .where(live))).all())
+        return found
+
+    async def get_taken(self, keys):
+        keys = list(keys)
+        taken = {}
+        if not keys:
+            return taken
+        async with self.engine.connect() as conn:
+            for i in range(0, len(keys), storage.IN_QUERY_CHUNK_SIZE):
+                chunk = keys[i:i+storage.IN_QUERY_CHUNK_SIZE]
+                rows = await conn.execute(
+                    select(self.table.c.key, self.table.c.url, self.table.c.expires_at)
+                    .where(self.table.c.key.in_(chunk)))
+                taken.update((key, url if expires_at is None else None)
+                             for key, url, expires_at in rows)
+        return taken
+
+    async def keys_from(self, start, limit):
+        key = self.table.c.key
+        async with self.engine.connect() as conn:
+            return (await conn.execute(
+                select(self.table.c.key)
+                .where(key >= start)
+                .where(func.length(self.table.c.key) == len(start))
+                .order_by(key)
+                .limit(limit))).scalars().all()
+
+    async def find_key(self, url):
+        async with self.engine.connect() as conn:
+            return (await conn.execute(
+                select(self.table.c.key)
+                .where(self.table.c.url_digest == url_digest(url))
+                .where(self.table.c.url == url)
+                .where(self.table.c.expires_at.is_(None))
+                .limit(1))).scalar()
+
+    async def insert_if_absent(self, key, url, expires_at=None):
+        values = {'key': key, 'url': url, 'expires_at': expires_at}
+        stmt = storage._insert_ignoring_conflicts(
+            self.table, self.engine.dialect.name)
+        if stmt is None:
+            try:
+                async with self.engine.begin() as conn:
+                    await conn.execute(self.table.insert().values(**values))
+            except IntegrityError:
+                return False
+            return True
+        async with self.engine.begin() as conn:
+            result = await conn.execute(stmt.values(**values))
+            return result.rowcount == 1
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+    def _live(self):
+        '''Return the condition of the rows which haven't expired.'''
+        return or_(self.table.c.expires_at.is_(None),
+                   self.table.c.expires_at > datetime.datetime.utcnow())
+
+
+class ThreadedStorage(AsyncStorage):
+    '''Calls the methods of a synchronous storage.Storage in the event loop's
+    default thread pool.
+
+    Args:
+        storage (storage.Storage): The storage to call
+    '''
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def get(self, key):
+        return await _run_in_thread(self.storage.get, key)
+
+    async def get_entry(self, key):
+        return await _run_in_thread(self.storage.get_entry, key)
+
+    async def get_many(self, keys):
+        return await _run_in_thread(self.storage.get_many, list(keys))
+
+    async def get_taken(self, keys):
+        return await _run_in_thread(self.storage.get_taken, list(keys))
+
+    async def keys_from(self, start, limit):
+        return await _run_in_thread(self.storage.keys_from, start, limit)
+
+    async def find_key(self, url):
+        return await _run_in_thread(self.storage.find_key, url)
+
+    async def insert_if_absent(self, key, url, expires_at=None):
+        return await _run_in_thread(
+            self.storage.insert_if_absent, key, url, expires_at)
+
+
+def init_app(app):
+    '''Create the AsyncStorage of an application. With the 'sqlalchemy'
+    storage backend, this creates an asyncio engine, which only connects
+    when first used.'''
+    if app.config['STORAGE_BACKEND'] != 'sqlalchemy':
+        app.extensions['async_storage'] = ThreadedStorage(app.extensions['storage'])
+        return
+    from sqlalchemy.ext.asyncio import create_async_engine
+    uri = app.config['ASYNC_DATABASE_URI'] or \
+        async_database_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+    options = {}
+    if make_url(uri).get_backend_name() == 'sqlite':
+        # SQLAlchemy defaults to opening a connection, and thus an aiosqlite
+        # thread, per checkout for SQLite files
+        from sqlalchemy.pool import AsyncAdaptedQueuePool
+        options['poolclass'] = AsyncAdaptedQueuePool
+    engine = create_async_engine(uri, **options)
+    registry = app.extensions.get('metrics')
+    if registry is not None:
+        metrics.instrument_engine(registry, engine.sync_engine)
+    app.extensions['async_storage'] = AsyncSQLAlchemyStorage(engine)
+
+
+def async_database_uri(uri: str) -> str:
+    '''Return the URI of a database, with the driver replaced by the async
+    driver of the same database.
+
+    Raises:
+        ValueError: There is no async driver for the database
+    '''
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError('no async driver for database: ' + backend)
+    return str(url.set(drivername=ASYNC_DRIVERS[backend]))
+
+
+async def dispose(app):
+    '''Release the connections of the AsyncStorage of app.'''
+    async_storage = app.extensions.get('async_storage')
+    if async_storage is not None:
+        await async_storage.dispose()
+
+
+@metrics.timer('shortcake_core_seconds', operation='async_shorten_url')
+async def shorten_url(url: str, expires_at=None) -> str:
+    '''Shorten a URL.
+
+    The asynchronous variant of core.shorten_url, which picks the same key.
+
+    Args:
+        url (str): The URL to be shortened
+        expires_at (datetime.datetime): When the short URL expires, in
+                                        naive UTC, or None if it never does
+
+    Returns:
+        str: The key of the shortened URL
+
+    Raises:
+        InvalidURLError: The input argument is not a valid URL
+        OutOfShortKeysError: There are no more available short URL keys
+    '''
+    # InvalidURLError is propogated to caller
+    url = core._validate_url(url)
+    if expires_at is None:
+        existing_key = await _async_storage().find_key(url)
+        if existing_key:
+            metrics.inc('shortcake_shorten_total', source='existing')
+            return existing_key
+    owner = url if expires_at is None else core._EXPIRING
+    if current_app.config['SHORTKEY_STRATEGY'] == 'sequence':
+        while True:
+            # the allocator checkpoints its lease in the database, so it is
+            # called in a thread. OutOfShortKeysError is propogated to caller
+            key = await run_sync(core._sequential_key)
+            if await _try_insert(key, url, expires_at):
+                metrics.inc('shortcake_shorten_total', source='sequence')
+                return key
+            metrics.inc('shortcake_shorten_lost_races_total')
+    candidates = core._candidate_keys(url_digest(url))
+    taken = await _async_storage().get_taken(core._maybe_taken(candidates))
+    while True:
+        key = core._pick_key(candidates, owner, taken)
+        if key is not None:
+            source, depth = 'window', candidates.index(key) + 1
+        else:
+            # OutOfShortKeysError is propogated to caller
+            key, steps = await _next_free_key(candidates[-1], owner, taken)
+            source, depth = 'fallback', len(candidates) + steps
+        if key in taken or await _try_insert(key, url, expires_at):
+            metrics.inc('shortcake_shorten_total', source=source)
+            metrics.observe('shortcake_shorten_probe_depth', depth)
+            return key
+        # lost a race for the key against another process
+        metrics.inc('shortcake_shorten_lost_races_total')
+        taken[key] = None
+
+
+async def lengthen_url(key: str) -> str:
+    '''Lengthen a URL.
+
+    The asynchronous variant of core.lengthen_url, sharing its cache and
+    snapshot.
+
+    Args:
+        key (str): The short URL key to lookup
+
+    Returns:
+        str: The URL associated with the short key provided as an argument
+
+    Raises:
+        InvalidShortKeyError: The argument is not a valid short key
+    '''
+    return (await lengthen_entry(key))[0]
+
+
+@metrics.timer('shortcake_core_seconds', operation='async_lengthen_url')
+async def lengthen_entry(key: str) -> tuple:
+    '''Lengthen a URL, and tell when it expires.
+
+    The asynchronous variant of core.lengthen_entry, sharing its cache and
+    snapshot.
+
+    Args:
+        key (str): The short URL key to lookup
+
+    Returns:
+        tuple: The URL associated with the short key, and its expiry time
+
+    Raises:
+        InvalidShortKeyError: The argument is not a valid short key
+    '''
+    if not core._is_valid_key(key):
+        raise core.InvalidShortKeyError
+    cache = core._lengthen_cache()
+    entry = cache.get(key)
+    if entry is not cache.MISSING:
+        metrics.inc('shortcake_lengthen_total', source='cache')
+        return entry if entry is not None else (None, None)
+    url = core._snapshot_get(key)
+    if url is not None:
+        metrics.inc('shortcake_lengthen_total', source='snapshot')
+        return url, None
+    entry = await _async_storage().get_entry(key)
+    metrics.inc('shortcake_lengthen_total',
+                source='storage_hit' if entry is not None else 'storage_miss')
+    core._cache_entry(key, entry)
+    return entry if entry is not None else (None, None)
+
+
+@metrics.timer('shortcake_core_seconds', operation='async_try_insert')
+async def _try_insert(key: str, url: str, expires_at=None) -> bool:
+    '''Try to insert a (key,url) pair into the database.
+
+    The asynchronous variant of core._try_insert.
+
+    Args:
+        key (str): a short URL key to be associated with the URL
+        url (str): a URL to be associated with the short key
+        expires_at (datetime.datetime): When the pair expires, or None
+
+    Returns:
+        bool: Whether the (key,url) pair provided as arguments exists in
+              the database
+    '''
+    if await _async_storage().insert_if_absent(key, url, expires_at):
+        # the key may have been cached as a miss
+        core._lengthen_cache().invalidate(key)
+        key_filter = core._key_filter()
+        if key_filter is not None:
+            key_filter.add(key)
+        metrics.inc('shortcake_try_insert_total', outcome='inserted')
+        return True
+    exists = expires_at is None and \
+        (await _async_storage().get_taken([key])).get(key) == url
+    metrics.inc('shortcake_try_insert_total',
+                outcome='existing' if exists else 'taken')
+    return exists
+
+
+async def _next_free_key(initial_key: str, url: str, taken: dict) -> tuple:
+    '''The asynchronous variant of core._next_free_key.
+
+    Raises:
+        OutOfShortKeysError: There are no more available short URL keys
+    '''
+    search = core._free_key_search(initial_key, url, taken)
+    try:
+        start = next(search)
+        while True:
+            start = search.send(await _async_storage().keys_from(
+                start, core.FREE_KEY_PAGE_SIZE))
+    except StopIteration as e:
+        return e.value
+
+
+async def run_sync(func, *args):
+    '''Call a function of the synchronous API, e.g. core.shorten_urls, in
+    the event loop's default thread pool, within an application context of
+    the current application, and return its result.'''
+    app = current_app._get_current_object()
+
+    def call():
+        with app.app_context():
+            return func(*args)
+    return await _run_in_thread(call)
+
+
+async def _run_in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args))
+
+
+def _async_storage() -> AsyncStorage:
+    '''Return the AsyncStorage of the current application.'''
+    return current_app.extensions['async_storage']
@@ -1,19 +1,19 @@
+import datetime
+
 from flask import current_app, request, abort, jsonify
-from app import core
+from app import core, clicks, httpcache
 
 
 def register(bp):
     @bp.route('/shorten', methods=['POST'])
     def shorten():
-        if not request.json or 'url' not in request.json:
+        if not isinstance(request.json, dict) or 'url' not in request.json:
             abort(400)
+        expires_at = _expires_at(request.json)
         try:
             url = request.json['url']
-            key = core.shorten_url(url)
-            short_url = 'http://{}/{}'.format(
-                current_app.config['DOMAIN_NAME'],
-                key)
-            return jsonify({'short_url': short_url}), 201
+            key = core.shorten_url(url, expires_at)
+            return jsonify(_shorten_result(key, expires_at)), 201
         except core.InvalidURLError as e:
             # TODO more descriptive and individualized error messages
             abort(400)
@@ -21,10 +21,118 @@ def register(bp):
             abort(400)
 
 
+    @bp.route('/shorten/batch', methods=['POST'])
+    def shorten_batch():
+        if not isinstance(request.json, dict) or \
+                not isinstance(request.json.get('urls'), list):
+            abort(400)
+        urls = request.json['urls']
+        if len(urls) > current_app.config['BATCH_SHORTEN_MAX_URLS']:
+            abort(413)
+        try:
+            keys = core.shorten_urls(urls)
+        except core.KeyContentionError as e:
+            abort(503, description=str(e))
+        return jsonify(_batch_results(urls, keys))
+
+
+    @bp.route('/lengthen/batch', methods=['POST'])
+    def lengthen_batch():
+        keys = _batch_keys(request.json)
+        return jsonify(_lengthen_results(core.lengthen_urls(keys)))
+
+
     @bp.route('/lengthen/<string:key>', methods=['GET'])
     def lengthen(key):
         try:
-            url = core.lengthen_url(key)
-            return jsonify({'url': url})
+            url, expires_at = core.lengthen_entry(key)
         except core.InvalidShortKeyError as e:
             abort(400)
+        return httpcache.lengthen_response(
+            jsonify({'url': url}), url is not None,
+            request.headers.get('If-None-Match'), expires_at)
+
+
+    @bp.route('/stats/<string:key>', methods=['GET'])
+    def stats(key):
+        return jsonify(_key_stats(key))
+
+
+def _short_url(key):
+    return 'http://{}/{}'.format(current_app.config['DOMAIN_NAME'], key)
+
+
+def _expires_at(data):
+    '''Return the expiry time of the short URL requested by the body of a
+    shorten request, given its optional expires_in (seconds), or None if it
+    doesn't expire. Aborts if expires_in isn't a positive integer of at
+    most MAX_EXPIRES_IN.'''
+    expires_in = data.get('expires_in')
+    if expires_in is None:
+        return None
+    if not isinstance(expires_in, int) or isinstance(expires_in, bool) or \
+            not 0 < expires_in <= current_app.config['MAX_EXPIRES_IN']:
+        abort(400)
+    return datetime.datetime.utcnow().replace(microsecond=0) + \
+        datetime.timedelta(seconds=expires_in)
+
+
+def _shorten_result(key, expires_at):
+    '''Return the body of a shorten response.'''
+    result = {'short_url': _short_url(key)}
+    if expires_at is not None:
+        result['expires_at'] = expires_at.isoformat() + 'Z'
+    return result
+
+
+def _batch_results(urls, keys):
+    '''Return the body of a batch shorten response, given the URLs and the
+    results of core.shorten_urls.'''
+    results = []
+    for url, key in zip(urls, keys):
+        if isinstance(key, core.InvalidURLError):
+            results.append({'url': url, 'error': 'invalid URL'})
+        elif isinstance(key, core.OutOfShortKeysError):
+            results.append({'url': url, 'error': 'out of short keys'})
+        else:
+            results.append({'url': url, 'short_url': _short_url(key)})
+    return {'results': results}
+
+
+def _batch_keys(data):
+    '''Return the keys of the body of a batch lengthen request, aborting
+    if it is malformed or too large.'''
+    if not isinstance(data, dict) or not isinstance(data.get('keys'), list) or \
+            not all(isinstance(key, str) for key in data['keys']):
+        abort(400)
+    if len(data['keys']) > current_app.config['BATCH_LENGTHEN_MAX_KEYS']:
+        abort(413)
+    return data['keys']
+
+
+def _lengthen_results(urls):
+    '''Return the body of a batch lengthen response, given the results of
+    core.lengthen_urls.'''
+    results = {}
+    for key, url in urls.items():
+        if isinstance(url, core.InvalidShortKeyError):
+            results[key] = {'error': 'invalid key'}
+        else:
+            results[key] = {'url': url}
+    return {'results': results}
+
+
+def _key_stats(key):
+    '''Return the body of a stats response for key.'''
+    try:
+        if core.lengthen_url(key) is None:
+            abort(404)
+    except core.InvalidShortKeyError as e:
+        abort(400)
+    key_stats = clicks.stats(key, current_app.config['STATS_MAX_MINUTES'])
+    return {
+        'key': key,
+        'clicks': key_stats['clicks'],
+        'minutes': [{'minute': minute.isoformat() + 'Z', 'clicks': count}
+                    for minute, count in key_stats['minutes']],
+    }
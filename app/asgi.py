@@ -0,0 +1,201 @@
+'''The ASGI application.
+
+Serves the REST API (``/api/v1``), short URL redirects and ``/metrics``
+with the coroutines of app.aio, so that a single process serves many
+concurrent requests while they wait on the database. Responses are the
+same as those of the WSGI application. The endpoints which have no
+asynchronous implementation, i.e. batch shortening, batch lengthening and
+statistics, run the synchronous one in a thread pool. The web interface is
+only served by the WSGI application.
+'''
+
+import time
+
+from flask import Response
+from werkzeug.exceptions import HTTPException, BadRequest, NotFound, \
+    RequestEntityTooLarge, ServiceUnavailable, ClientDisconnected
+from werkzeug.routing import Map, Rule
+
+from app import aio, core, clicks, httpcache
+from app.api.routes import _expires_at, _shorten_result, _batch_results, \
+    _batch_keys, _lengthen_results, _key_stats
+from app.redirect import is_key_path, redirect_location, render_not_found
+
+
+URL_MAP = Map([
+    Rule('/api/v1/shorten', methods=['POST'], endpoint='shorten'),
+    Rule('/api/v1/shorten/batch', methods=['POST'], endpoint='shorten_batch'),
+    Rule('/api/v1/lengthen/batch', methods=['POST'], endpoint='lengthen_batch'),
+    Rule('/api/v1/lengthen/<string:key>', methods=['GET'], endpoint='lengthen'),
+    Rule('/api/v1/stats/<string:key>', methods=['GET'], endpoint='stats'),
+    Rule('/metrics', methods=['GET'], endpoint='metrics'),
+    Rule('/<string:key>', methods=['GET', 'HEAD'], endpoint='redirect'),
+])
+
+
+class ASGIApp:
+    '''ASGI application serving the API and redirects of a Flask application.
+
+    Each request is handled within an application context of app, in a
+    task of its own, so that the configuration, lookup cache, key filter,
+    click recorder and metrics of app are shared with app.core.
+
+    Args:
+        app (flask.Flask): The application whose configuration and database
+                           are used
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.url_adapter = URL_MAP.bind('localhost')
+        self._not_found_body = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('unsupported ASGI scope type: ' + scope['type'])
+        start = time.perf_counter()
+        endpoint = 'none'
+        with self.app.app_context():
+            try:
+                endpoint, args = self.url_adapter.match(
+                    scope['path'], scope['method'])
+                handler = getattr(self, endpoint)
+                response = await handler(scope, receive, **args)
+            except HTTPException as e:
+                response = e.get_response()
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response.headers.items()]
+        await send({'type': 'http.response.start',
+                    'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': response.get_data() if scope['method'] != 'HEAD' else b''})
+        registry = self.app.extensions.get('metrics')
+        if registry is not None:
+            registry.observe(
+                'shortcake_http_request_seconds',
+                {'endpoint': 'asgi.' + endpoint, 'status': str(response.status_code)},
+                time.perf_counter() - start)
+
+    async def shorten(self, scope, receive):
+        data = await self._json(scope, receive)
+        if not isinstance(data, dict) or 'url' not in data:
+            raise BadRequest
+        expires_at = _expires_at(data)
+        try:
+            key = await aio.shorten_url(data['url'], expires_at)
+        except (core.InvalidURLError, core.OutOfShortKeysError):
+            raise BadRequest
+        return self._jsonify(_shorten_result(key, expires_at), 201)
+
+    async def shorten_batch(self, scope, receive):
+        data = await self._json(scope, receive)
+        if not isinstance(data, dict) or not isinstance(data.get('urls'), list):
+            raise BadRequest
+        urls = data['urls']
+        if len(urls) > self.app.config['BATCH_SHORTEN_MAX_URLS']:
+            raise RequestEntityTooLarge
+        try:
+            keys = await aio.run_sync(core.shorten_urls, urls)
+        except core.KeyContentionError as e:
+            raise ServiceUnavailable(str(e))
+        return self._jsonify(_batch_results(urls, keys))
+
+    async def lengthen_batch(self, scope, receive):
+        keys = _batch_keys(await self._json(scope, receive))
+        urls = await aio.run_sync(core.lengthen_urls, keys)
+        return self._jsonify(_lengthen_results(urls))
+
+    async def lengthen(self, scope, receive, key):
+        try:
+            url, expires_at = await aio.lengthen_entry(key)
+        except core.InvalidShortKeyError:
+            raise BadRequest
+        return httpcache.lengthen_response(
+            self._jsonify({'url': url}), url is not None,
+            _header(scope, b'if-none-match'), expires_at)
+
+    async def stats(self, scope, receive, key):
+        return self._jsonify(await aio.run_sync(_key_stats, key))
+
+    async def metrics(self, scope, receive):
+        registry = self.app.extensions.get('metrics')
+        if registry is None:
+            raise NotFound
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    async def redirect(self, scope, receive, key):
+        url, expires_at = await aio.lengthen_entry(key) \
+            if is_key_path(scope['path']) else (None, None)
+        if not url:
+            return Response(self.not_found_body(), 404, httpcache.negative_headers(),
+                            mimetype='text/html')
+        clicks.record(self.app, key)
+        return Response(b'', self.app.config['REDIRECT_STATUS'],
+                        [('Location', redirect_location(url))] +
+                        httpcache.redirect_headers(expires_at))
+
+    def not_found_body(self) -> bytes:
+        '''Return the pre-rendered body of the 404 page.'''
+        if self._not_found_body is None:
+            self._not_found_body = render_not_found(self.app)
+        return self._not_found_body
+
+    def _jsonify(self, data, status=200) -> Response:
+        response = self.app.json.response(data)
+        response.status_code = status
+        return response
+
+    async def _json(self, scope, receive):
+        '''Return the JSON body of a request.
+
+        Raises:
+            BadRequest: The body is not JSON
+            RequestEntityTooLarge: The body is longer than MAX_CONTENT_LENGTH
+        '''
+        mimetype = (_header(scope, b'content-type') or '').split(';')[0].strip()
+        if not (mimetype == 'application/json' or
+                mimetype.startswith('application/') and mimetype.endswith('+json')):
+            raise BadRequest
+        limit = self.app.config['MAX_CONTENT_LENGTH']
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected
+            body += message.get('body', b'')
+            if limit is not None and len(body) > limit:
+                raise RequestEntityTooLarge
+            if not message.get('more_body'):
+                break
+        try:
+            return self.app.json.loads(bytes(body))
+        except ValueError:
+            raise BadRequest
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await aio.dispose(self.app)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def _header(scope, name: bytes):
+    '''Return the value of a request header, given its lowercase name, or
+    None if the request doesn't have it.'''
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def create_asgi_app(app) -> ASGIApp:
+    '''Create the ASGI application serving the API and redirects of app.'''
+    aio.init_app(app)
+    return ASGIApp(app)
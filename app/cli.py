@@ -0,0 +1,204 @@
+'''Command line interface of the application.
+
+Contains the ``flask shortcake`` command group, whose commands are used to
+administer the database of a deployment, e.g. to back it up or migrate it
+to another database.
+'''
+
+import csv
+import json
+import time
+import datetime
+import itertools as it
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from app import core, snapshot
+
+
+cli = AppGroup('shortcake', help='Administer the shortcake database.')
+
+FORMATS = ('csv', 'jsonl')
+
+
+@cli.command('export')
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='Output format. Inferred from the file name if omitted, '
+                   'otherwise jsonl.')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Number of rows fetched from the database at a time.')
+def export_urls(output, fmt, batch_size):
+    '''Export every short URL to OUTPUT (default: stdout).
+
+    Rows are streamed from a server-side cursor in key order, so memory
+    usage does not depend on the size of the table. Expired short URLs
+    are left out.
+    '''
+    fmt = fmt or _infer_format(output.name)
+    rows = current_app.extensions['storage'].scan(batch_size)
+    write = _writer(output, fmt)
+    progress = _Progress('exported')
+    n = 0
+    for key, url, expires_at in rows:
+        write(key, url, expires_at)
+        n += 1
+        if n % batch_size == 0:
+            progress.report(n)
+    progress.report(n, done=True)
+
+
+@cli.command('import')
+@click.argument('input', type=click.File('r'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='Input format. Inferred from the file name if omitted, '
+                   'otherwise jsonl.')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Number of rows inserted per transaction.')
+@click.option('--skip', default=0, show_default=True,
+              help='Number of leading records to skip, used to resume an '
+                   'interrupted import.')
+def import_urls(input, fmt, batch_size, skip):
+    '''Import short URLs from INPUT (default: stdin).
+
+    Records are read and bulk inserted in batches, one transaction per
+    batch, so memory usage does not depend on the size of the input.
+    Records whose key already exists are skipped, and the number of
+    records imported so far is reported after every batch, so an
+    interrupted import can safely be resumed with --skip.
+    '''
+    fmt = fmt or _infer_format(input.name)
+    storage = current_app.extensions['storage']
+    records = it.islice(_reader(input, fmt), skip, None)
+    progress = _Progress('imported', offset=skip)
+    n = skip
+    while True:
+        batch = list(it.islice(records, batch_size))
+        if not batch:
+            break
+        storage.insert_many(batch, skip_existing=True)
+        n += len(batch)
+        progress.report(n)
+    progress.report(n, done=True)
+
+
+@cli.command('snapshot')
+@click.argument('output', required=False)
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Number of rows fetched from the database at a time.')
+def snapshot_urls(output, batch_size):
+    '''Write a snapshot of every short URL to OUTPUT (default: SNAPSHOT_PATH).
+
+    The snapshot replaces OUTPUT atomically once complete, and running
+    worker processes switch to it within SNAPSHOT_CHECK_INTERVAL seconds.
+    Short URLs which expire are left out, since snapshots are served
+    without checking expiry.
+    '''
+    output = output or current_app.config['SNAPSHOT_PATH']
+    if not output:
+        raise click.UsageError('no OUTPUT given, and SNAPSHOT_PATH is not set')
+    pairs = ((key, url) for key, url, expires_at
+             in current_app.extensions['storage'].scan(batch_size)
+             if expires_at is None)
+    progress = _Progress('snapshotted')
+    n = snapshot.write_snapshot(pairs, output)
+    progress.report(n, done=True)
+
+
+@cli.command('sweep')
+@click.option('--batch-size', type=int,
+              help='Number of expired rows deleted per transaction. '
+                   'Defaults to SWEEP_BATCH_SIZE.')
+@click.option('--pause', default=0.0, show_default=True,
+              help='Number of seconds to sleep between two batches, which '
+                   'leaves the database to other clients.')
+@click.option('--interval', type=float,
+              help='Keep sweeping, every INTERVAL seconds, instead of '
+                   'exiting once every expired row is deleted.')
+def sweep_urls(batch_size, pause, interval):
+    '''Delete the expired short URLs, and their click statistics.
+
+    Rows are deleted in batches of at most --batch-size, each in a short
+    transaction of its own, the earliest expired first, so that other
+    clients are never locked out for long. Their keys can then be used
+    again by new short URLs.
+    '''
+    batch_size = batch_size or current_app.config['SWEEP_BATCH_SIZE']
+    while True:
+        progress = _Progress('swept')
+        n = 0
+        while True:
+            deleted = len(core.sweep_expired(batch_size))
+            n += deleted
+            if deleted < batch_size:
+                break
+            progress.report(n)
+            time.sleep(pause)
+        progress.report(n, done=True)
+        if interval is None:
+            break
+        time.sleep(interval)
+
+
+def _infer_format(filename):
+    return 'csv' if filename.endswith('.csv') else 'jsonl'
+
+
+def _writer(output, fmt):
+    '''Return a function writing a (key,url,expires_at) record to output in
+    fmt. expires_at is written as an ISO 8601 UTC time, and left out (jsonl)
+    or empty (csv) when None.'''
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(('key', 'url', 'expires_at'))
+        return lambda key, url, expires_at: writer.writerow(
+            (key, url, _format_time(expires_at) or ''))
+
+    def write(key, url, expires_at):
+        record = {'key': key, 'url': url}
+        if expires_at is not None:
+            record['expires_at'] = _format_time(expires_at)
+        output.write(json.dumps(record) + '\n')
+    return write
+
+
+def _reader(input, fmt):
+    '''Yield (key,url,expires_at) records read from input in fmt. The
+    expires_at field is optional.'''
+    if fmt == 'csv':
+        for row in csv.DictReader(input):
+            yield row['key'], row['url'], _parse_time(row.get('expires_at'))
+    else:
+        for line in input:
+            if line.strip():
+                record = json.loads(line)
+                yield record['key'], record['url'], \
+                    _parse_time(record.get('expires_at'))
+
+
+def _format_time(dt):
+    return dt.isoformat() + 'Z' if dt is not None else None
+
+
+def _parse_time(s):
+    '''Parse a time written by _format_time, or None if s is empty.'''
+    if not s:
+        return None
+    return datetime.datetime.fromisoformat(s.rstrip('Z'))
+
+
+class _Progress:
+    '''Reports the progress and throughput of a command on stderr.'''
+
+    def __init__(self, verb, offset=0):
+        self.verb = verb
+        self.offset = offset
+        self.start = time.perf_counter()
+
+    def report(self, n, done=False):
+        elapsed = time.perf_counter() - self.start
+        rate = (n - self.offset) / elapsed if elapsed else 0
+        click.echo('{} {} {} rows ({:.0f} rows/s)'.format(
+            'done,' if done else '...', self.verb, n, rate), err=True)
@@ -0,0 +1,214 @@
+'''Click tracking.
+
+Counts the redirects served for each short URL, per minute. Clicks are
+recorded into an in-memory buffer on the redirect path, which costs no
+more than appending to a deque, and are written to the database in the
+background by a flusher thread, aggregated into one row per key and
+minute, with a single bulk upsert per flush.
+'''
+
+import os
+import time
+import atexit
+import logging
+import datetime
+import threading
+from collections import Counter, deque
+
+from sqlalchemy import func
+
+from app import storage
+from app.db import db
+from app.models import ClickStat
+
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop-newest', 'drop-oldest')
+
+
+class ClickRecorder:
+    '''Buffers clicks in memory, and flushes them to the database in batches.
+
+    The buffer is a ring buffer holding at most buffer_size clicks. When it
+    is full, either the click being recorded or the oldest buffered click
+    is dropped, depending on overflow_policy, and counted in dropped. A
+    daemon thread flushes the buffer every flush_interval seconds, or as
+    soon as it holds flush_size clicks. The thread is started on the first
+    click recorded by each process, so that it survives forking.
+
+    Args:
+        app (flask.Flask): The application whose database is written to
+        buffer_size (int): The maximum number of buffered clicks
+        flush_size (int): The number of buffered clicks which triggers an
+                          early flush
+        flush_interval (float): The number of seconds between flushes. If
+                                0, no thread is started, and the buffer is
+                                only flushed by calling flush.
+        overflow_policy (str): 'drop-newest' or 'drop-oldest'
+        clock (callable): Returns the current time in seconds since the epoch
+    '''
+
+    def __init__(self, app, buffer_size, flush_size, flush_interval,
+                 overflow_policy='drop-newest', clock=time.time):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy: ' + overflow_policy)
+        self.app = app
+        self.buffer_size = buffer_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self._clock = clock
+        self._flush_lock = threading.Lock()
+        # guards the start of the thread, and dropped
+        self._lock = threading.Lock()
+        self._exit_flush_registered = False
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        maxlen = self.buffer_size if self.overflow_policy == 'drop-oldest' else None
+        self._buffer = deque(maxlen=maxlen)
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, key: str):
+        '''Record a click on the short URL with the given key.'''
+        if self._pid != os.getpid() or \
+                (self._thread is None and self.flush_interval > 0):
+            with self._lock:
+                if self._pid != os.getpid():
+                    # forked; the buffer and thread belong to the parent
+                    # process
+                    self._reset()
+                if self._thread is None and self.flush_interval > 0:
+                    self._start()
+        if len(self._buffer) >= self.buffer_size:
+            with self._lock:
+                self.dropped += 1
+            if self.overflow_policy == 'drop-newest':
+                return
+        # appending to a deque is thread-safe, and with a maxlen, evicts the
+        # oldest click atomically
+        self._buffer.append((key, self._clock()))
+        if len(self._buffer) >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        '''Write the buffered clicks to the database, and return how many
+        were written. Must be called within an application context.'''
+        with self._flush_lock:
+            counts = Counter()
+            for _ in range(len(self._buffer)):
+                key, timestamp = self._buffer.popleft()
+                counts[key, int(timestamp // 60 * 60)] += 1
+            if counts:
+                _upsert_counts(counts)
+            return sum(counts.values())
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='click-flusher', daemon=True)
+        self._thread.start()
+        if not self._exit_flush_registered:
+            # write whatever is left in the buffer when the process exits;
+            # forked processes inherit the handler
+            atexit.register(self.flush_in_context)
+            self._exit_flush_registered = True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush_in_context()
+
+    def flush_in_context(self):
+        '''Flush the buffer within a fresh application context, logging
+        rather than raising errors. Clicks which fail to be written are
+        lost.'''
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            logger.exception('failed to flush clicks')
+
+
+def init_app(app):
+    '''Create the ClickRecorder of an application, if click tracking is
+    enabled.'''
+    if not app.config['CLICK_TRACKING']:
+        app.extensions.pop('click_recorder', None)
+        return
+    recorder = ClickRecorder(
+        app,
+        app.config['CLICK_BUFFER_SIZE'],
+        app.config['CLICK_FLUSH_SIZE'],
+        app.config['CLICK_FLUSH_INTERVAL'],
+        app.config['CLICK_OVERFLOW_POLICY'])
+    app.extensions['click_recorder'] = recorder
+
+
+def record(app, key: str):
+    '''Record a click on key, if click tracking is enabled for app.'''
+    recorder = app.extensions.get('click_recorder')
+    if recorder is not None:
+        recorder.record(key)
+
+
+def stats(key: str, limit: int) -> dict:
+    '''Return the click statistics of a short URL: its total number of
+    clicks, and its clicks during each of the last (at most) limit minutes
+    in which it was clicked, oldest first.'''
+    total = db.session.query(func.coalesce(func.sum(ClickStat.count), 0)) \
+        .filter(ClickStat.key == key).scalar()
+    minutes = db.session.query(ClickStat.minute, ClickStat.count) \
+        .filter(ClickStat.key == key) \
+        .order_by(ClickStat.minute.desc()) \
+        .limit(limit).all()
+    return {
+        'clicks': total,
+        'minutes': [(minute, count) for minute, count in reversed(minutes)],
+    }
+
+
+def delete(keys) -> int:
+    '''Delete the click statistics of the given short URLs, e.g. once they
+    expired, and return the number of rows deleted.'''
+    keys = list(keys)
+    table = ClickStat.__table__
+    deleted = 0
+    for i in range(0, len(keys), storage.IN_QUERY_CHUNK_SIZE):
+        deleted += db.session.execute(
+            table.delete().where(
+                table.c.key.in_(keys[i:i+storage.IN_QUERY_CHUNK_SIZE]))).rowcount
+    db.session.commit()
+    return deleted
+
+
+def _upsert_counts(counts):
+    '''Add counts, a Counter of (key, minute timestamp) pairs, to the
+    ClickStat table, in a single statement where possible.'''
+    table = ClickStat.__table__
+    rows = [{'key': key,
+             'minute': datetime.datetime.utcfromtimestamp(minute),
+             'count': count}
+            for (key, minute), count in counts.items()]
+    insert = storage._dialect_insert()
+    if insert is not None:
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key', 'minute'],
+            set_={'count': table.c.count + stmt.excluded.count})
+        db.session.execute(stmt, rows)
+    else:
+        for row in rows:
+            updated = db.session.execute(
+                table.update()
+                .where(table.c.key == row['key'])
+                .where(table.c.minute == row['minute'])
+                .values(count=table.c.count + row['count'])
+            ).rowcount
+            if not updated:
+                db.session.execute(table.insert().values(**row))
+    db.session.commit()
@@ -5,19 +5,37 @@ helper functions.
 '''
 
 import re
+import time
+import atexit
 import string
-import hashlib
+import datetime
+import functools
+import threading
 import itertools as it
+from collections import OrderedDict
 
+from flask import current_app
 from werkzeug.urls import url_parse, url_fix
-
-from app.models import ShortURL
-from app.db import db
+from app.models import url_digest
+from app import sequence, keyfilter, storage, metrics, snapshot, clicks, \
+    groupcommit
 
 
 SHORTKEY_LENGTH = 7  # can be increased up to 10 if need be
 SHORTKEY_CHARSET = string.digits + string.ascii_uppercase + string.ascii_lowercase
 N_SHORTKEY_CHARS = len(SHORTKEY_CHARSET)
+# the base62 value of each character of SHORTKEY_CHARSET, whose characters
+# are in ascending bytewise order, so that keys of the same length sort
+# like their values
+_SHORTKEY_CHAR_VALUES = {c: i for i, c in enumerate(SHORTKEY_CHARSET)}
+
+# the number of existing keys fetched by each query of the search for a
+# free key following the candidate windows
+FREE_KEY_PAGE_SIZE = 1000
+
+# stands in for the URL of an expiring short URL when picking its key, so
+# that only free keys are picked: expiring short URLs never share keys
+_EXPIRING = object()
 
 
 class InvalidURLError(Exception):
@@ -32,8 +50,112 @@ class OutOfShortKeysError(Exception):
     '''Raised when there are no more available short URL keys.'''
     pass
 
+class KeyContentionError(Exception):
+    '''Raised when the keys picked for a batch of URLs keep being claimed by
+    other processes before they could be inserted.'''
+    pass
+
+
+class LookupCache:
+    '''A size-bounded, thread-safe LRU cache with per-entry expiry.
+
+    Used to memoize the results of key lookups in lengthen_entry. Both hits
+    (a (url,expires_at) entry) and misses (None) are cached, but misses are given their own,
+    typically much shorter, time to live, so that a key which is created
+    shortly after being looked up does not stay unresolvable for long.
 
-def shorten_url(url: str) -> str:
+    Args:
+        maxsize (int): The maximum number of entries held by the cache
+        ttl (float): Time to live of a cached URL, in seconds
+        negative_ttl (float): Time to live of a cached miss, in seconds
+        clock (callable): Returns the current time in seconds
+    '''
+
+    MISSING = object()
+    '''Returned by get when a key is not in the cache.'''
+
+    def __init__(self, maxsize, ttl, negative_ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Return the cached value of key, or LookupCache.MISSING.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return self.MISSING
+
+    def put(self, key, value, ttl=None):
+        '''Cache value (a URL, or None for a miss) under key, for at most ttl
+        seconds if given, e.g. until the short URL expires.'''
+        default_ttl = self.ttl if value is not None else self.negative_ttl
+        ttl = default_ttl if ttl is None else min(ttl, default_ttl)
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        '''Drop key from the cache, if present.'''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''Drop every entry and reset the hit/miss counters.'''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def init_app(app):
+    '''Initialize the per-application state used by this module.'''
+    app.extensions['lengthen_cache'] = LookupCache(
+        app.config['LENGTHEN_CACHE_SIZE'],
+        app.config['LENGTHEN_CACHE_TTL'],
+        app.config['LENGTHEN_CACHE_NEGATIVE_TTL'])
+    keyfilter.init_app(app)
+    snapshot.init_app(app)
+    groupcommit.init_app(app)
+    if app.config['SHORTKEY_STRATEGY'] == 'sequence':
+        secret = app.config['SHORTKEY_SEQUENCE_SECRET'] or app.config['SECRET_KEY']
+        if isinstance(secret, str):
+            secret = secret.encode()
+        half = SHORTKEY_LENGTH // 2
+        app.extensions['key_permutation'] = sequence.FeistelPermutation(
+            secret,
+            N_SHORTKEY_CHARS ** half,
+            N_SHORTKEY_CHARS ** (SHORTKEY_LENGTH - half))
+        allocator = sequence.LeaseAllocator(
+            'shortkey',
+            app.config['SHORTKEY_LEASE_SIZE'],
+            app.config['SHORTKEY_LEASE_TTL'],
+            app.config['SHORTKEY_LEASE_CHECKPOINT_INTERVAL'])
+        app.extensions['key_allocator'] = allocator
+        atexit.register(_release_lease, app, allocator)
+
+
+@metrics.timer('shortcake_core_seconds', operation='shorten_url')
+def shorten_url(url: str, expires_at=None) -> str:
     '''Shorten a URL.
 
     Given an arbitrarily long URL, convert it into a short URL, and
@@ -41,10 +163,14 @@ def shorten_url(url: str) -> str:
     of the shortened URL. If the argument is not a valid URL, raise
     InvalidURLError, or if there are no more available short URL keys,
     raise OutOfShortKeysError. In both of these cases, the conversion is
-    unsuccessful, and no database operations are performed.
+    unsuccessful, and no database operations are performed. A short URL
+    which expires always gets a key of its own, which is never shared
+    with other short URLs of the same URL.
 
     Args:
         url (str): The URL to be shortened
+        expires_at (datetime.datetime): When the short URL expires, in
+                                        naive UTC, or None if it never does
 
     Returns:
         str: The key of the shortened URL
@@ -54,39 +180,156 @@ def shorten_url(url: str) -> str:
         OutOfShortKeysError: There are no more available short URL keys
     '''
 
-    # The algorithm for converting a URL into a shortkey is as follows:
+    # If the URL has been shortened before, its existing key is found by
+    # looking up the digest of the URL in an index. Otherwise, with the
+    # "sequence" SHORTKEY_STRATEGY, the next id of a sequence is permuted into
+    # a key (see _sequential_key). With the default "hash" strategy, the
+    # algorithm for converting a URL into a shortkey is as follows:
     #    1. Hash the URL and convert the hash into a string of characters from
     #       SHORTKEY_CHARSET
-    #    2. Try the beginning of this string as a shortkey. If the key is taken,
-    #       slide the shortkey "window" over by 1 and try again. Repeat this
-    #       until the end of the string is reached.
-    #    3. Take the current candidate key and increment it by 1 until an
-    #       available shortkey is found
+    #    2. Every SHORTKEY_LENGTH-wide "window" of this string, from left to
+    #       right, is a candidate shortkey. All of them are looked up in a
+    #       single query, and the first one which is free (or already
+    #       associated with the URL) is picked. If the KEY_FILTER is enabled,
+    #       only the candidates before the first one which is definitely
+    #       free are looked up, so usually there is no query at all.
+    #    3. If none of the windows are free, find the first free key after
+    #       the last one, in sort order, with range scans of the primary key
+    #       index (see _next_free_key)
     #
-    # The performance of this algorithm in the worst case is terrible, but per
-    # the current parameters there are 7**62 possible shortkeys, so it is
-    # unlikely that step 3 of the algorithms will ever be reached.
+    # The picked key is inserted atomically, so if another process claims it
+    # first, the key is marked as taken and the next one is picked instead.
+    # Keys of expired short URLs are taken until the sweeper deletes them.
+    # The performance of step 3 in the worst case is terrible, but per the
+    # current parameters there are 62**7 possible shortkeys, so it is
+    # unlikely that it will ever be reached.
 
     # InvalidURLError is propogated to caller
-    url = _validate_url(url)
-    hashstr = hashlib.sha1(url.encode()).hexdigest()
-    long_keystr = _key_from_hex(hashstr)
-    for i in range(len(long_keystr) - SHORTKEY_LENGTH + 1):
-        candidate_key = long_keystr[i:i+SHORTKEY_LENGTH]
-        if _try_insert(candidate_key, url):
-            return candidate_key
-    # none of the key windows were available, so increment the current candidate
-    # key until we find an available one
-    initial_key = candidate_key
-    cur = _next_key(initial_key)
-    while cur != initial_key:
-        if _try_insert(cur, url):
-            return cur
-        cur = _next_key(cur)
-        if not cur:  # wrap around
-            cur = '0' * SHORTKEY_LENGTH
-    # there are no more available shortkeys
-    raise OutOfShortKeysError
+    with metrics.timed('shortcake_shorten_phase_seconds', phase='validate'):
+        url = _validate_url(url)
+    if expires_at is None:
+        with metrics.timed('shortcake_shorten_phase_seconds', phase='lookup'):
+            existing_key = _storage().find_key(url)
+        if existing_key:
+            metrics.inc('shortcake_shorten_total', source='existing')
+            return existing_key
+    owner = url if expires_at is None else _EXPIRING
+    if current_app.config['SHORTKEY_STRATEGY'] == 'sequence':
+        with metrics.timed('shortcake_shorten_phase_seconds', phase='insert'):
+            while True:
+                # OutOfShortKeysError is propogated to caller
+                key = _sequential_key()
+                # sequential keys can only be taken if the table also holds
+                # keys of the hash strategy, or the permutation secret was
+                # changed
+                if _try_insert(key, url, expires_at):
+                    metrics.inc('shortcake_shorten_total', source='sequence')
+                    return key
+                metrics.inc('shortcake_shorten_lost_races_total')
+    with metrics.timed('shortcake_shorten_phase_seconds', phase='derive'):
+        candidates = _candidate_keys(url_digest(url))
+    with metrics.timed('shortcake_shorten_phase_seconds', phase='probe'):
+        taken = _lookup_keys(_maybe_taken(candidates))
+    while True:
+        key = _pick_key(candidates, owner, taken)
+        if key is not None:
+            source, depth = 'window', candidates.index(key) + 1
+        else:
+            # OutOfShortKeysError is propogated to caller
+            with metrics.timed('shortcake_shorten_phase_seconds', phase='probe'):
+                key, steps = _next_free_key(candidates[-1], owner, taken)
+            source, depth = 'fallback', len(candidates) + steps
+        if key in taken:
+            inserted = True
+        else:
+            with metrics.timed('shortcake_shorten_phase_seconds', phase='insert'):
+                inserted = _try_insert(key, url, expires_at)
+        if inserted:
+            metrics.inc('shortcake_shorten_total', source=source)
+            metrics.observe('shortcake_shorten_probe_depth', depth)
+            return key
+        # lost a race for the key against another process
+        metrics.inc('shortcake_shorten_lost_races_total')
+        taken[key] = None
+
+
+@metrics.timer('shortcake_core_seconds', operation='shorten_urls')
+def shorten_urls(urls) -> list:
+    '''Shorten many URLs at once.
+
+    Like shorten_url, but for an iterable of URLs, which are all inserted
+    into the database in a single transaction. Availability of the
+    candidate keys of every URL is resolved with a handful of set-based
+    queries, rather than one query per candidate key. Return a list with
+    one item per input URL, in order: either the key of the shortened
+    URL, or the exception instance (InvalidURLError or
+    OutOfShortKeysError) explaining why that URL couldn't be shortened.
+    A failing URL does not prevent the others from being shortened.
+
+    Args:
+        urls (iterable): The URLs to be shortened
+
+    Returns:
+        list: The key of each shortened URL, or an exception instance
+
+    Raises:
+        KeyContentionError: Other processes claimed some of the picked keys
+                            on every attempt; nothing was inserted
+    '''
+    urls = list(urls)
+    # validated URLs, by position in the input
+    valid = {}
+    results = [None] * len(urls)
+    for i, url in enumerate(urls):
+        try:
+            valid[i] = _validate_url(url)
+        except InvalidURLError as e:
+            results[i] = e
+    sequential = current_app.config['SHORTKEY_STRATEGY'] == 'sequence'
+    candidates = {} if sequential else \
+        {url: _candidate_keys(url_digest(url)) for url in valid.values()}
+
+    # another process may claim one of our keys between the lookup and the
+    # commit, in which case the whole batch is resolved again
+    attempts = 3
+    for attempt in range(attempts):
+        # the keys of URLs which have been shortened before
+        assigned = _storage().find_keys(set(valid.values()))
+        taken = _lookup_keys(
+            {key for keys in candidates.values() for key in _maybe_taken(keys)})
+        taken.update((key, url) for url, key in assigned.items())
+        new_rows = []
+        for i, url in valid.items():
+            key = assigned.get(url)
+            if key is None:
+                try:
+                    if sequential:
+                        key = _sequential_key()
+                    else:
+                        key = _pick_key(candidates[url], url, taken) or \
+                            _next_free_key(candidates[url][-1], url, taken)[0]
+                except OutOfShortKeysError as e:
+                    results[i] = e
+                    continue
+                if key not in taken:
+                    new_rows.append((key, url))
+                taken[key] = url
+                assigned[url] = key
+            results[i] = key
+        try:
+            _storage().insert_many(new_rows)
+        except storage.KeyConflictError as e:
+            if attempt == attempts - 1:
+                raise KeyContentionError(
+                    'short URL keys were claimed concurrently, retry later') from e
+            continue
+        cache = _lengthen_cache()
+        key_filter = _key_filter()
+        for key, _ in new_rows:
+            cache.invalidate(key)
+            if key_filter is not None:
+                key_filter.add(key)
+        return results
 
 
 def lengthen_url(key: str) -> str:
@@ -94,7 +337,8 @@ def lengthen_url(key: str) -> str:
 
     Given the key of a short URL, return the corresponding (long) URL.
     If the argument is an invalid short key, return InvalidShortKeyError.
-    If the short key isn't associated with any URL, return None.
+    If the short key isn't associated with any URL, or the short URL
+    expired, return None. See lengthen_entry.
 
     Args:
         key (str): The short URL key to lookup
@@ -102,42 +346,363 @@ def lengthen_url(key: str) -> str:
     Returns:
         str: The URL associated with the short key provided as an argument
 
+    Raises:
+        InvalidShortKeyError: The argument is not a valid short key
+    '''
+    return lengthen_entry(key)[0]
+
+
+@metrics.timer('shortcake_core_seconds', operation='lengthen_url')
+def lengthen_entry(key: str) -> tuple:
+    '''Lengthen a URL, and tell when it expires.
+
+    Like lengthen_url, but return a (url,expires_at) pair, where expires_at
+    is when the short URL expires, or None if it never does, so that
+    responses can be cached no longer than the short URL lives. url is None
+    if the key isn't associated with any URL. Results, including misses,
+    are memoized in the application's LookupCache, but never past the
+    expiry of the short URL, and keys found in the SNAPSHOT_PATH snapshot
+    are served from it. The KEY_FILTER isn't consulted: it doesn't know the
+    keys other worker processes created since it was last rebuilt.
+
+    Args:
+        key (str): The short URL key to lookup
+
+    Returns:
+        tuple: The URL associated with the short key, and its expiry time
+
     Raises:
         InvalidShortKeyError: The argument is not a valid short key
     '''
     if not _is_valid_key(key):
         raise InvalidShortKeyError
-    existing_entry = ShortURL.query.get(key)
-    if existing_entry:
-        return existing_entry.url
-    # key isn't in database
-    return None
+    cache = _lengthen_cache()
+    entry = cache.get(key)
+    if entry is not cache.MISSING:
+        metrics.inc('shortcake_lengthen_total', source='cache')
+        return entry if entry is not None else (None, None)
+    url = _snapshot_get(key)
+    if url is not None:
+        # not cached, the snapshot is shared by every worker process
+        metrics.inc('shortcake_lengthen_total', source='snapshot')
+        return url, None
+    # a None entry means the key isn't in the database, or expired
+    entry = _storage().get_entry(key)
+    metrics.inc('shortcake_lengthen_total',
+                source='storage_hit' if entry is not None else 'storage_miss')
+    _cache_entry(key, entry)
+    return entry if entry is not None else (None, None)
+
+
+@metrics.timer('shortcake_core_seconds', operation='lengthen_urls')
+def lengthen_urls(keys) -> dict:
+    '''Lengthen many URLs at once.
+
+    Like lengthen_url, but for an iterable of keys. The keys which are
+    neither cached nor in the snapshot are looked up with one query per
+    LENGTHEN_BATCH_CHUNK_SIZE keys. Return a dict mapping each distinct
+    input key to either its URL, None if the key isn't associated with any
+    URL, or an InvalidShortKeyError instance if it isn't a valid key.
+    Results are not added to the LookupCache, so that a batch doesn't evict
+    the keys which are looked up frequently.
 
+    Args:
+        keys (iterable): The short URL keys to lookup
+
+    Returns:
+        dict: The URL of each key, None, or an exception instance
+    '''
+    results = {}
+    # the keys which have to be looked up in the database
+    pending = []
+    cache = _lengthen_cache()
+    sources = dict.fromkeys(['cache', 'snapshot'], 0)
+    for key in keys:
+        if key in results:
+            continue
+        if not _is_valid_key(key):
+            results[key] = InvalidShortKeyError(key)
+            continue
+        entry = cache.get(key)
+        if entry is not cache.MISSING:
+            sources['cache'] += 1
+            url = entry[0] if entry is not None else None
+        else:
+            url = _snapshot_get(key)
+            if url is not None:
+                sources['snapshot'] += 1
+            else:
+                pending.append(key)
+        results[key] = url
+    chunk_size = current_app.config['LENGTHEN_BATCH_CHUNK_SIZE']
+    found = 0
+    for i in range(0, len(pending), chunk_size):
+        urls = _storage().get_many(pending[i:i+chunk_size])
+        results.update(urls)
+        found += len(urls)
+    sources['storage_hit'] = found
+    sources['storage_miss'] = len(pending) - found
+    for source, n in sources.items():
+        if n:
+            metrics.inc('shortcake_lengthen_total', n, source=source)
+    return results
+
+
+@metrics.timer('shortcake_core_seconds', operation='sweep_expired')
+def sweep_expired(limit: int) -> list:
+    '''Delete expired short URLs.
+
+    Delete up to limit of the short URLs which have expired, the earliest
+    first, along with their click statistics, and return their keys. Each
+    call deletes a single batch in a short transaction, found through the
+    index on expiry times, so that the table is never locked for long;
+    callers sweep every expired short URL by calling it until it returns
+    fewer than limit keys. Once deleted, the keys are free again.
+
+    Args:
+        limit (int): The maximum number of short URLs deleted
 
-def _try_insert(key: str, url: str) -> bool:
+    Returns:
+        list: The keys of the deleted short URLs
+    '''
+    keys = _storage().delete_expired(datetime.datetime.utcnow(), limit)
+    if keys:
+        clicks.delete(keys)
+        cache = _lengthen_cache()
+        for key in keys:
+            cache.invalidate(key)
+        metrics.inc('shortcake_swept_total', len(keys))
+    return keys
+
+
+@metrics.timer('shortcake_core_seconds', operation='try_insert')
+def _try_insert(key: str, url: str, expires_at=None) -> bool:
     '''Try to insert a (key,url) pair into the database.
 
     Try to insert a (key,url) pair into the database, and return a bool
     indicating whether the pair exists in the database. True may be
     returned either because the pair was successfully inserted, or
-    because it already existed in the database. Note that this function
+    because it already existed in the database, unless the pair expires,
+    in which case it must have been inserted. Note that this function
     *does not* sanitize the input arguments; this is the responsibility of
     the caller.
 
     Args:
         key (str): a short URL key to be associated with the URL
         url (str): a URL to be associated with the short key
+        expires_at (datetime.datetime): When the pair expires, or None
 
     Returns:
         bool: Whether the (key,url) pair provided as arguments exists in
               the database
     '''
-    existing_entry = ShortURL.query.get(key)
-    if existing_entry:
-        return existing_entry.url == url
-    db.session.add(ShortURL(key=key, url=url))
-    db.session.commit()
-    return True
+    committer = current_app.extensions.get('group_committer')
+    insert_if_absent = committer.insert_if_absent if committer is not None \
+        else _storage().insert_if_absent
+    if insert_if_absent(key, url, expires_at):
+        # the key may have been cached as a miss
+        _lengthen_cache().invalidate(key)
+        key_filter = _key_filter()
+        if key_filter is not None:
+            key_filter.add(key)
+        metrics.inc('shortcake_try_insert_total', outcome='inserted')
+        return True
+    exists = expires_at is None and _storage().get_taken([key]).get(key) == url
+    metrics.inc('shortcake_try_insert_total',
+                outcome='existing' if exists else 'taken')
+    return exists
+
+
+def _candidate_keys(digest: str) -> list:
+    '''Return the candidate short keys of a URL, given its digest, in the
+    order in which they should be tried.'''
+    derive = _KEY_DERIVATIONS[current_app.config['SHORTKEY_DERIVATION']]
+    long_keystr = derive(digest)
+    return [long_keystr[i:i+SHORTKEY_LENGTH]
+            for i in range(len(long_keystr) - SHORTKEY_LENGTH + 1)]
+
+
+def _lookup_keys(keys) -> dict:
+    '''Return a dict mapping each of the given keys which exists in the
+    database to its URL, or to None if the short URL expires (whether or
+    not it has expired yet), using as few queries as possible.'''
+    return _storage().get_taken(keys)
+
+
+def _maybe_taken(candidates) -> list:
+    '''Return the candidate keys which need to be looked up to pick one:
+    all of them, or, if the KEY_FILTER is enabled, those before the first
+    candidate which is definitely free.'''
+    key_filter = _key_filter()
+    if key_filter is None:
+        return list(candidates)
+    return list(it.takewhile(key_filter.might_contain, candidates))
+
+
+def _pick_key(candidates, url: str, taken: dict):
+    '''Return the first of the candidate keys which is either free or
+    already associated with url, given a dict of taken keys to their URLs.
+    Return None if every candidate belongs to another URL.'''
+    for key in candidates:
+        if taken.get(key, url) == url:
+            return key
+    return None
+
+
+def _next_free_key(initial_key: str, url: str, taken: dict) -> tuple:
+    '''Return the first key after initial_key, in sort order and wrapping
+    around, which is free, or associated with url by the taken dict, along
+    with the number of keys considered. See _free_key_search.
+
+    Raises:
+        OutOfShortKeysError: There are no more available short URL keys
+    '''
+    search = _free_key_search(initial_key, url, taken)
+    try:
+        start = next(search)
+        while True:
+            start = search.send(_storage().keys_from(start, FREE_KEY_PAGE_SIZE))
+    except StopIteration as e:
+        return e.value
+
+
+def _free_key_search(initial_key: str, url: str, taken: dict):
+    '''Search for the first key after initial_key, in sort order and
+    wrapping around, which is free, or associated with url by the taken
+    dict, and return it along with the number of keys considered.
+
+    Rather than looking keys up one by one, the existing keys from the
+    current one on are fetched FREE_KEY_PAGE_SIZE at a time, in order, by a
+    range scan of the primary key index, and the first gap between them is
+    free. A single query thus skips over a run of up to
+    FREE_KEY_PAGE_SIZE taken keys. Keys are also checked against the taken
+    dict, which holds the keys claimed since it was filled in, and no query
+    is made at all if the KEY_FILTER reports the next key as definitely
+    free.
+
+    The search does no I/O itself, so that the synchronous and asynchronous
+    shorten paths share it: it is a generator which yields the key a page
+    should start at, expects the result of keys_from(key,
+    FREE_KEY_PAGE_SIZE) to be sent back, and returns the (key, steps)
+    pair. See _next_free_key.
+
+    Raises:
+        OutOfShortKeysError: There are no more available short URL keys
+    '''
+    length = len(initial_key)
+    start = _key_to_int(initial_key)
+    space = N_SHORTKEY_CHARS ** length
+    # up to the last key of this length, then from the first one
+    for cur, end in ((start + 1, space), (0, start)):
+        while cur < end:
+            key = _int_to_key(cur, length)
+            if _maybe_taken([key]):
+                existing = yield key
+                gap = _first_gap(cur, existing)
+                if len(existing) == FREE_KEY_PAGE_SIZE and \
+                        gap == cur + FREE_KEY_PAGE_SIZE:
+                    # every key of the page is taken, the gap is further on
+                    cur = gap
+                    continue
+                cur = gap
+                if cur >= end:
+                    break
+                key = _int_to_key(cur, length)
+            if taken.get(key, url) == url:
+                return key, (cur - start) % space
+            cur += 1
+    raise OutOfShortKeysError
+
+
+def _first_gap(cur: int, keys) -> int:
+    '''Return the value of the first key from cur on which isn't one of
+    keys, the existing keys from cur on, in ascending order.'''
+    for key in keys:
+        if _key_to_int(key) != cur:
+            break
+        cur += 1
+    return cur
+
+
+def _sequential_key() -> str:
+    '''Return the key of the next id of the short key sequence.
+
+    The id is mapped onto the key space by a keyed permutation, so that
+    consecutive ids yield unrelated, non-guessable keys.
+
+    Raises:
+        OutOfShortKeysError: The sequence has run past the key space
+    '''
+    permutation = current_app.extensions['key_permutation']
+    n = current_app.extensions['key_allocator'].next_id()
+    if n >= len(permutation):
+        raise OutOfShortKeysError
+    return _int_to_key(permutation.permute(n), SHORTKEY_LENGTH)
+
+
+def _release_lease(app, allocator):
+    '''Hand the remaining ids of a lease back on exit.'''
+    try:
+        with app.app_context():
+            allocator.release()
+    except Exception:
+        # the lease will expire on its own
+        pass
+
+
+def _key_to_int(key: str) -> int:
+    '''Return the base62 value of a short key.'''
+    values = _SHORTKEY_CHAR_VALUES
+    n = 0
+    for c in key:
+        n = n * N_SHORTKEY_CHARS + values[c]
+    return n
+
+
+def _int_to_key(n: int, length: int) -> str:
+    '''Return the short key of the given length whose base62 value is n.'''
+    chars = []
+    for _ in range(length):
+        n, i = divmod(n, N_SHORTKEY_CHARS)
+        chars.append(SHORTKEY_CHARSET[i])
+    return ''.join(reversed(chars))
+
+
+def _lengthen_cache() -> LookupCache:
+    '''Return the LookupCache of the current application.'''
+    return current_app.extensions['lengthen_cache']
+
+
+def _storage() -> storage.Storage:
+    '''Return the Storage of the current application.'''
+    return current_app.extensions['storage']
+
+
+def _key_filter():
+    '''Return the KeyFilter of the current application, or None.'''
+    return current_app.extensions.get('key_filter')
+
+
+def _cache_entry(key: str, entry):
+    '''Cache the (url,expires_at) entry of a key, or None if it has none,
+    until the short URL expires at most.'''
+    expires_at = entry[1] if entry is not None else None
+    _lengthen_cache().put(key, entry, _seconds_until(expires_at))
+
+
+def _seconds_until(expires_at):
+    '''Return the number of seconds until a naive UTC datetime, or None if
+    expires_at is None.'''
+    if expires_at is None:
+        return None
+    return (expires_at - datetime.datetime.utcnow()).total_seconds()
+
+
+def _snapshot_get(key: str):
+    '''Return the URL of key in the snapshot of the current application, or
+    None if it isn't there, or there is no snapshot.'''
+    reader = current_app.extensions.get('snapshot')
+    return reader.get(key) if reader is not None else None
 
 
 def _key_from_hex(hexs: str) -> str:
@@ -150,6 +715,53 @@ def _key_from_hex(hexs: str) -> str:
     Note that this function assumes that the argument passed in is a valid
     hexadecimal string; sanitation is the responsibility of the caller.
 
+    The argument is read as an integer and written out in base
+    N_SHORTKEY_CHARS, least significant digit first, padded to the number
+    of digits needed for any integer of that many bits. Every digit but
+    the last few is therefore uniformly distributed over SHORTKEY_CHARSET
+    for a uniformly distributed argument, such as a hash digest.
+
+    Args:
+        hexs (str): a string of hexidecimal characters
+
+    Returns:
+        str: a short URL key
+    '''
+    n = int(hexs, 16)
+    chars = []
+    for _ in range(_base62_width(len(hexs) * 4)):
+        n, i = divmod(n, N_SHORTKEY_CHARS)
+        chars.append(SHORTKEY_CHARSET[i])
+    return ''.join(chars)
+
+
+@functools.lru_cache()
+def _base62_width(bits: int) -> int:
+    '''Return the number of SHORTKEY_CHARSET digits needed to write out any
+    integer of the given number of bits.'''
+    width, n = 0, (1 << bits) - 1
+    while n:
+        n //= N_SHORTKEY_CHARS
+        width += 1
+    return width
+
+
+def _legacy_key_from_hex(hexs: str) -> str:
+    '''Derive a short URL key from a hexidecimal string, the legacy way.
+
+    Given a string of hexadecimal characters, return a short URL key,
+    which is deterministically derived from the argument. The argument
+    string will be consumed as much as possible, so the length of the
+    returned short key depends on the length of the argument string.
+    Note that this function assumes that the argument passed in is a valid
+    hexadecimal string; sanitation is the responsibility of the caller.
+
+    This is the derivation used before _key_from_hex, kept so that the
+    keys of existing deployments can be reproduced. It builds a bit string
+    (dropping the leading zeros of every byte), regroups it into sextets,
+    and maps sextets beyond the charset onto a single fill character,
+    which skews the distribution of keys.
+
     Args:
         hexs (str): a string of hexidecimal characters
 
@@ -165,7 +777,6 @@ def _key_from_hex(hexs: str) -> str:
         return it.zip_longest(*args, fillvalue=fillvalue)
 
     hash_bytes = bytes.fromhex(hexs)
-    # TODO is there a more efficient way to do this with bitmask operations?
     hash_binstr = ''.join(bin(b)[2:] for b in hash_bytes)
     keystr = ''
     shortkey_fillchar = None
@@ -187,15 +798,21 @@ def _key_from_hex(hexs: str) -> str:
     return keystr
 
 
+_KEY_DERIVATIONS = {
+    'base62': _key_from_hex,
+    'legacy': _legacy_key_from_hex,
+}
+
+
 def _next_key(key: str) -> str:
     '''Return the next greatest key.
 
-    Given a short URL key, return the next greatest key, assuming an
-    alphanumeric sort order. If there is no next greatest key, (i.e. the
-    input key was the highest in the sort order, namely "zzzzzzz"),
-    return None. Note that this function *does not* santitize the input
-    argument. A valid key is assumed to be provided, and sanitation is
-    the responsibility of the caller.
+    Given a short URL key, return the next greatest key of the same length,
+    assuming an alphanumeric sort order. If there is no next greatest key,
+    (i.e. the input key was the highest in the sort order, namely
+    "zzzzzzz"), return None. Note that this function *does not* santitize
+    the input argument. A valid key is assumed to be provided, and
+    sanitation is the responsibility of the caller.
 
     Args:
         key (str): A short URL key
@@ -203,19 +820,11 @@ def _next_key(key: str) -> str:
     Returns:
         str: The next greatest short URL key
     '''
-    ret = key
-    for i in reversed(range(len(key))):
-        k = key[i]
-        if k == 'z':
-            ret = ret[:i] + '0' + ret[i+1:]
-        else:
-            idx = SHORTKEY_CHARSET.find(k)
-            ret = ret[:i] + SHORTKEY_CHARSET[idx+1] + ret[i+1:]
-            break
-    else:
+    n = _key_to_int(key) + 1
+    if n == N_SHORTKEY_CHARS ** len(key):
         # we got the string 'zzzzzzz'
         return None
-    return ret
+    return _int_to_key(n, len(key))
 
 
 def _validate_url(url: str) -> str:
@@ -4,3 +4,15 @@ from flask_sqlalchemy import SQLAlchemy
 
 # TODO does this have to be in its own file?
 db = SQLAlchemy()
+
+
+def dispose_engine(app):
+    '''Drop the connection pool inherited from the parent process, in a
+    forked child process.
+
+    The pooled connections are abandoned rather than closed, as closing
+    them would also close the parent's (shared) database sessions. The
+    child opens connections of its own as needed.
+    '''
+    with app.app_context():
+        db.get_engine(app).dispose(close=False)
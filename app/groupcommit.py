@@ -0,0 +1,132 @@
+'''Group commit of short URL inserts.
+
+Every shorten of a new URL ends with the insert of a single row, in a
+transaction of its own, whose commit waits for the database to flush its
+log to disk. Under a burst of shortens, these flushes dominate. When
+GROUP_COMMIT is enabled, the inserts of the concurrent requests of a worker
+process are instead collected, for up to GROUP_COMMIT_DELAY seconds or
+until GROUP_COMMIT_MAX_ROWS are pending, and written in a single
+transaction, so that a whole group pays for a single flush.
+
+The first request to arrive while no group is pending leads the group: it
+waits for the others, writes the group, and hands each request its own
+result. Every request thus still learns whether its key was free, and a
+request whose key was claimed in the meantime picks another one, as
+without group commit. A lone request is delayed by GROUP_COMMIT_DELAY,
+which is why group commit is opt-in.
+'''
+
+import os
+import threading
+
+
+class GroupCommitter:
+    '''Inserts rows into a storage in groups, one transaction per group.
+
+    Args:
+        storage (storage.Storage): The storage the rows are inserted into
+        max_delay (float): The maximum number of seconds the leader of a
+                           group waits for more rows
+        max_rows (int): The number of pending rows which gets a group
+                        written without waiting any longer
+    '''
+
+    def __init__(self, storage, max_delay, max_rows):
+        self.storage = storage
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._full = threading.Event()
+        self._leading = False
+
+    def insert_if_absent(self, key: str, url: str, expires_at=None) -> bool:
+        '''Insert a (key,url) pair, expiring at expires_at, along with those
+        of the concurrent callers, unless the key already exists. Return
+        whether the pair was inserted. Must be called within an application
+        context.
+
+        Raises:
+            Exception: Whatever writing the group raised
+        '''
+        if self._pid != os.getpid():
+            # forked; the pending rows belong to the parent process
+            self._reset()
+        pending = _PendingRow((key, url, expires_at))
+        with self._lock:
+            self._pending.append(pending)
+            leader = not self._leading
+            if leader:
+                self._leading = True
+            if len(self._pending) >= self.max_rows:
+                self._full.set()
+        if not leader:
+            pending.done.wait()
+        else:
+            try:
+                self._full.wait(self.max_delay)
+            finally:
+                # even if interrupted, the group is taken and written, so
+                # that neither it nor the next one is left waiting
+                with self._lock:
+                    group, self._pending = self._pending, []
+                    self._leading = False
+                    self._full.clear()
+                # the next group may be collected while this one is written
+                self._write(group)
+        if pending.error is not None:
+            raise pending.error
+        return pending.inserted
+
+    def _write(self, group):
+        '''Write a group, and release its requests, whatever happens.'''
+        try:
+            inserted = self.storage.insert_if_absent_many(
+                [pending.row for pending in group])
+            for pending, was_inserted in zip(group, inserted):
+                pending.inserted = was_inserted
+        except Exception as e:
+            for pending in group:
+                pending.error = e
+        except BaseException:
+            # e.g. SystemExit from a worker shutdown, which only the leader
+            # raises; the others learn their row's fate is unknown
+            for pending in group:
+                pending.error = GroupCommitError('the group commit was interrupted')
+            raise
+        finally:
+            for pending in group:
+                pending.done.set()
+
+
+class GroupCommitError(Exception):
+    '''Raised in the requests of a group whose writer was interrupted.'''
+    pass
+
+
+class _PendingRow:
+    '''A row waiting to be written with its group.'''
+
+    __slots__ = ('row', 'inserted', 'error', 'done')
+
+    def __init__(self, row):
+        self.row = row
+        self.inserted = False
+        self.error = None
+        self.done = threading.Event()
+
+
+def init_app(app):
+    '''Create the GroupCommitter of an application, if GROUP_COMMIT is
+    enabled.'''
+    if not app.config['GROUP_COMMIT']:
+        app.extensions.pop('group_committer', None)
+        return
+    app.extensions['group_committer'] = GroupCommitter(
+        app.extensions['storage'],
+        app.config['GROUP_COMMIT_DELAY'],
+        app.config['GROUP_COMMIT_MAX_ROWS'])
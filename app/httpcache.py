@@ -0,0 +1,104 @@
+'''HTTP caching of redirects and lookups.
+
+A short URL never changes once created, so redirects and the responses of
+the lengthen endpoint can be cached by browsers and CDNs. Contains the
+helpers which compute the caching headers and entity tags of these
+responses, shared by the WSGI and ASGI applications. Responses for unknown
+keys are only cached for HTTP_NEGATIVE_MAX_AGE seconds, since the key may
+be created at any time, and responses for short URLs which expire are
+never cached past their expiry, after which the key may be reused.
+'''
+
+import time
+import hashlib
+import datetime
+
+from flask import current_app
+from werkzeug.http import http_date, parse_etags, HTTP_STATUS_CODES
+
+
+REDIRECT_STATUSES = (301, 302, 307, 308)
+
+
+def init_app(app):
+    '''Check the caching options of an application.
+
+    Raises:
+        ValueError: REDIRECT_STATUS is not a redirect status
+    '''
+    if app.config['REDIRECT_STATUS'] not in REDIRECT_STATUSES:
+        raise ValueError('unsupported REDIRECT_STATUS: {}'.format(
+            app.config['REDIRECT_STATUS']))
+
+
+def cache_headers(max_age, expires_at=None) -> list:
+    '''Return the headers letting a response be cached for max_age seconds,
+    but not past expires_at (a naive UTC datetime) if given, or, if that
+    leaves 0 seconds or less, requiring caches to revalidate it every
+    time.'''
+    if expires_at is not None:
+        max_age = min(max_age,
+                      (expires_at - datetime.datetime.utcnow()).total_seconds())
+    max_age = int(max_age)
+    if max_age <= 0:
+        return [('Cache-Control', 'no-cache')]
+    return [('Cache-Control', 'public, max-age={:d}'.format(max_age)),
+            ('Expires', http_date(time.time() + max_age))]
+
+
+def redirect_headers(expires_at=None) -> list:
+    '''Return the caching headers of a redirect of the current application,
+    to a short URL expiring at expires_at, if not None.'''
+    return cache_headers(current_app.config['HTTP_REDIRECT_MAX_AGE'],
+                         expires_at)
+
+
+def lengthen_headers(expires_at=None) -> list:
+    '''Return the caching headers of a lookup of an existing key by the
+    current application, whose short URL expires at expires_at, if not
+    None.'''
+    return cache_headers(current_app.config['HTTP_LENGTHEN_MAX_AGE'],
+                         expires_at)
+
+
+def negative_headers() -> list:
+    '''Return the caching headers of a response of the current application
+    for an unknown key.'''
+    return cache_headers(current_app.config['HTTP_NEGATIVE_MAX_AGE'])
+
+
+def lengthen_response(response, found: bool, if_none_match, expires_at=None):
+    '''Add the caching headers to the response of the lengthen endpoint,
+    plus an ETag if the key was found, in which case the response is turned
+    into a 304 Not Modified if the If-None-Match header value of the request
+    (or None) matches it. expires_at is when the short URL expires, or None.
+    Return the response.'''
+    if not found:
+        response.headers.extend(negative_headers())
+        return response
+    response.headers.extend(lengthen_headers(expires_at))
+    tag = etag(response.get_data())
+    response.headers['ETag'] = tag
+    if not_modified(if_none_match, tag):
+        response.status_code = 304
+        response.set_data(b'')
+    return response
+
+
+def redirect_status_line(status: int) -> str:
+    '''Return the WSGI status line of a redirect status, e.g. '302 FOUND'.'''
+    return '{:d} {}'.format(status, HTTP_STATUS_CODES[status].upper())
+
+
+def etag(body: bytes) -> str:
+    '''Return the strong entity tag of a response body, quoted.'''
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def not_modified(if_none_match, tag: str) -> bool:
+    '''Return whether a response with the given entity tag is fresh for a
+    request with the given If-None-Match header value (or None).'''
+    if not if_none_match:
+        return False
+    # If-None-Match uses the weak comparison
+    return parse_etags(if_none_match).contains_weak(tag.strip('"'))
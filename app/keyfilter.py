@@ -0,0 +1,208 @@
+'''In-memory filter of the existing short keys.
+
+Contains a Bloom filter over the existing short keys, which lets the
+probing of candidate keys when shortening a URL skip the database whenever
+a key is definitely not taken. Lookups don't use it, since the filter of a
+worker process doesn't know the keys created by the others until it is
+rebuilt, whereas a wrongly skipped probe only costs a failed insert. A Bloom
+filter never answers "absent" for a key which was added to it, and answers
+"present" for a key which wasn't with a configurable false positive rate.
+'''
+
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    '''A Bloom filter of strings.
+
+    The filter is sized for capacity items at the given false positive
+    rate, which takes -ln(error_rate) / ln(2)**2 bits per item, e.g. 9.6 bits
+    (1.2 bytes) per item at 1%. The bit positions of an item are derived
+    from a single 128-bit BLAKE2b digest by double hashing.
+
+    Args:
+        capacity (int): The number of items the filter is sized for
+        error_rate (float): The false positive rate of the filter once it
+                            holds capacity items
+    '''
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits = max(8, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.nbits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def __contains__(self, item):
+        bits = self._bits
+        for i in self._positions(item):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        '''Return the number of items added, counting duplicates.'''
+        return self.count
+
+    @property
+    def nbytes(self):
+        '''The size of the bit array, in bytes.'''
+        return len(self._bits)
+
+    def add(self, item):
+        '''Add item to the filter.'''
+        positions = self._positions(item)
+        bits = self._bits
+        # setting a bit isn't atomic, and a lost update is a false negative
+        with self._lock:
+            for i in positions:
+                bits[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+
+    def update(self, items):
+        '''Add every item of an iterable to the filter.'''
+        bits = self._bits
+        with self._lock:
+            for item in items:
+                for i in self._positions(item):
+                    bits[i >> 3] |= 1 << (i & 7)
+                self.count += 1
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        # an odd step visits distinct positions whenever nbits is a power of 2
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in range(self.nhashes)]
+
+
+class KeyFilter:
+    '''A BloomFilter of the keys of the application's Storage, kept up to date.
+
+    The filter is built by streaming every key from the database the first
+    time it is used by a process, and rebuilt every rebuild_interval
+    seconds by a daemon thread, sized for twice the number of keys at the
+    time, and at least capacity. Keys inserted by the current process are
+    added as they are inserted. Until the first build is complete, every
+    key may be present.
+
+    Keys inserted by *other* processes are only known after the next
+    rebuild, so in a deployment with several worker processes, a key
+    created by one worker can be reported as definitely absent by another
+    for up to rebuild_interval seconds.
+
+    Args:
+        app (flask.Flask): The application whose Storage is scanned
+        capacity (int): The minimum number of keys the filter is sized for
+        error_rate (float): The false positive rate of the filter when it
+                            is filled to its size
+        rebuild_interval (float): The number of seconds between rebuilds.
+                                  If 0, no thread is started: the filter is
+                                  built synchronously on first use, and
+                                  only rebuilt by calling rebuild.
+        batch_size (int): The number of keys fetched from the database at a
+                          time while building
+    '''
+
+    def __init__(self, app, capacity, error_rate, rebuild_interval,
+                 batch_size=10000):
+        self.app = app
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._filter = None
+        # keys added while a rebuild is scanning the table
+        self._pending = None
+        self._thread = None
+
+    def might_contain(self, key: str) -> bool:
+        '''Return False if key is definitely not in the table.'''
+        self._ensure_started()
+        bloom = self._filter
+        return bloom is None or key in bloom
+
+    def add(self, key: str):
+        '''Record that key was inserted into the table.'''
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(key)
+            if self._pending is not None:
+                self._pending.append(key)
+
+    def rebuild(self):
+        '''Build a new filter from the keys in the table, and swap it in
+        once complete. Must be called within an application context.'''
+        with self._lock:
+            if self._pending is not None:
+                # another rebuild is in progress
+                return
+            self._pending = []
+        try:
+            start = time.perf_counter()
+            storage = self.app.extensions['storage']
+            bloom = BloomFilter(
+                max(self.capacity, 2 * storage.count()), self.error_rate)
+            bloom.update(storage.scan_keys(self.batch_size))
+            with self._lock:
+                bloom.update(self._pending)
+                self._filter = bloom
+            logger.info('built key filter of %d keys (%d bytes) in %.2fs',
+                        len(bloom), bloom.nbytes, time.perf_counter() - start)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            # forked; the thread belongs to the parent process
+            self._reset()
+        if self._filter is not None or self._thread is not None:
+            return
+        if self.rebuild_interval > 0:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='key-filter', daemon=True)
+                    self._thread.start()
+        else:
+            self.rebuild()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.rebuild()
+            except Exception:
+                logger.exception('failed to build key filter')
+            time.sleep(self.rebuild_interval)
+
+
+def init_app(app):
+    '''Create the KeyFilter of an application, if it is enabled.'''
+    if not app.config['KEY_FILTER']:
+        app.extensions.pop('key_filter', None)
+        return
+    app.extensions['key_filter'] = KeyFilter(
+        app,
+        app.config['KEY_FILTER_CAPACITY'],
+        app.config['KEY_FILTER_ERROR_RATE'],
+        app.config['KEY_FILTER_REBUILD_INTERVAL'])
@@ -0,0 +1,476 @@
+'''Operational metrics.
+
+Contains the counters and latency histograms recorded by the core
+operations, the HTTP endpoints and the database engine, and the
+``/metrics`` endpoint which exposes them in the Prometheus text format.
+
+Every worker process records its metrics in memory. If METRICS_DIR is
+set, each process also writes a snapshot of them to a file of its own in
+that directory every METRICS_SNAPSHOT_INTERVAL seconds, and the
+``/metrics`` endpoint sums the snapshots of every process, so that it
+reports the whole deployment, whichever worker serves the scrape. The
+totals of exited processes are kept, so that counters never go backwards:
+their files are folded into a single one by the remaining processes. The
+directory should be emptied when the deployment (re)starts.
+'''
+
+import os
+import json
+import time
+import errno
+import secrets
+import bisect
+import inspect
+import atexit
+import logging
+import functools
+import threading
+import contextlib
+
+import sqlalchemy
+from flask import current_app, has_app_context, request, g, Response
+
+from app.db import db
+
+try:
+    import fcntl
+except ImportError:
+    # no locking, nor folding of the snapshots of exited processes
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+DEPTH_BUCKETS = (1, 2, 3, 5, 10, 21, 50, 100, 1000)
+
+# the snapshot of a process is written to metrics-<pid>-<token>.json, so that
+# a process reusing the pid of an exited one doesn't overwrite its totals
+SNAPSHOT_PREFIX = 'metrics-'
+EXITED_SNAPSHOT = 'metrics-exited.json'
+SNAPSHOT_LOCK = 'metrics.lock'
+
+COUNTERS = {
+    'shortcake_shorten_total':
+        'URLs shortened, by where their key came from: an existing key, a '
+        'candidate window, the fallback search or the sequence.',
+    'shortcake_shorten_lost_races_total':
+        'Keys which were free when looked up, but claimed by another process '
+        'before being inserted.',
+    'shortcake_lengthen_total':
+        'Keys lengthened, by what answered the lookup.',
+    'shortcake_try_insert_total':
+        'Attempts to insert a (key,url) pair, by outcome.',
+    'shortcake_swept_total':
+        'Expired short URLs deleted by the sweeper.',
+    'shortcake_replica_reads_total':
+        'Short URL lookups, by the database they were made on: a read '
+        'replica, the primary, or the primary again for the keys a replica '
+        'missed.',
+    'shortcake_replica_ejections_total':
+        'Read replicas ejected after a failed query.',
+    'shortcake_db_queries_total':
+        'Statements executed by the SQLAlchemy engine.',
+}
+
+HISTOGRAMS = {
+    'shortcake_core_seconds':
+        ('Latency of the core operations.', LATENCY_BUCKETS),
+    'shortcake_shorten_phase_seconds':
+        ('Latency of each phase of shorten_url.', LATENCY_BUCKETS),
+    'shortcake_shorten_probe_depth':
+        ('Number of candidate keys considered by shorten_url before finding '
+         'a free one.', DEPTH_BUCKETS),
+    'shortcake_db_query_seconds':
+        ('Latency of the statements executed by the SQLAlchemy engine.',
+         LATENCY_BUCKETS),
+    'shortcake_http_request_seconds':
+        ('Latency of HTTP requests, by endpoint and status.', LATENCY_BUCKETS),
+}
+
+
+class Metrics:
+    '''The counters and histograms of one process.
+
+    Series are identified by the name of a metric, declared in COUNTERS or
+    HISTOGRAMS, and a dict of labels. Recording a value takes a lock and a
+    couple of dict operations.
+
+    Args:
+        directory (str): The directory where snapshots of the metrics of
+                         every process are written, or None
+        snapshot_interval (float): The number of seconds between two
+                                   snapshots
+    '''
+
+    def __init__(self, directory=None, snapshot_interval=5):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # a new lock, since another thread of the parent process may have
+        # held its lock when it forked
+        self._lock = threading.Lock()
+        self._filename = '{}{}-{}.json'.format(
+            SNAPSHOT_PREFIX, self._pid, secrets.token_hex(4))
+        # counters, and histograms as a list of bucket counts followed by the
+        # sum of the observed values, by (name, sorted label items)
+        self._counters = {}
+        self._histograms = {}
+        self._thread = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # forked; the parent's values are reported by the parent
+            self._reset()
+        if self._thread is None and self.directory:
+            with self._lock:
+                if self._thread is None:
+                    self._start()
+
+    def inc(self, name, labels, amount=1):
+        '''Add amount to a counter.'''
+        series = (name, tuple(sorted(labels.items())))
+        self._check_pid()
+        with self._lock:
+            self._counters[series] = self._counters.get(series, 0) + amount
+
+    def observe(self, name, labels, value):
+        '''Record a value in a histogram.'''
+        series = (name, tuple(sorted(labels.items())))
+        buckets = HISTOGRAMS[name][1]
+        i = bisect.bisect_left(buckets, value)
+        self._check_pid()
+        with self._lock:
+            counts = self._histograms.get(series)
+            if counts is None:
+                counts = self._histograms[series] = [0] * (len(buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict:
+        '''Return the metrics of this process, in a JSON serializable form.'''
+        self._check_pid()
+        with self._lock:
+            return _snapshot(self._counters, self._histograms)
+
+    def write_snapshot(self):
+        '''Write the snapshot of this process to its file in the directory.'''
+        snapshot = self.snapshot()
+        _write_json(os.path.join(self.directory, self._filename), snapshot)
+
+    def collect(self) -> list:
+        '''Return the snapshots of every process, this one included.'''
+        if not self.directory:
+            return [self.snapshot()]
+        snapshots = [self.snapshot()]
+        with self._locked_directory(exclusive=False):
+            for filename in os.listdir(self.directory):
+                if not filename.endswith('.json') or filename == self._filename:
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    logger.warning('skipping unreadable metrics snapshot %s',
+                                   filename)
+        return snapshots
+
+    def fold_exited(self) -> int:
+        '''Add the snapshots of the processes which have exited to the
+        snapshot of the exited processes, and remove their files, so that
+        the directory doesn't grow with every restarted worker. Return the
+        number of files removed.'''
+        if fcntl is None:
+            return 0
+        with self._locked_directory(exclusive=True):
+            dead = [filename for filename in os.listdir(self.directory)
+                    if not _alive(_snapshot_pid(filename))]
+            if not dead:
+                return 0
+            exited_path = os.path.join(self.directory, EXITED_SNAPSHOT)
+            snapshots = []
+            for filename in [EXITED_SNAPSHOT] + dead:
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        snapshots.append(json.load(f))
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError):
+                    logger.warning('skipping unreadable metrics snapshot %s',
+                                   filename)
+            counters, histograms = _merge(snapshots)
+            _write_json(exited_path, _snapshot(
+                {(name, labels): value for name, series in counters.items()
+                 for labels, value in series.items()},
+                {(name, labels): counts for name, series in histograms.items()
+                 for labels, counts in series.items()}))
+            for filename in dead:
+                os.remove(os.path.join(self.directory, filename))
+            return len(dead)
+
+    @contextlib.contextmanager
+    def _locked_directory(self, exclusive):
+        '''Lock the directory, so that collect never sees the snapshots of
+        exited processes both folded and in their own files.'''
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, SNAPSHOT_LOCK), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def render(self) -> str:
+        '''Return the metrics of every process, summed, in the Prometheus
+        text format.'''
+        counters, histograms = _merge(self.collect())
+        lines = []
+        for name, help_text in COUNTERS.items():
+            lines += ['# HELP {} {}'.format(name, help_text),
+                      '# TYPE {} counter'.format(name)]
+            for labels, value in sorted(counters.get(name, {}).items()):
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines += ['# HELP {} {}'.format(name, help_text),
+                      '# TYPE {} histogram'.format(name)]
+            for labels, counts in sorted(histograms.get(name, {}).items()):
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels + (('le', _number(bound)),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, _labels(labels), _number(counts[-1])))
+                lines.append('{}_count{} {}'.format(
+                    name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='metrics-snapshot', daemon=True)
+        self._thread.start()
+        atexit.register(self._write_snapshot_logging_errors)
+
+    def _run(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self._write_snapshot_logging_errors()
+            try:
+                self.fold_exited()
+            except Exception:
+                logger.exception('failed to fold metrics snapshots')
+
+    def _write_snapshot_logging_errors(self):
+        try:
+            self.write_snapshot()
+        except Exception:
+            logger.exception('failed to write metrics snapshot')
+
+
+def _snapshot(counters, histograms) -> dict:
+    '''Return counters and histograms, by (name, sorted label items), in a
+    JSON serializable form.'''
+    return {
+        'counters': [[name, dict(labels), value] for (name, labels), value
+                     in counters.items()],
+        'histograms': [[name, dict(labels), list(counts)]
+                       for (name, labels), counts in histograms.items()],
+    }
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    # readers never see a partially written file
+    os.replace(tmp, path)
+
+
+def _snapshot_pid(filename):
+    '''Return the pid of the process whose snapshot is in filename, or None
+    if it isn't the snapshot of a single process.'''
+    if not filename.startswith(SNAPSHOT_PREFIX) or not filename.endswith('.json'):
+        return None
+    pid = filename[len(SNAPSHOT_PREFIX):-len('.json')].split('-', 1)[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def _alive(pid) -> bool:
+    '''Return whether a process with the given pid exists; True if pid is
+    None.'''
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def init_app(app):
+    '''Create the Metrics of an application, if enabled, and register the
+    /metrics endpoint and the hooks which time requests and queries.'''
+    if not app.config['METRICS']:
+        app.extensions.pop('metrics', None)
+        return
+    directory = app.config['METRICS_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    registry = Metrics(directory, app.config['METRICS_SNAPSHOT_INTERVAL'])
+    app.extensions['metrics'] = registry
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            registry.observe(
+                'shortcake_http_request_seconds',
+                {'endpoint': request.endpoint or 'none',
+                 'status': str(response.status_code)},
+                time.perf_counter() - start)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', _metrics_view)
+
+    with app.app_context():
+        instrument_engine(registry, db.get_engine(app))
+
+
+def instrument_engine(registry, engine):
+    '''Record the number and latency of the statements executed by a
+    (synchronous) SQLAlchemy engine in registry.'''
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', _before_query)
+    sqlalchemy.event.listen(
+        engine, 'after_cursor_execute', functools.partial(_after_query, registry))
+    sqlalchemy.event.listen(engine, 'handle_error', _failed_query)
+
+
+def inc(name: str, amount=1, **labels):
+    '''Add amount to a counter of the current application.'''
+    registry = _registry()
+    if registry is not None:
+        registry.inc(name, labels, amount)
+
+
+def observe(name: str, value, **labels):
+    '''Record a value in a histogram of the current application.'''
+    registry = _registry()
+    if registry is not None:
+        registry.observe(name, labels, value)
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels):
+    '''Record the time spent in a with block in a histogram.'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timer(name: str, **labels):
+    '''Decorator recording the time spent in each call of a function, or of
+    a coroutine function, in a histogram.'''
+    def decorator(f):
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await f(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - start, **labels)
+            return async_wrapper
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def _registry():
+    '''Return the Metrics of the current application, or None if there is
+    none, or no application context.'''
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('metrics')
+
+
+def _metrics_view():
+    registry = current_app.extensions['metrics']
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_query(registry, conn, cursor, statement, parameters, context,
+                 executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        return
+    registry.inc('shortcake_db_queries_total', {})
+    registry.observe('shortcake_db_query_seconds', {},
+                     time.perf_counter() - starts.pop())
+
+
+def _failed_query(context):
+    starts = context.connection.info.get('metrics_query_start')
+    if starts:
+        starts.pop()
+
+
+def _merge(snapshots):
+    '''Sum snapshots into dicts of counters and histograms, by metric name
+    and then by sorted label items.'''
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            series = counters.setdefault(name, {})
+            labels = tuple(sorted(labels.items()))
+            series[labels] = series.get(labels, 0) + value
+        for name, labels, counts in snapshot['histograms']:
+            if name not in HISTOGRAMS or \
+                    len(counts) != len(HISTOGRAMS[name][1]) + 2:
+                # written by a process with different buckets
+                continue
+            series = histograms.setdefault(name, {})
+            labels = tuple(sorted(labels.items()))
+            total = series.get(labels)
+            if total is None:
+                series[labels] = list(counts)
+            else:
+                series[labels] = [a + b for a, b in zip(total, counts)]
+    return counters, histograms
+
+
+def _labels(items) -> str:
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in items) + '}'
+
+
+def _number(value) -> str:
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
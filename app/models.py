@@ -1,13 +1,79 @@
-'''This module contains the database model definition only.'''
+'''This module contains the database model definitions only.'''
+
+import hashlib
+
+from sqlalchemy.dialects import postgresql
 
 from app import db
 
+
+def url_digest(url: str) -> str:
+    '''Return the fixed-width digest of a URL, as stored in ShortURL.url_digest.'''
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def _default_url_digest(context):
+    url = context.get_current_parameters().get('url')
+    return url_digest(url) if url is not None else None
+
+
 class ShortURL(db.Model):
-    '''This class represents the sole database table of the application,
+    '''This class represents the main database table of the application,
        which serves to associate short URLs with long ones. The short URL
        key is used as the database primary key, because these have to be
-       unique anyway.
+       unique anyway. The indexed digest of the URL allows finding the key
+       of an already shortened URL without scanning the table; it is
+       filled in automatically from the URL on insert. A short URL with an
+       expires_at (naive UTC) is treated as missing once expired, until its
+       row is deleted by the sweeper, which finds it through the index.
+       Keys are compared bytewise (the "C" collation on PostgreSQL, SQLite's
+       default elsewhere), so that range scans and ordered scans of keys are
+       served by the primary key index.
     '''
     __tablename__ = 'shortURL'
-    key = db.Column(db.String(10), primary_key=True)
+    key = db.Column(
+        db.String(10).with_variant(postgresql.VARCHAR(10, collation='C'), 'postgresql'),
+        primary_key=True)
     url = db.Column(db.String(1000))
+    url_digest = db.Column(db.String(40), index=True, default=_default_url_digest)
+    expires_at = db.Column(db.DateTime, index=True)
+
+
+class KeySequence(db.Model):
+    '''This class represents named, monotonically increasing id sequences,
+       from which blocks of ids are reserved by incrementing next_id. It
+       serves the same purpose as a database sequence, but works the same
+       way on every database.
+    '''
+    __tablename__ = 'keySequence'
+    name = db.Column(db.String(32), primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+
+class KeyLease(db.Model):
+    '''This class represents a range of ids of a KeySequence, [start, end),
+       leased by a single worker process until expires_at. The worker
+       periodically checkpoints its progress through the range into next_id
+       and renews the lease. Once a lease expires, the ids from next_id
+       onwards may be reclaimed by another worker.
+    '''
+    __tablename__ = 'keyLease'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), nullable=False)
+    start = db.Column(db.BigInteger, nullable=False)
+    end = db.Column(db.BigInteger, nullable=False)
+    next_id = db.Column(db.BigInteger, nullable=False)
+    owner = db.Column(db.String(128), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ClickStat(db.Model):
+    '''This class represents the number of clicks on (i.e. redirects served
+       for) a short URL during one minute. Rows are upserted in batches by
+       the click recorder, so the counts lag behind by up to one flush
+       interval.
+    '''
+    __tablename__ = 'clickStat'
+    key = db.Column(db.String(10), primary_key=True)
+    minute = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,224 @@
+'''On-demand request profiling.
+
+Contains a WSGI middleware which profiles a sample of requests, plus any
+request carrying the profiling secret in its X-Shortcake-Profile header,
+and writes one profile per request to a directory. Profiles are either
+cProfile statistics (``.prof``, for pstats, snakeviz, etc.), or the
+collapsed stacks of a sampling profiler (``.folded``, for flamegraph.pl or
+speedscope). Requests which aren't profiled only pay for a random draw.
+Sampled profiles are rate limited per process, and the oldest profiles
+are deleted once the directory holds too many, so that neither the
+overhead nor the disk usage grows with traffic.
+'''
+
+import os
+import sys
+import hmac
+import time
+import random
+import logging
+import cProfile
+import threading
+from collections import Counter
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_SHORTCAKE_PROFILE'
+MODES = ('cprofile', 'sampling')
+
+
+class ProfilingMiddleware:
+    '''WSGI middleware which profiles some of the requests to an application.
+
+    Args:
+        wsgi_app (callable): The WSGI application to profile
+        directory (str): The directory the profiles are written to
+        secret (str): The value of the X-Shortcake-Profile header which
+                      forces a request to be profiled, or None
+        sample_rate (float): The fraction of all requests which are profiled
+        mode (str): 'cprofile' or 'sampling'
+        sampling_interval (float): The number of seconds between two samples
+                                   of the sampling profiler
+        max_files (int): The number of profiles kept in the directory; the
+                         oldest ones are deleted past it. 0 keeps them all.
+        max_per_minute (int): The maximum number of requests profiled at
+                              random per minute. 0 means no limit.
+        clock (callable): Returns the current time in seconds
+    '''
+
+    def __init__(self, wsgi_app, directory, secret=None, sample_rate=0,
+                 mode='cprofile', sampling_interval=0.001, max_files=0,
+                 max_per_minute=0, clock=time.monotonic):
+        if mode not in MODES:
+            raise ValueError('unknown profiling mode: ' + mode)
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.sampling_interval = sampling_interval
+        self.max_files = max_files
+        self.max_per_minute = max_per_minute
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._minute_start = None
+        self._minute_count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        start = time.perf_counter()
+        if self.mode == 'cprofile':
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is already active in this thread
+                return self.wsgi_app(environ, start_response)
+        else:
+            profiler = SamplingProfiler(self.sampling_interval)
+            profiler.start()
+        try:
+            # the body is produced within the profile too
+            body = self.wsgi_app(environ, start_response)
+            try:
+                chunks = list(body)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        finally:
+            if self.mode == 'cprofile':
+                profiler.disable()
+            else:
+                profiler.stop()
+            self._write(profiler, environ, time.perf_counter() - start)
+        return chunks
+
+    def should_profile(self, environ) -> bool:
+        '''Return whether to profile a request.'''
+        header = environ.get(PROFILE_HEADER)
+        if header is not None and self.secret and \
+                hmac.compare_digest(header.encode(), self.secret.encode()):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate \
+            and self._take_sample()
+
+    def _take_sample(self) -> bool:
+        '''Count a request profiled at random, and return whether it is
+        within max_per_minute.'''
+        if self.max_per_minute <= 0:
+            return True
+        now = self._clock()
+        with self._lock:
+            if self._minute_start is None or now - self._minute_start >= 60:
+                self._minute_start = now
+                self._minute_count = 0
+            if self._minute_count >= self.max_per_minute:
+                return False
+            self._minute_count += 1
+            return True
+
+    def _write(self, profiler, environ, elapsed):
+        path_info = environ.get('PATH_INFO', '/').strip('/').replace('/', '.')
+        name = '{:.6f}-{}-{}-{}-{:.0f}ms'.format(
+            time.time(), os.getpid(), environ.get('REQUEST_METHOD', ''),
+            ''.join(c for c in path_info if c.isalnum() or c in '._-')[:64]
+            or 'root', elapsed * 1e3)
+        try:
+            if self.mode == 'cprofile':
+                profiler.dump_stats(os.path.join(self.directory, name + '.prof'))
+            else:
+                with open(os.path.join(self.directory, name + '.folded'), 'w') as f:
+                    profiler.write_collapsed(f)
+        except OSError:
+            logger.exception('failed to write profile %s', name)
+        self._rotate()
+
+    def _rotate(self):
+        '''Delete the oldest profiles of the directory, shared by every
+        process, past max_files.'''
+        if self.max_files <= 0:
+            return
+        try:
+            # names start with the time, so they sort oldest first
+            names = sorted(name for name in os.listdir(self.directory)
+                           if name.endswith(('.prof', '.folded')))
+            for name in names[:-self.max_files]:
+                os.remove(os.path.join(self.directory, name))
+        except OSError:
+            # another process may have deleted the same profile first
+            pass
+
+
+class SamplingProfiler:
+    '''Samples the stack of a thread at regular intervals.
+
+    The samples are aggregated into collapsed stacks, i.e. one line per
+    distinct stack, of the form "outermost;...;innermost count", which is
+    the input format of flamegraph.pl and speedscope. Sampling happens in
+    a separate thread, so the profiled thread is only slowed down by
+    contention for the GIL. While the profiled thread is CPU bound, the
+    sampling thread only gets the GIL every sys.getswitchinterval()
+    seconds (5ms by default), so samples are at least that far apart.
+
+    Args:
+        interval (float): The number of seconds between two samples
+        thread_id (int): The identifier of the thread to sample. Defaults to
+                         the thread calling start.
+    '''
+
+    def __init__(self, interval=0.001, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''Start sampling.'''
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(
+            target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stop sampling, and wait for the sampling thread to exit.'''
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(
+                    code.co_filename, code.co_name, code.co_firstlineno))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, f):
+        '''Write the collapsed stacks to a text file.'''
+        for stack, count in self.stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+def init_app(app):
+    '''Wrap the WSGI application of app in a ProfilingMiddleware, if
+    profiling is enabled.'''
+    if not app.config['PROFILING']:
+        return
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app,
+        app.config['PROFILING_DIR'],
+        app.config['PROFILING_SECRET'],
+        app.config['PROFILING_SAMPLE_RATE'],
+        app.config['PROFILING_MODE'],
+        app.config['PROFILING_SAMPLING_INTERVAL'],
+        app.config['PROFILING_MAX_FILES'],
+        app.config['PROFILING_MAX_PER_MINUTE'])
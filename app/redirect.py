@@ -0,0 +1,123 @@
+'''Short URL redirection.
+
+Contains the helpers shared by every place which redirects short URLs, as
+well as a WSGI middleware which serves these redirects directly, bypassing
+Flask's request dispatching and template rendering.
+'''
+
+import time
+
+from flask import render_template, current_app, has_app_context
+from werkzeug.urls import iri_to_uri
+
+from app import core, clicks, httpcache
+
+
+# deletes every valid short key character from a string
+_KEY_CHARS_TABLE = str.maketrans('', '', core.SHORTKEY_CHARSET)
+
+
+def is_key_path(path: str) -> bool:
+    '''Return whether a request path is "/" followed by a valid short key.'''
+    return 8 <= len(path) <= 11 and path[0] == '/' and \
+        not path[1:].translate(_KEY_CHARS_TABLE)
+
+
+def redirect_location(url: str) -> str:
+    '''Return the value of the Location header redirecting to url.'''
+    # TODO this is just a temporary hack for domain-only URLs
+    if not url.startswith('http'):
+        url = 'http://' + url
+    return iri_to_uri(url, safe_conversion=True)
+
+
+class RedirectFastPath:
+    '''WSGI middleware which serves short URL redirects.
+
+    GET and HEAD requests for a path of the form /<key> are answered
+    directly, with a single lookup and no routing, request context or
+    session. A redirect, or the 404 page, are equivalent to what the
+    webapp blueprint returns, caching headers included. The 404 page is
+    rendered only once. Every other request, including requests for the
+    paths of the application's static routes (e.g. /metrics), falls through
+    to the wrapped WSGI application.
+
+    Args:
+        app (flask.Flask): The application whose configuration and database
+                           are used
+        wsgi_app (callable): The WSGI application to fall through to
+    '''
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self._not_found_body = None
+        self._static_paths = None
+        self._status_line = None
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        method = environ.get('REQUEST_METHOD')
+        if not is_key_path(path) or method not in ('GET', 'HEAD') or \
+                path in self.static_paths():
+            return self.wsgi_app(environ, start_response)
+        start = time.perf_counter()
+        # like flask, reuse the application context if one is already pushed
+        if has_app_context() and current_app._get_current_object() is self.app:
+            url, expires_at = core.lengthen_entry(path[1:])
+        else:
+            with self.app.app_context():
+                url, expires_at = core.lengthen_entry(path[1:])
+        if url:
+            clicks.record(self.app, path[1:])
+            status = self.status_line()
+            body = b''
+            headers = [('Location', redirect_location(url))]
+            max_age = self.app.config['HTTP_REDIRECT_MAX_AGE']
+        else:
+            status = '404 NOT FOUND'
+            body = self.not_found_body()
+            headers = [('Content-Type', 'text/html; charset=utf-8')]
+            max_age = self.app.config['HTTP_NEGATIVE_MAX_AGE']
+        headers += httpcache.cache_headers(max_age, expires_at)
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        registry = self.app.extensions.get('metrics')
+        if registry is not None:
+            registry.observe(
+                'shortcake_http_request_seconds',
+                {'endpoint': 'redirect_fast_path', 'status': status[:3]},
+                time.perf_counter() - start)
+        return [body] if method == 'GET' else []
+
+    def status_line(self) -> str:
+        '''Return the status line of a redirect, as configured.'''
+        if self._status_line is None:
+            self._status_line = httpcache.redirect_status_line(
+                self.app.config['REDIRECT_STATUS'])
+        return self._status_line
+
+    def static_paths(self) -> set:
+        '''Return the paths of the routes of the application which take no
+        arguments, which are never short URLs.'''
+        if self._static_paths is None:
+            self._static_paths = {rule.rule for rule in self.app.url_map.iter_rules()
+                                  if not rule.arguments}
+        return self._static_paths
+
+    def not_found_body(self) -> bytes:
+        '''Return the pre-rendered body of the 404 page.'''
+        if self._not_found_body is None:
+            self._not_found_body = render_not_found(self.app)
+        return self._not_found_body
+
+
+def render_not_found(app) -> bytes:
+    '''Render the body of the 404 page of app, which is the webapp's if the
+    web interface is served.'''
+    if 'webapp' in app.blueprints:
+        with app.test_request_context('/'):
+            html = render_template('404.html')
+    else:
+        html = '<h1>Not Found</h1>'
+    return html.encode()
@@ -0,0 +1,175 @@
+'''Routing of short URL lookups to read replicas.
+
+Lookups of short URLs far outnumber their creation, so with
+READ_REPLICA_URIS set, the lookups of the ``'sqlalchemy'`` storage backend
+are spread round-robin over read replicas of the database, while every
+write, and every read made while shortening, still goes to the primary
+database at SQLALCHEMY_DATABASE_URI. A replica whose query fails is
+ejected for READ_REPLICA_EJECT_SECONDS, and the lookup is retried on the
+next one, then on the primary if no replica is left.
+
+Replicas lag behind the primary, so lookups of the keys a worker process
+inserted within the last READ_YOUR_WRITES_SECONDS are sent to the primary,
+and, unless READ_REPLICA_RECHECK_MISSES is disabled, keys which a replica
+doesn't know are looked up again on the primary, since they may just have
+been created by another process. A short URL is thus resolvable as soon as
+it is returned by a shorten request.
+'''
+
+import os
+import math
+import time
+import logging
+import threading
+import itertools as it
+from collections import OrderedDict
+
+import sqlalchemy
+from sqlalchemy.exc import DBAPIError
+
+from app import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaSet:
+    '''The read replicas of a database, and the keys recently written to
+    the primary.
+
+    Args:
+        uris (list): The URIs of the replicas
+        eject_seconds (float): How long a failing replica is left out
+        window (float): How long, in seconds, the lookups of a key written
+                        to the primary are sent to the primary
+        recheck_misses (bool): Whether keys missing from a replica should be
+                               looked up again on the primary
+        timeout (float): The connect and statement timeout of the replicas,
+                         in seconds
+        clock (callable): Returns the current time in seconds
+    '''
+
+    # how long, in seconds, a pooled connection is reused, so that
+    # connections dropped by the replica or the network are replaced
+    # without a ping before every lookup
+    POOL_RECYCLE = 300
+
+    def __init__(self, uris, eject_seconds, window, recheck_misses=True,
+                 timeout=1.0, clock=time.monotonic):
+        self.uris = list(uris)
+        self.eject_seconds = eject_seconds
+        self.window = window
+        self.recheck_misses = recheck_misses
+        self.timeout = timeout
+        self._clock = clock
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._engines = [None] * len(self.uris)
+        self._ejected_until = [0.0] * len(self.uris)
+        self._turns = it.count()
+        self._written = OrderedDict()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # forked; the pooled connections belong to the parent process
+            for engine in self._engines:
+                if engine is not None:
+                    engine.dispose(close=False)
+            self._reset()
+
+    def execute(self, stmt):
+        '''Execute a read-only statement on the next healthy replica, and
+        return its rows, or None if every replica is ejected or fails.'''
+        self._check_pid()
+        n = len(self.uris)
+        first = next(self._turns)
+        for i in range(first, first + n):
+            index = i % n
+            if self._ejected_until[index] > self._clock():
+                continue
+            try:
+                with self._engine(index).connect() as conn:
+                    rows = conn.execute(stmt).all()
+            except DBAPIError:
+                logger.warning('ejecting read replica %d for %gs', index,
+                               self.eject_seconds, exc_info=True)
+                self._ejected_until[index] = self._clock() + self.eject_seconds
+                metrics.inc('shortcake_replica_ejections_total')
+                continue
+            return rows
+        return None
+
+    def wrote(self, keys):
+        '''Record that keys were just written to the primary.'''
+        if self.window <= 0:
+            return
+        now = self._clock()
+        with self._lock:
+            for key in keys:
+                self._written[key] = now
+                self._written.move_to_end(key)
+            # drop the keys which are out of the window, the oldest first
+            while self._written:
+                key, written = next(iter(self._written.items()))
+                if written > now - self.window:
+                    break
+                del self._written[key]
+
+    def written_recently(self, keys) -> bool:
+        '''Return whether any of keys was written to the primary by this
+        process within the read-your-writes window.'''
+        if not self._written:
+            return False
+        horizon = self._clock() - self.window
+        with self._lock:
+            return any(self._written.get(key, horizon) > horizon
+                       for key in keys)
+
+    def _engine(self, index):
+        engine = self._engines[index]
+        if engine is None:
+            with self._lock:
+                engine = self._engines[index]
+                if engine is None:
+                    uri = self.uris[index]
+                    engine = sqlalchemy.create_engine(
+                        uri, pool_recycle=self.POOL_RECYCLE,
+                        connect_args=_connect_args(uri, self.timeout))
+                    self._engines[index] = engine
+        return engine
+
+
+def _connect_args(uri: str, timeout: float) -> dict:
+    '''Return the DBAPI connect arguments making connections to, and
+    statements on, the database at uri time out after timeout seconds, so
+    that a hung replica fails, and is ejected, instead of blocking requests.
+    '''
+    backend = sqlalchemy.engine.make_url(uri).get_backend_name()
+    if backend == 'postgresql':
+        return {
+            # libpq only takes whole seconds
+            'connect_timeout': max(1, math.ceil(timeout)),
+            'options': '-c statement_timeout={:d}'.format(int(timeout * 1000)),
+        }
+    if backend == 'sqlite':
+        # how long to wait for a lock
+        return {'timeout': timeout}
+    return {}
+
+
+def init_app(app):
+    '''Create the ReplicaSet of an application, if READ_REPLICA_URIS is
+    set.'''
+    uris = app.config['READ_REPLICA_URIS']
+    if not uris:
+        app.extensions.pop('read_replicas', None)
+        return
+    app.extensions['read_replicas'] = ReplicaSet(
+        uris,
+        app.config['READ_REPLICA_EJECT_SECONDS'],
+        app.config['READ_YOUR_WRITES_SECONDS'],
+        app.config['READ_REPLICA_RECHECK_MISSES'],
+        app.config['READ_REPLICA_TIMEOUT'])
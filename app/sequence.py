@@ -0,0 +1,237 @@
+'''Sequential short key allocation.
+
+Contains the pieces used by the "sequence" short key strategy: the
+allocation of monotonically increasing ids from leased ranges, and the keyed
+permutation which maps those ids onto non-guessable positions in the
+short key space. Distinct ids always map to distinct keys, so keys
+allocated this way never collide with each other.
+'''
+
+import os
+import hmac
+import socket
+import hashlib
+import secrets
+import datetime
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app.db import db
+from app.models import KeySequence, KeyLease
+
+
+class FeistelPermutation:
+    '''A keyed bijection of the integers in [0, a*b).
+
+    This is a Feistel network with alternating moduli a and b (as in
+    Black and Rogaway's "generalized Feistel"), so that the domain needn't
+    be a power of two. With a = 62**3 and b = 62**4, it permutes the ids of
+    all 7-character base62 keys, and each round operates on whole base62
+    digits. The round function is HMAC-SHA256 keyed with a secret, so the
+    permutation can't be inverted without knowing the secret.
+
+    Args:
+        secret (bytes): The key of the permutation
+        a (int): The modulus of the left half
+        b (int): The modulus of the right half
+        rounds (int): The number of Feistel rounds; must be even
+    '''
+
+    def __init__(self, secret, a, b, rounds=8):
+        if rounds % 2:
+            raise ValueError('the number of rounds must be even')
+        self.secret = secret
+        self.a = a
+        self.b = b
+        self.rounds = rounds
+
+    def __len__(self):
+        return self.a * self.b
+
+    def _round(self, i, x):
+        msg = i.to_bytes(1, 'big') + x.to_bytes(8, 'big')
+        digest = hmac.new(self.secret, msg, hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def permute(self, n):
+        '''Return the image of n, which must be in [0, a*b).'''
+        a, b = self.a, self.b
+        left, right = divmod(n, b)
+        for i in range(self.rounds):
+            left, right = right, (left + self._round(i, right)) % a
+            a, b = b, a
+        return left * b + right
+
+    def invert(self, n):
+        '''Return the preimage of n, which must be in [0, a*b).'''
+        a, b = self.a, self.b
+        left, right = divmod(n, b)
+        for i in reversed(range(self.rounds)):
+            a, b = b, a
+            left, right = (right - self._round(i, left)) % a, left
+        return left * b + right
+
+
+class LeaseAllocator:
+    '''Hands out monotonically increasing ids from leased ranges.
+
+    Each worker process leases a range of lease_size ids of a sequence at
+    a time, recorded in the KeyLease table, and hands them out from memory
+    without any coordination with other processes. The progress through
+    the range is checkpointed to the lease every checkpoint_interval ids,
+    which also renews the lease for another ttl seconds; this is the only
+    query made until the range runs out. A lease which isn't renewed in
+    time, because its worker crashed or hung, expires, and the remainder
+    of its range is reclaimed by the next worker which needs ids, starting
+    from the last checkpoint. Ids used after that checkpoint are then
+    handed out again, so callers must tolerate the occasional id whose
+    key turns out to be taken.
+
+    Args:
+        name (str): The name of the sequence in the KeySequence table
+        lease_size (int): The number of ids in a newly leased range
+        ttl (float): The number of seconds a lease is valid for unless
+                     renewed
+        checkpoint_interval (int): The number of ids handed out between
+                                   checkpoints
+        clock (callable): Returns the current UTC time as a datetime
+    '''
+
+    def __init__(self, name, lease_size, ttl, checkpoint_interval,
+                 clock=datetime.datetime.utcnow):
+        self.name = name
+        self.lease_size = lease_size
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.checkpoint_interval = checkpoint_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self.owner = '{}:{}:{}'.format(
+            socket.gethostname(), self._pid, secrets.token_hex(4))
+        self._lease_id = None
+        self._next = self._end = self._checkpointed = 0
+        self._renew_at = None
+
+    def next_id(self) -> int:
+        '''Return the next unused id.'''
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked; the lease belongs to the parent process
+                self._reset()
+            if self._lease_id is not None:
+                if self._next == self._end:
+                    self._finish()
+                elif self._next - self._checkpointed >= self.checkpoint_interval \
+                        or self._clock() >= self._renew_at:
+                    self._checkpoint(self._clock() + self.ttl)
+            if self._lease_id is None:
+                self._acquire()
+            n = self._next
+            self._next += 1
+            return n
+
+    def release(self):
+        '''Checkpoint the current lease and let it expire immediately, so
+        that its remaining ids can be reclaimed by another process.'''
+        with self._lock:
+            if self._lease_id is not None and self._pid == os.getpid():
+                self._checkpoint(self._clock())
+                self._lease_id = None
+
+    def _acquire(self):
+        table = KeyLease.__table__
+        now = self._clock()
+        expires = now + self.ttl
+        # try to reclaim the remainder of an expired lease first
+        with db.engine.begin() as conn:
+            expired = conn.execute(
+                select(table.c.id, table.c.next_id, table.c.end)
+                .where(table.c.name == self.name)
+                .where(table.c.expires_at < now)
+                .where(table.c.next_id < table.c.end)
+                .order_by(table.c.id)
+                .limit(1)
+            ).first()
+            # the expiry is checked again, so that only one process can win
+            if expired and conn.execute(
+                    table.update()
+                    .where(table.c.id == expired.id)
+                    .where(table.c.expires_at < now)
+                    .values(owner=self.owner, expires_at=expires)
+            ).rowcount == 1:
+                self._lease_id, start, self._end = expired
+                self._start(start, expires)
+                return
+        start = reserve_ids(self.name, self.lease_size)
+        with db.engine.begin() as conn:
+            self._lease_id = conn.execute(table.insert().values(
+                name=self.name, start=start, end=start + self.lease_size,
+                next_id=start, owner=self.owner, expires_at=expires,
+            )).inserted_primary_key[0]
+        self._end = start + self.lease_size
+        self._start(start, expires)
+
+    def _start(self, start, expires):
+        self._next = self._checkpointed = start
+        # renew well before expiry, so that no other process can reclaim
+        # the lease while ids are still being handed out from it
+        self._renew_at = expires - self.ttl / 4
+
+    def _checkpoint(self, expires):
+        table = KeyLease.__table__
+        with db.engine.begin() as conn:
+            renewed = conn.execute(
+                table.update()
+                .where(table.c.id == self._lease_id)
+                .where(table.c.owner == self.owner)
+                .values(next_id=self._next, expires_at=expires)
+            ).rowcount
+        if renewed:
+            self._checkpointed = self._next
+            self._renew_at = expires - self.ttl / 4
+        else:
+            # the lease expired and was reclaimed by another process
+            self._lease_id = None
+
+    def _finish(self):
+        table = KeyLease.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                table.delete()
+                .where(table.c.id == self._lease_id)
+                .where(table.c.owner == self.owner))
+        self._lease_id = None
+
+
+def reserve_ids(name: str, count: int) -> int:
+    '''Atomically reserve count consecutive ids from the named sequence,
+    and return the first of them.
+
+    The reservation runs in its own transaction on its own connection, so
+    it is committed independently of the current session.
+    '''
+    table = KeySequence.__table__
+    with db.engine.begin() as conn:
+        updated = conn.execute(
+            table.update()
+            .where(table.c.name == name)
+            .values(next_id=table.c.next_id + count)
+        ).rowcount
+        if updated:
+            end = conn.execute(
+                select(table.c.next_id).where(table.c.name == name)
+            ).scalar()
+            return end - count
+    # the sequence doesn't exist yet. Create it, unless another process has
+    # just done so, in which case the insert fails and we try again.
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(name=name, next_id=count))
+        return 0
+    except IntegrityError:
+        return reserve_ids(name, count)
@@ -0,0 +1,224 @@
+'''Read-only snapshots of the short URLs.
+
+A snapshot is an immutable file holding every short URL at the time it was
+written, in a compact binary format which is searched in place through
+mmap, so the worker processes of a host share a single copy of it in the
+page cache. When SNAPSHOT_PATH is set, lengthen_url looks keys up in the
+snapshot before the storage, which is then only queried for the keys
+created since the snapshot was written. Snapshots are written by ``flask
+shortcake snapshot``, and picked up by running workers when the file is
+replaced.
+
+Short URLs are never modified once created, and those which expire are
+left out of snapshots, so a snapshot never goes stale; it only lacks the
+newer ones. The layout of a snapshot is, with
+every integer little endian:
+
+* a header: the magic string ``SHORTCK1``, the key width (uint16), two
+  reserved bytes, the number of short URLs n (uint32), and the time at
+  which the snapshot was written (uint64, seconds since the epoch)
+* the n keys, in ascending bytewise order, each padded with NUL bytes to
+  the key width
+* n + 1 offsets (uint64) into the URL blob, the URL of the i-th key
+  spanning from the i-th to the (i+1)-th offset
+* the URL blob, i.e. every URL, UTF-8 encoded, in key order
+'''
+
+import os
+import mmap
+import time
+import shutil
+import struct
+import logging
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SHORTCK1'
+HEADER = struct.Struct('<8sHHIQ')
+OFFSET = struct.Struct('<Q')
+KEY_WIDTH = 10  # the length of the longest valid key
+
+
+class SnapshotFormatError(Exception):
+    '''Raised when a file is not a valid snapshot.'''
+    pass
+
+
+class Snapshot:
+    '''A snapshot file, memory-mapped.
+
+    Args:
+        path (str): The path of the snapshot file
+
+    Raises:
+        SnapshotFormatError: The file is not a valid snapshot
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+            if stat.st_size < HEADER.size:
+                raise SnapshotFormatError('truncated header: ' + path)
+            # the mapping stays valid after the file is closed, or replaced
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_width, _, self.count, self.created = \
+            HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise SnapshotFormatError('not a snapshot: ' + path)
+        self._offsets = HEADER.size + self.count * self.key_width
+        self._blob = self._offsets + (self.count + 1) * OFFSET.size
+        if len(self._mm) < self._blob or \
+                len(self._mm) != self._blob + self._offset(self.count):
+            raise SnapshotFormatError('truncated snapshot: ' + path)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key: str):
+        '''Return the URL of key, or None if key isn't in the snapshot.'''
+        i = self._find(key)
+        if i is None:
+            return None
+        return self._mm[self._blob + self._offset(i):
+                        self._blob + self._offset(i + 1)].decode()
+
+    def _find(self, key):
+        '''Return the index of key, or None, by binary search.'''
+        width = self.key_width
+        needle = key.encode().ljust(width, b'\0')
+        if len(needle) != width:
+            return None
+        mm = self._mm
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = HEADER.size + mid * width
+            probe = mm[start:start + width]
+            if probe < needle:
+                lo = mid + 1
+            elif probe > needle:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _offset(self, i):
+        return OFFSET.unpack_from(self._mm, self._offsets + i * OFFSET.size)[0]
+
+
+class SnapshotReader:
+    '''Looks keys up in the snapshot at a path, if there is one, reopening
+    it when the file is replaced.
+
+    Args:
+        path (str): The path of the snapshot file
+        check_interval (float): The minimum number of seconds between two
+                                checks for a new snapshot file
+        clock (callable): Returns the current time in seconds
+    '''
+
+    def __init__(self, path, check_interval=10, clock=time.monotonic):
+        self.path = path
+        self.check_interval = check_interval
+        self.snapshot = None
+        self._clock = clock
+        self._checked = None
+
+    def get(self, key: str):
+        '''Return the URL of key, or None if key isn't in the snapshot.'''
+        now = self._clock()
+        if self._checked is None or now - self._checked >= self.check_interval:
+            self._checked = now
+            self.reload()
+        snapshot = self.snapshot
+        return snapshot.get(key) if snapshot is not None else None
+
+    def reload(self):
+        '''Open the snapshot file, unless it's the one already open.'''
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.snapshot = None
+            return
+        identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        if self.snapshot is not None and self.snapshot.identity == identity:
+            return
+        try:
+            # the previous snapshot is unmapped once no thread uses it
+            self.snapshot = Snapshot(self.path)
+        except (OSError, SnapshotFormatError):
+            logger.exception('failed to open snapshot %s', self.path)
+            self.snapshot = None
+
+
+def write_snapshot(pairs, path, key_width=KEY_WIDTH, created=None) -> int:
+    '''Write a snapshot of short URLs to a file, and return the number of
+    short URLs written.
+
+    The snapshot is written to a temporary file in the same directory, which
+    then atomically replaces path, so readers never see a partial snapshot.
+    Memory usage does not depend on the number of short URLs.
+
+    Args:
+        pairs (iterable): The (key,url) pairs, in ascending bytewise key
+                          order, e.g. as returned by Storage.scan
+        path (str): The path of the snapshot file
+        key_width (int): The length of the longest key
+        created (int): The time at which the snapshot was taken, in seconds
+                       since the epoch. Defaults to now.
+
+    Raises:
+        ValueError: The keys are not in order, or one is longer than
+                    key_width
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    created = int(time.time()) if created is None else created
+    with tempfile.TemporaryFile(dir=directory) as keys, \
+            tempfile.TemporaryFile(dir=directory) as offsets, \
+            tempfile.TemporaryFile(dir=directory) as blob:
+        count, end, previous = 0, 0, b''
+        offsets.write(OFFSET.pack(0))
+        for key, url in pairs:
+            key_bytes = key.encode().ljust(key_width, b'\0')
+            if len(key_bytes) != key_width:
+                raise ValueError('key longer than {}: {}'.format(key_width, key))
+            if key_bytes <= previous:
+                raise ValueError('keys out of order: {}'.format(key))
+            previous = key_bytes
+            url_bytes = url.encode()
+            keys.write(key_bytes)
+            blob.write(url_bytes)
+            end += len(url_bytes)
+            offsets.write(OFFSET.pack(end))
+            count += 1
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, key_width, 0, count, created))
+                for part in (keys, offsets, blob):
+                    part.seek(0)
+                    shutil.copyfileobj(part, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    return count
+
+
+def init_app(app):
+    '''Create the SnapshotReader of an application, if SNAPSHOT_PATH is set.'''
+    if not app.config['SNAPSHOT_PATH']:
+        app.extensions.pop('snapshot', None)
+        return
+    app.extensions['snapshot'] = SnapshotReader(
+        app.config['SNAPSHOT_PATH'], app.config['SNAPSHOT_CHECK_INTERVAL'])
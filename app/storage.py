@@ -0,0 +1,776 @@
+'''Short URL storage.
+
+Contains the interface through which app.core reads and writes short URLs,
+i.e. (key,url) pairs, and its implementations, one of which is selected
+with the STORAGE_BACKEND configuration option:
+
+* ``'sqlalchemy'``: the ShortURL table of the application's database
+* ``'sqlite'``: an embedded SQLite database in WAL mode, with pragmas tuned
+  for a read-mostly workload, accessed without an ORM
+* ``'memory'``: a dict, private to the process, for tests and benchmarks
+
+Every other table (click statistics, key leases) always lives in the
+application's database.
+
+A short URL may expire, at a naive UTC datetime. Once expired, it is
+treated as missing by every read, but its key stays taken until the row
+is deleted by delete_expired.
+'''
+
+import os
+import heapq
+import sqlite3
+import datetime
+import threading
+
+from sqlalchemy import select, func, or_
+from sqlalchemy.exc import IntegrityError
+
+from app import metrics, replicas
+from app.db import db
+from app.models import ShortURL, url_digest
+
+
+# the maximum number of keys bound into a single "key IN (...)" query. This
+# stays well below SQLite's limit on the number of host parameters.
+IN_QUERY_CHUNK_SIZE = 500
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class KeyConflictError(Exception):
+    '''Raised when inserting a short URL whose key already exists.'''
+    pass
+
+
+class Storage:
+    '''The interface of a store of short URLs.
+
+    Every short URL is a (key,url) pair, which may expire, and keys are
+    unique. Writes are durable (committed) when the method making them
+    returns. Rows, as taken by insert_many and returned by scan, are
+    (key,url,expires_at) triples, where expires_at is None for short URLs
+    which never expire.
+    '''
+
+    def get(self, key: str):
+        '''Return the URL of key, or None if key doesn't exist or expired.'''
+        raise NotImplementedError
+
+    def get_entry(self, key: str):
+        '''Return the (url,expires_at) pair of key, or None if key doesn't
+        exist or expired.'''
+        raise NotImplementedError
+
+    def get_many(self, keys) -> dict:
+        '''Return a dict mapping each of the given keys which exists, and
+        hasn't expired, to its URL.'''
+        raise NotImplementedError
+
+    def get_taken(self, keys) -> dict:
+        '''Return a dict mapping each of the given keys which exists, expired
+        or not, to its URL if it never expires, or else to None. Used to
+        find out which keys are free.'''
+        raise NotImplementedError
+
+    def keys_from(self, start: str, limit: int) -> list:
+        '''Return up to limit of the keys, expired or not, of the same
+        length as start and not lower than it, in ascending bytewise order.
+        Used to find the free keys after start, i.e. the gaps between the
+        returned keys.'''
+        raise NotImplementedError
+
+    def find_key(self, url: str):
+        '''Return a key of url which never expires, or None if there is
+        none.'''
+        raise NotImplementedError
+
+    def find_keys(self, urls) -> dict:
+        '''Return a dict mapping each of the given URLs which has a key
+        which never expires to one of these keys.'''
+        raise NotImplementedError
+
+    def insert_if_absent(self, key: str, url: str, expires_at=None) -> bool:
+        '''Atomically insert a (key,url) pair, expiring at expires_at,
+        unless the key already exists. Return whether the pair was
+        inserted.'''
+        raise NotImplementedError
+
+    def insert_if_absent_many(self, rows) -> list:
+        '''Insert (key,url) pairs or (key,url,expires_at) rows in a single
+        transaction, skipping those whose key already exists, earlier rows
+        included. Return a list of whether each row was inserted.'''
+        raise NotImplementedError
+
+    def insert_many(self, rows, skip_existing=False):
+        '''Insert (key,url) pairs or (key,url,expires_at) rows, all or
+        nothing.
+
+        Raises:
+            KeyConflictError: One of the keys already exists, and
+                              skip_existing is False. Nothing is inserted.
+                              If skip_existing is True, the rows whose key
+                              exists are skipped instead.
+        '''
+        raise NotImplementedError
+
+    def scan(self, batch_size=10000):
+        '''Yield every (key,url,expires_at) row which hasn't expired, in
+        ascending bytewise key order, fetching batch_size rows at a time.'''
+        raise NotImplementedError
+
+    def scan_keys(self, batch_size=10000):
+        '''Yield every key, expired or not, in no particular order, fetching
+        batch_size keys at a time.'''
+        raise NotImplementedError
+
+    def count(self) -> int:
+        '''Return the number of short URLs, expired or not.'''
+        raise NotImplementedError
+
+    def delete_expired(self, now, limit: int) -> list:
+        '''Delete up to limit of the short URLs which expired by now, the
+        earliest first, in a single short transaction, and return their
+        keys.'''
+        raise NotImplementedError
+
+
+class SQLAlchemyStorage(Storage):
+    '''Stores short URLs in the ShortURL table of the application's database,
+    through the session of the current application context. Lookups are
+    made on the read replicas, if any (see app.replicas).
+
+    Args:
+        replicas (replicas.ReplicaSet): The read replicas of the database,
+                                        or None
+    '''
+
+    table = ShortURL.__table__
+
+    def __init__(self, replicas=None):
+        self.replicas = replicas
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        rows = self._lookup([key])
+        return (rows[0].url, rows[0].expires_at) if rows else None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), IN_QUERY_CHUNK_SIZE):
+            found.update((row.key, row.url)
+                         for row in self._lookup(keys[i:i+IN_QUERY_CHUNK_SIZE]))
+        return found
+
+    def get_taken(self, keys):
+        keys = list(keys)
+        taken = {}
+        for i in range(0, len(keys), IN_QUERY_CHUNK_SIZE):
+            chunk = keys[i:i+IN_QUERY_CHUNK_SIZE]
+            taken.update(
+                (key, url if expires_at is None else None)
+                for key, url, expires_at in db.session.execute(
+                    select(self.table.c.key, self.table.c.url, self.table.c.expires_at)
+                    .where(self.table.c.key.in_(chunk))))
+        return taken
+
+    def keys_from(self, start, limit):
+        # a range scan of the primary key index, whose collation is bytewise
+        # (see ShortURL.key)
+        key = self.table.c.key
+        return db.session.execute(
+            select(self.table.c.key)
+            .where(key >= start)
+            .where(func.length(self.table.c.key) == len(start))
+            .order_by(key)
+            .limit(limit)).scalars().all()
+
+    def find_key(self, url):
+        # the index on the digest narrows the search down to the handful of
+        # rows whose URL has the same digest
+        return db.session.execute(
+            select(self.table.c.key)
+            .where(self.table.c.url_digest == url_digest(url))
+            .where(self.table.c.url == url)
+            .where(self.table.c.expires_at.is_(None))
+            .limit(1)).scalar()
+
+    def find_keys(self, urls):
+        digests = {url_digest(url): url for url in urls}
+        digest_list = list(digests)
+        found = {}
+        for i in range(0, len(digest_list), IN_QUERY_CHUNK_SIZE):
+            chunk = digest_list[i:i+IN_QUERY_CHUNK_SIZE]
+            rows = db.session.execute(
+                select(self.table.c.key, self.table.c.url, self.table.c.url_digest)
+                .where(self.table.c.url_digest.in_(chunk))
+                .where(self.table.c.expires_at.is_(None)))
+            for key, url, digest in rows:
+                if digests[digest] == url:
+                    found.setdefault(url, key)
+        return found
+
+    def insert_if_absent(self, key, url, expires_at=None):
+        # On PostgreSQL and SQLite this is a single INSERT ... ON CONFLICT DO
+        # NOTHING statement, so concurrent processes can never both claim the
+        # same key. Other databases fall back to a plain INSERT, whose
+        # primary key violation is caught.
+        values = {'key': key, 'url': url, 'expires_at': expires_at}
+        stmt = _insert_ignoring_conflicts(self.table)
+        if stmt is None:
+            try:
+                db.session.execute(self.table.insert().values(**values))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return False
+            self._wrote([key])
+            return True
+        inserted = db.session.execute(stmt.values(**values)).rowcount == 1
+        db.session.commit()
+        if inserted:
+            self._wrote([key])
+        return inserted
+
+    def insert_if_absent_many(self, rows):
+        # one statement per row, since the rowcount of an executemany doesn't
+        # tell which rows were inserted; without ON CONFLICT, each row gets a
+        # savepoint of its own so a violation only undoes that row
+        rows = list(rows)
+        stmt = _insert_ignoring_conflicts(self.table)
+        inserted = []
+        try:
+            for row in rows:
+                values = _row_dict(row)
+                if stmt is not None:
+                    inserted.append(
+                        db.session.execute(stmt.values(**values)).rowcount == 1)
+                    continue
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(self.table.insert().values(**values))
+                    inserted.append(True)
+                except IntegrityError:
+                    inserted.append(False)
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            raise
+        self._wrote(row[0] for row, was_inserted in zip(rows, inserted)
+                    if was_inserted)
+        return inserted
+
+    def insert_many(self, rows, skip_existing=False):
+        rows = [_row_dict(row) for row in rows]
+        if not rows:
+            return
+        stmt = None
+        if skip_existing:
+            stmt = _insert_ignoring_conflicts(self.table)
+            if stmt is None:
+                # no ON CONFLICT clause; leave out the rows whose key exists,
+                # or repeats that of an earlier row, beforehand
+                rows = self._absent_rows(rows)
+                if not rows:
+                    return
+        if stmt is None:
+            stmt = self.table.insert()
+        try:
+            db.session.execute(stmt, rows)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise KeyConflictError
+        self._wrote(row['key'] for row in rows)
+
+    def _absent_rows(self, rows):
+        '''Return the rows whose key neither exists nor is that of an
+        earlier row.'''
+        keys = list({row['key'] for row in rows})
+        seen = set()
+        for i in range(0, len(keys), IN_QUERY_CHUNK_SIZE):
+            chunk = keys[i:i+IN_QUERY_CHUNK_SIZE]
+            seen.update(db.session.execute(
+                select(self.table.c.key).where(self.table.c.key.in_(chunk)))
+                .scalars())
+        absent = []
+        for row in rows:
+            if row['key'] not in seen:
+                seen.add(row['key'])
+                absent.append(row)
+        return absent
+
+    def scan(self, batch_size=10000):
+        query = db.session.query(ShortURL.key, ShortURL.url, ShortURL.expires_at) \
+            .filter(self._live()) \
+            .order_by(ShortURL.key) \
+            .execution_options(stream_results=True) \
+            .yield_per(batch_size)
+        for key, url, expires_at in query:
+            yield key, url, expires_at
+
+    def scan_keys(self, batch_size=10000):
+        query = db.session.query(ShortURL.key) \
+            .execution_options(stream_results=True) \
+            .yield_per(batch_size)
+        for key, in query:
+            yield key
+
+    def count(self):
+        return db.session.execute(
+            select(func.count()).select_from(self.table)).scalar()
+
+    def delete_expired(self, now, limit):
+        # the index on expires_at turns both statements into range scans, and
+        # the delete only locks the rows it deletes
+        keys = db.session.execute(
+            select(self.table.c.key)
+            .where(self.table.c.expires_at <= now)
+            .order_by(self.table.c.expires_at)
+            .limit(limit)).scalars().all()
+        if keys:
+            db.session.execute(
+                self.table.delete()
+                .where(self.table.c.key.in_(keys))
+                .where(self.table.c.expires_at <= now))
+        db.session.commit()
+        return keys
+
+    def _lookup(self, keys):
+        '''Return the (key,url,expires_at) rows of the live short URLs among
+        at most IN_QUERY_CHUNK_SIZE keys.
+
+        They are read from a replica, unless there are none, none of them is
+        healthy, or one of the keys was written by this process within the
+        read-your-writes window. Keys missing from the replica are looked up
+        again on the primary, as they may not have been replicated yet,
+        unless the replicas are configured not to.
+        '''
+        def query(keys):
+            key = self.table.c.key
+            return (select(key, self.table.c.url, self.table.c.expires_at)
+                    .where(key == keys[0] if len(keys) == 1 else key.in_(keys))
+                    .where(self._live()))
+        if self.replicas is not None and keys and \
+                not self.replicas.written_recently(keys):
+            rows = self.replicas.execute(query(keys))
+            if rows is not None:
+                metrics.inc('shortcake_replica_reads_total', target='replica')
+                found = {row.key for row in rows}
+                missing = [key for key in keys if key not in found]
+                if missing and self.replicas.recheck_misses:
+                    metrics.inc('shortcake_replica_reads_total',
+                                target='primary_recheck')
+                    rows += db.session.execute(query(missing)).all()
+                return rows
+        if self.replicas is not None:
+            metrics.inc('shortcake_replica_reads_total', target='primary')
+        return db.session.execute(query(keys)).all()
+
+    def _wrote(self, keys):
+        if self.replicas is not None:
+            self.replicas.wrote(keys)
+
+    def _live(self):
+        '''Return the condition of the rows which haven't expired.'''
+        return or_(self.table.c.expires_at.is_(None),
+                   self.table.c.expires_at > datetime.datetime.utcnow())
+
+
+class MemoryStorage(Storage):
+    '''Stores short URLs in a dict. The short URLs are private to the
+    process, and lost when it exits.'''
+
+    def __init__(self):
+        self._urls = {}
+        self._keys = {}
+        self._expiry = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        url = self._urls.get(key)
+        if url is None:
+            return None
+        expires_at = self._expiry.get(key)
+        if expires_at is not None and expires_at <= datetime.datetime.utcnow():
+            return None
+        return url, expires_at
+
+    def get_many(self, keys):
+        urls = self._urls
+        if not self._expiry:
+            return {key: urls[key] for key in keys if key in urls}
+        found = {}
+        for key in keys:
+            url = self.get(key)
+            if url is not None:
+                found[key] = url
+        return found
+
+    def get_taken(self, keys):
+        urls, expiry = self._urls, self._expiry
+        return {key: urls[key] if key not in expiry else None
+                for key in keys if key in urls}
+
+    def keys_from(self, start, limit):
+        with self._lock:
+            keys = [key for key in self._urls
+                    if len(key) == len(start) and key >= start]
+        return heapq.nsmallest(limit, keys)
+
+    def find_key(self, url):
+        return self._keys.get(url)
+
+    def find_keys(self, urls):
+        keys = self._keys
+        return {url: keys[url] for url in urls if url in keys}
+
+    def insert_if_absent(self, key, url, expires_at=None):
+        with self._lock:
+            if key in self._urls:
+                return False
+            self._insert(key, url, expires_at)
+            return True
+
+    def insert_if_absent_many(self, rows):
+        inserted = []
+        with self._lock:
+            for key, url, expires_at in map(_row_tuple, rows):
+                inserted.append(key not in self._urls)
+                if inserted[-1]:
+                    self._insert(key, url, expires_at)
+        return inserted
+
+    def insert_many(self, rows, skip_existing=False):
+        rows = [_row_tuple(row) for row in rows]
+        with self._lock:
+            if not skip_existing and (
+                    len({key for key, _, _ in rows}) < len(rows) or
+                    any(key in self._urls for key, _, _ in rows)):
+                raise KeyConflictError
+            for key, url, expires_at in rows:
+                if key not in self._urls:
+                    self._insert(key, url, expires_at)
+
+    def _insert(self, key, url, expires_at):
+        self._urls[key] = url
+        if expires_at is None:
+            self._keys.setdefault(url, key)
+        else:
+            self._expiry[key] = expires_at
+
+    def scan(self, batch_size=10000):
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            rows = sorted((key, url, self._expiry.get(key))
+                          for key, url in self._urls.items())
+        return iter([row for row in rows if row[2] is None or row[2] > now])
+
+    def scan_keys(self, batch_size=10000):
+        with self._lock:
+            keys = list(self._urls)
+        return iter(keys)
+
+    def count(self):
+        return len(self._urls)
+
+    def delete_expired(self, now, limit):
+        with self._lock:
+            expired = sorted((expires_at, key) for key, expires_at
+                             in self._expiry.items() if expires_at <= now)
+            keys = [key for _, key in expired[:limit]]
+            for key in keys:
+                del self._urls[key]
+                del self._expiry[key]
+        return keys
+
+
+class SQLiteStorage(Storage):
+    '''Stores short URLs in an embedded SQLite database, through the sqlite3
+    module, bypassing SQLAlchemy altogether.
+
+    The database is put in WAL mode, so that readers never block, nor are
+    blocked by, the writer, and can be shared by the worker processes of a
+    single host. Each thread has its own connection, with commits synced to
+    disk only at checkpoints (synchronous=NORMAL), which may lose the last
+    transactions on power loss but never corrupts the database, and with
+    the database memory-mapped. Expiry times are stored as seconds since
+    the epoch.
+
+    Args:
+        path (str): The path of the database file, created if needed
+        mmap_size (int): The number of bytes of the database which are
+                         memory-mapped
+        cache_size (int): The size of the page cache of each connection, in
+                          KiB
+    '''
+
+    def __init__(self, path, mmap_size=256 * 2 ** 20, cache_size=16 * 2 ** 10):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            # forked; the connections belong to the parent process
+            self._reset()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # transactions are managed explicitly
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA temp_store = MEMORY')
+            conn.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+            conn.execute('PRAGMA cache_size = {:d}'.format(-self.cache_size))
+            conn.execute('CREATE TABLE IF NOT EXISTS shorturl ('
+                         'key TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                         'url_digest TEXT NOT NULL, expires_at REAL) '
+                         'WITHOUT ROWID')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(shorturl)')]
+            if 'expires_at' not in columns:
+                # created before short URLs could expire
+                conn.execute('ALTER TABLE shorturl ADD COLUMN expires_at REAL')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_shorturl_url_digest '
+                         'ON shorturl (url_digest)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_shorturl_expires_at '
+                         'ON shorturl (expires_at)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        row = self._connection().execute(
+            'SELECT url, expires_at FROM shorturl WHERE key = ? '
+            'AND (expires_at IS NULL OR expires_at > ?)',
+            (key, _now_seconds())).fetchone()
+        if row is None:
+            return None
+        return row[0], _from_seconds(row[1])
+
+    def get_many(self, keys):
+        keys = list(keys)
+        conn = self._connection()
+        now = _now_seconds()
+        found = {}
+        for i in range(0, len(keys), IN_QUERY_CHUNK_SIZE):
+            chunk = keys[i:i+IN_QUERY_CHUNK_SIZE]
+            found.update(conn.execute(
+                'SELECT key, url FROM shorturl WHERE key IN ({}) '
+                'AND (expires_at IS NULL OR expires_at > ?)'.format(
+                    ','.join('?' * len(chunk))), chunk + [now]))
+        return found
+
+    def get_taken(self, keys):
+        keys = list(keys)
+        conn = self._connection()
+        taken = {}
+        for i in range(0, len(keys), IN_QUERY_CHUNK_SIZE):
+            chunk = keys[i:i+IN_QUERY_CHUNK_SIZE]
+            taken.update(conn.execute(
+                'SELECT key, CASE WHEN expires_at IS NULL THEN url END '
+                'FROM shorturl WHERE key IN ({})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        return taken
+
+    def keys_from(self, start, limit):
+        return [key for key, in self._connection().execute(
+            'SELECT key FROM shorturl WHERE key >= ? AND length(key) = ? '
+            'ORDER BY key LIMIT ?', (start, len(start), limit))]
+
+    def find_key(self, url):
+        row = self._connection().execute(
+            'SELECT key FROM shorturl WHERE url_digest = ? AND url = ? '
+            'AND expires_at IS NULL LIMIT 1',
+            (url_digest(url), url)).fetchone()
+        return row[0] if row else None
+
+    def find_keys(self, urls):
+        digests = {url_digest(url): url for url in urls}
+        digest_list = list(digests)
+        conn = self._connection()
+        found = {}
+        for i in range(0, len(digest_list), IN_QUERY_CHUNK_SIZE):
+            chunk = digest_list[i:i+IN_QUERY_CHUNK_SIZE]
+            rows = conn.execute(
+                'SELECT key, url, url_digest FROM shorturl '
+                'WHERE url_digest IN ({}) AND expires_at IS NULL'.format(
+                    ','.join('?' * len(chunk))),
+                chunk)
+            for key, url, digest in rows:
+                if digests[digest] == url:
+                    found.setdefault(url, key)
+        return found
+
+    def insert_if_absent(self, key, url, expires_at=None):
+        return self._connection().execute(
+            'INSERT OR IGNORE INTO shorturl (key, url, url_digest, expires_at) '
+            'VALUES (?, ?, ?, ?)',
+            (key, url, url_digest(url), _to_seconds(expires_at))).rowcount == 1
+
+    def insert_if_absent_many(self, rows):
+        conn = self._connection()
+        inserted = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for key, url, expires_at in map(_row_tuple, rows):
+                inserted.append(conn.execute(
+                    'INSERT OR IGNORE INTO shorturl '
+                    '(key, url, url_digest, expires_at) VALUES (?, ?, ?, ?)',
+                    (key, url, url_digest(url),
+                     _to_seconds(expires_at))).rowcount == 1)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return inserted
+
+    def insert_many(self, rows, skip_existing=False):
+        conn = self._connection()
+        stmt = 'INSERT OR IGNORE' if skip_existing else 'INSERT'
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                stmt + ' INTO shorturl (key, url, url_digest, expires_at) '
+                'VALUES (?, ?, ?, ?)',
+                ((key, url, url_digest(url), _to_seconds(expires_at))
+                 for key, url, expires_at in map(_row_tuple, rows)))
+        except sqlite3.IntegrityError:
+            conn.execute('ROLLBACK')
+            raise KeyConflictError
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def scan(self, batch_size=10000):
+        # a separate cursor, so that the scan can be interleaved with other
+        # queries on this thread's connection
+        cursor = self._connection().execute(
+            'SELECT key, url, expires_at FROM shorturl '
+            'WHERE expires_at IS NULL OR expires_at > ? ORDER BY key',
+            (_now_seconds(),))
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for key, url, expires_at in rows:
+                    yield key, url, _from_seconds(expires_at)
+        finally:
+            cursor.close()
+
+    def scan_keys(self, batch_size=10000):
+        cursor = self._connection().execute('SELECT key FROM shorturl')
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for key, in rows:
+                    yield key
+        finally:
+            cursor.close()
+
+    def count(self):
+        return self._connection().execute(
+            'SELECT count(*) FROM shorturl').fetchone()[0]
+
+    def delete_expired(self, now, limit):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            keys = [key for key, in conn.execute(
+                'SELECT key FROM shorturl WHERE expires_at <= ? '
+                'ORDER BY expires_at LIMIT ?', (_to_seconds(now), limit))]
+            conn.executemany('DELETE FROM shorturl WHERE key = ?',
+                             ((key,) for key in keys))
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return keys
+
+
+def init_app(app):
+    '''Create the Storage of an application, as configured.'''
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'sqlalchemy':
+        replicas.init_app(app)
+        storage = SQLAlchemyStorage(app.extensions.get('read_replicas'))
+    elif backend == 'memory':
+        storage = MemoryStorage()
+    elif backend == 'sqlite':
+        storage = SQLiteStorage(
+            app.config['STORAGE_SQLITE_PATH'],
+            app.config['STORAGE_SQLITE_MMAP_SIZE'])
+    else:
+        raise ValueError('unknown storage backend: ' + backend)
+    app.extensions['storage'] = storage
+
+
+def _row_tuple(row) -> tuple:
+    '''Return a (key,url) pair or (key,url,expires_at) row as a row.'''
+    return tuple(row) if len(row) == 3 else (row[0], row[1], None)
+
+
+def _row_dict(row) -> dict:
+    key, url, expires_at = _row_tuple(row)
+    return {'key': key, 'url': url, 'expires_at': expires_at}
+
+
+def _to_seconds(dt):
+    '''Return a naive UTC datetime, or None, as seconds since the epoch.'''
+    return (dt - _EPOCH).total_seconds() if dt is not None else None
+
+
+def _from_seconds(seconds):
+    '''Return seconds since the epoch, or None, as a naive UTC datetime.'''
+    return _EPOCH + datetime.timedelta(seconds=seconds) if seconds is not None else None
+
+
+def _now_seconds():
+    return _to_seconds(datetime.datetime.utcnow())
+
+
+def _insert_ignoring_conflicts(table, dialect=None):
+    '''Return an INSERT statement into table which silently skips rows
+    whose primary key already exists, or None if the database doesn't
+    support one. dialect is the name of the database's dialect, which
+    defaults to that of the current application's database.'''
+    insert = _dialect_insert(dialect)
+    if insert is None:
+        return None
+    return insert(table).on_conflict_do_nothing(
+        index_elements=[c.name for c in table.primary_key])
+
+
+def _dialect_insert(dialect=None):
+    '''Return the insert construct of a dialect (by default, the current
+    database's), which supports ON CONFLICT clauses, or None if there is no
+    such construct.'''
+    if dialect is None:
+        dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
@@ -1,6 +1,7 @@
 from flask import request, render_template, redirect, flash, current_app
 from markupsafe import Markup
-from app import core
+from app import core, clicks, httpcache
+from app.redirect import redirect_location
 
 
 def register(bp):
@@ -25,12 +26,17 @@ def register(bp):
     @bp.route('/<string:key>', methods=['GET'])
     def short_url_redirect(key):
         try:
-            expanded_url = core.lengthen_url(key)
+            expanded_url, expires_at = core.lengthen_entry(key)
             if not expanded_url:
-                return render_template('404.html'), 404
-            # TODO this is just a temporary hack for domain-only URLs
-            if not expanded_url.startswith('http'):
-                expanded_url = 'http://' + expanded_url
-            return redirect(expanded_url)
+                return not_found()
+            clicks.record(current_app, key)
+            response = redirect(redirect_location(expanded_url),
+                                current_app.config['REDIRECT_STATUS'])
+            response.headers.extend(httpcache.redirect_headers(expires_at))
+            return response
         except core.InvalidShortKeyError:
-            return render_template('404.html'), 404
+            return not_found()
+
+
+def not_found():
+    return render_template('404.html'), 404, httpcache.negative_headers()
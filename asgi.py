@@ -0,0 +1,16 @@
+'''The ASGI entry point.
+
+Serves the API and short URL redirects (see app.asgi) with the production
+configuration, from an asyncio event loop, e.g.::
+
+    $ gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+The web interface is only served by the WSGI entry point, wsgi.
+'''
+
+from config import ProductionConfig
+from app import create_app
+from app.asgi import create_asgi_app
+
+
+app = create_asgi_app(create_app(ProductionConfig))
@@ -0,0 +1,31 @@
+'''Micro-benchmark of the derivation of candidate keys from a URL digest.
+
+Not collected by the regular test run. Run from the project root with::
+
+    $ pytest -s benchmarks/bench_key_derivation.py
+'''
+
+import timeit
+import random
+
+from app import core
+
+
+N_DIGESTS = 2000
+REPEAT = 5
+
+
+def _best_time(derive, digests):
+    '''Return the best time, in microseconds, of one call to derive.'''
+    timer = timeit.Timer(lambda: [derive(d) for d in digests])
+    return min(timer.repeat(REPEAT, number=1)) / len(digests) * 1e6
+
+
+def test_key_derivation_speed():
+    rng = random.Random(0)
+    digests = ['{:040x}'.format(rng.getrandbits(160)) for _ in range(N_DIGESTS)]
+    base62 = _best_time(core._key_from_hex, digests)
+    legacy = _best_time(core._legacy_key_from_hex, digests)
+    print('\nbase62: {:.2f} us/key, legacy: {:.2f} us/key ({:.1f}x)'.format(
+        base62, legacy, legacy / base62))
+    assert base62 < legacy
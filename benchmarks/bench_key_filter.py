@@ -0,0 +1,39 @@
+'''Micro-benchmark of the Bloom filter of existing keys.
+
+Reports the memory used per million keys, the measured false positive rate
+and the cost of building and querying the filter. Not collected by the
+regular test run. Run from the project root with::
+
+    $ pytest -s benchmarks/bench_key_filter.py
+'''
+
+import time
+import random
+
+from app import core
+from app.keyfilter import BloomFilter
+
+
+N_KEYS = 1000000
+N_PROBES = 200000
+
+
+def test_key_filter():
+    rng = random.Random(0)
+    keys = [core._int_to_key(rng.randrange(62 ** 7), 7) for _ in range(N_KEYS)]
+    probes = [core._int_to_key(rng.randrange(62 ** 7), 7) for _ in range(N_PROBES)]
+    for error_rate in (0.01, 0.001):
+        bloom = BloomFilter(N_KEYS, error_rate)
+        start = time.perf_counter()
+        bloom.update(keys)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        false_positives = sum(key in bloom for key in probes)
+        lookup = (time.perf_counter() - start) / N_PROBES
+        rate = false_positives / N_PROBES
+        print('\nerror rate {}: {:.2f} MB per million keys, {} hashes, '
+              'measured false positive rate {:.4f}, built in {:.1f}s, '
+              '{:.2f} us/lookup'.format(
+                  error_rate, bloom.nbytes / N_KEYS, bloom.nhashes, rate,
+                  build, lookup * 1e6))
+        assert rate < error_rate * 1.5
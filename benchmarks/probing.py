@@ -0,0 +1,98 @@
+'''Benchmark of the database round trips made per shorten_url call.
+
+The keyspace is far too large for collisions to happen naturally at any
+realistic table size, so the table "filling up" is simulated by claiming
+each candidate key window of the URLs being shortened with probability
+``--occupancy``. The set-based probing of core.shorten_url is compared
+with the original strategy of one lookup (and possibly a commit) per
+candidate window. Run from the project root::
+
+    $ python -m benchmarks.probing --rows 10000 --urls 500
+'''
+
+import json
+import random
+import argparse
+
+import sqlalchemy
+
+from config import TestingConfig
+from app import create_app, core
+from app.db import db
+from app.models import ShortURL, url_digest
+
+
+def legacy_shorten_url(url):
+    '''The probing strategy of shorten_url prior to set-based lookups.'''
+    url = core._validate_url(url)
+    for key in core._candidate_keys(url_digest(url)):
+        existing_entry = ShortURL.query.get(key)
+        if existing_entry:
+            if existing_entry.url == url:
+                return key
+            continue
+        db.session.add(ShortURL(key=key, url=url))
+        db.session.commit()
+        return key
+    raise core.OutOfShortKeysError
+
+
+def run(rows, n_urls, occupancies, seed):
+    app = create_app(TestingConfig)
+    results = []
+    with app.app_context():
+        round_trips = [0]
+        def count(*args):
+            round_trips[0] += 1
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+        sqlalchemy.event.listen(db.engine, 'commit', count)
+        for occupancy in occupancies:
+            for name, shorten in (('legacy', legacy_shorten_url),
+                                  ('set-based', core.shorten_url)):
+                rng = random.Random(seed)
+                db.drop_all()
+                db.create_all()
+                app.extensions['lengthen_cache'].clear()
+                filler = [{'key': '{:07d}'.format(i), 'url': 'http://fill.com/'}
+                          for i in range(rows)]
+                urls = ['http://www.example.com/{}/{}'.format(seed, i)
+                        for i in range(n_urls)]
+                for url in urls:
+                    for key in core._candidate_keys(url_digest(url)):
+                        if rng.random() < occupancy:
+                            filler.append({'key': key, 'url': 'http://taken.com/'})
+                db.session.execute(ShortURL.__table__.insert().prefix_with('OR IGNORE'),
+                                   filler)
+                db.session.commit()
+                round_trips[0] = 0
+                for url in urls:
+                    try:
+                        shorten(url)
+                    except core.OutOfShortKeysError:
+                        pass
+                results.append({
+                    'strategy': name,
+                    'table_rows': ShortURL.query.count(),
+                    'window_occupancy': occupancy,
+                    'round_trips_per_shorten': round_trips[0] / n_urls,
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='unrelated rows to seed the table with')
+    parser.add_argument('--urls', type=int, default=500,
+                        help='number of URLs to shorten per run')
+    parser.add_argument('--occupancy', type=float, nargs='+',
+                        default=[0.0, 0.25, 0.5, 0.75, 0.9],
+                        help='probability that a candidate window is taken')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for result in run(args.rows, args.urls, args.occupancy, args.seed):
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
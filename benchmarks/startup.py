@@ -0,0 +1,89 @@
+'''Measures the cold start time of a worker process.
+
+Each entry point is imported in a fresh interpreter, several times, and the
+median time from interpreter start to the application being ready to
+serve is reported. The time taken by a preloaded worker, i.e. one forked
+from a process which already imported the entry point, is reported too.
+Run from the project root, e.g.::
+
+    $ pipenv run python -m benchmarks.startup --runs 10
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+# the entry points, and the environment they are imported with
+ENTRY_POINTS = {
+    'main': ('main', {}),
+    'wsgi': ('wsgi', {}),
+    'wsgi (api only)': ('wsgi', {'WEB_UI': '0'}),
+}
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+sys.stdout.write(repr(time.perf_counter() - start))
+'''
+
+FORK_SCRIPT = '''
+import os, sys, time
+import {module}
+from app.db import dispose_engine
+times = []
+for _ in range({runs}):
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        # what gunicorn's post_fork hook does, before serving requests
+        dispose_engine({module}.app)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    times.append(time.perf_counter() - start)
+sys.stdout.write(repr(sorted(times)[len(times) // 2]))
+'''
+
+
+def run_python(script, env):
+    '''Run a python script in a fresh interpreter, and return its output.'''
+    return subprocess.run(
+        [sys.executable, '-c', script], env=env, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        base_env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1',
+                        DATABASE_URL='sqlite:///' + os.path.join(tmpdir, 'app.db'))
+        # warm up the filesystem cache, and the bytecode cache
+        run_python(IMPORT_SCRIPT.format(module='main'), base_env)
+        for name, (module, env) in ENTRY_POINTS.items():
+            env = dict(base_env, **env)
+            walls, imports = [], []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                imports.append(float(run_python(
+                    IMPORT_SCRIPT.format(module=module), env)))
+                walls.append(time.perf_counter() - start)
+            print('{:<16} cold start {:6.0f} ms (import {:4.0f} ms)'.format(
+                name, statistics.median(walls) * 1e3,
+                statistics.median(imports) * 1e3))
+            if module == 'wsgi':
+                fork = float(run_python(
+                    FORK_SCRIPT.format(module=module, runs=args.runs), env))
+                print('{:<16} preloaded  {:6.1f} ms'.format(name, fork * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+'''Reproducible benchmark suite of the shorten, lengthen and redirect paths.
+
+Every scenario is run against every requested database backend and table
+size, and reports its throughput and latency percentiles as JSON, so that
+the results of two runs can be compared. Scenarios either call app.core
+directly, or drive the whole application through the Flask test client.
+Run from the project root, e.g.::
+
+    $ scripts/run-benchmarks --sizes 10k 100k --output before.json
+
+The PostgreSQL backend is only run when a database URL is given with
+--postgres-url (or the BENCHMARK_POSTGRES_URL environment variable). All
+tables of that database are dropped, so never point it at a database
+holding data you care about. The storage-memory and storage-sqlite
+backends store short URLs with the 'memory' and 'sqlite' STORAGE_BACKEND
+respectively, rather than through SQLAlchemy.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import werkzeug.test
+
+from config import TestingConfig
+from app import create_app, core, clicks, snapshot
+from app.db import db
+from app.models import ShortURL
+from app.redirect import RedirectFastPath
+
+
+SCENARIOS = {}
+
+# the size of the chunks the table is seeded in
+SEED_CHUNK_SIZE = 50000
+# the number of concurrent shortens of the core.shorten_url.burst scenarios
+BURST_SIZE = 16
+# an odd multiplier which isn't a multiple of 31, so that multiplying by it
+# is a bijection of the 62**7 key space, scattering the seeded keys
+SEED_KEY_MULTIPLIER = 2654435761
+
+
+def scenario(name):
+    '''Register a scenario under name.
+
+    A scenario is a function taking a Context, which returns the operation
+    to benchmark, as a function of no arguments, or None if it can't be run
+    against the backend. The scenario may change the configuration of the
+    application; it is restored afterwards.
+    '''
+    def decorator(f):
+        SCENARIOS[name] = f
+        return f
+    return decorator
+
+
+class Context:
+    '''The state shared by the scenarios run against one table size.'''
+
+    def __init__(self, app, size, seed, tmpdir):
+        self.app = app
+        self.tmpdir = tmpdir
+        self.client = app.test_client()
+        self.size = size
+        self.rng = random.Random(seed)
+        self.executor = None
+        self._url_counter = 0
+
+    def existing_key(self):
+        '''Return the key of a random seeded row.'''
+        return seed_key(self.rng.randrange(self.size))
+
+    def missing_key(self):
+        '''Return a valid key which isn't in the table.'''
+        # seeded keys are all 7 characters long
+        return core._int_to_key(self.rng.randrange(62 ** 8), 8)
+
+    def new_url(self):
+        '''Return a URL which hasn't been shortened yet.'''
+        self._url_counter += 1
+        return 'http://www.example.com/new/{}/{}'.format(
+            self.rng.getrandbits(64), self._url_counter)
+
+
+def seed_key(i):
+    '''Return the key of the i-th seeded row.'''
+    return core._int_to_key(i * SEED_KEY_MULTIPLIER % 62 ** 7, 7)
+
+
+def seed_url(i):
+    '''Return the URL of the i-th seeded row.'''
+    return 'https://www.example.com/seed/{}?utm_source=benchmark'.format(i)
+
+
+def seed(app, start, end):
+    '''Insert the seeded rows with indexes in [start, end).'''
+    store = app.extensions['storage']
+    for i in range(start, end, SEED_CHUNK_SIZE):
+        store.insert_many([(seed_key(j), seed_url(j))
+                           for j in range(i, min(end, i + SEED_CHUNK_SIZE))])
+
+
+@scenario('core.shorten_url')
+def core_shorten_url(ctx):
+    return lambda: core.shorten_url(ctx.new_url())
+
+
+@scenario('core.shorten_url.known')
+def core_shorten_url_known(ctx):
+    return lambda: core.shorten_url(seed_url(ctx.rng.randrange(ctx.size)))
+
+
+@scenario('core.shorten_url.filtered')
+def core_shorten_url_filtered(ctx):
+    ctx.app.config['KEY_FILTER'] = True
+    core.init_app(ctx.app)
+    return lambda: core.shorten_url(ctx.new_url())
+
+
+# The burst scenarios shorten BURST_SIZE new URLs at once, from as many
+# threads, as a threaded worker process serving a burst of shortens would;
+# each operation is a whole burst. They can't be run against an in-memory
+# SQLite database, which is a separate database for every thread.
+
+@scenario('core.shorten_url.burst')
+def core_shorten_url_burst(ctx):
+    return shorten_burst(ctx)
+
+
+@scenario('core.shorten_url.burst.group_commit')
+def core_shorten_url_burst_group_commit(ctx):
+    ctx.app.config['GROUP_COMMIT'] = True
+    ctx.app.config['GROUP_COMMIT_MAX_ROWS'] = BURST_SIZE
+    core.init_app(ctx.app)
+    return shorten_burst(ctx)
+
+
+def shorten_burst(ctx):
+    if ctx.app.config['STORAGE_BACKEND'] == 'sqlalchemy' and \
+            db.engine.url.database in (None, '', ':memory:'):
+        return None
+    ctx.executor = ThreadPoolExecutor(BURST_SIZE)
+
+    def shorten(url):
+        with ctx.app.app_context():
+            return core.shorten_url(url)
+
+    def burst():
+        urls = [ctx.new_url() for _ in range(BURST_SIZE)]
+        return list(ctx.executor.map(shorten, urls))
+    return burst
+
+
+@scenario('core.lengthen_url.hit')
+def core_lengthen_url_hit(ctx):
+    # uniformly random keys; at large table sizes most lookups miss the cache
+    return lambda: core.lengthen_url(ctx.existing_key())
+
+
+@scenario('core.lengthen_url.uncached')
+def core_lengthen_url_uncached(ctx):
+    ctx.app.config['LENGTHEN_CACHE_SIZE'] = 0
+    core.init_app(ctx.app)
+    return lambda: core.lengthen_url(ctx.existing_key())
+
+
+@scenario('core.lengthen_url.hot')
+def core_lengthen_url_hot(ctx):
+    hot = [ctx.existing_key() for _ in range(100)]
+    return lambda: core.lengthen_url(ctx.rng.choice(hot))
+
+
+@scenario('core.lengthen_url.miss')
+def core_lengthen_url_miss(ctx):
+    return lambda: core.lengthen_url(ctx.missing_key())
+
+
+@scenario('core.lengthen_url.snapshot')
+def core_lengthen_url_snapshot(ctx):
+    # uncached, so that every lookup is served by the snapshot
+    path = os.path.join(ctx.tmpdir, 'shorturls.snapshot')
+    snapshot.write_snapshot(
+        ((key, url) for key, url, _ in ctx.app.extensions['storage'].scan()), path)
+    ctx.app.config['LENGTHEN_CACHE_SIZE'] = 0
+    ctx.app.config['SNAPSHOT_PATH'] = path
+    core.init_app(ctx.app)
+    return lambda: core.lengthen_url(ctx.existing_key())
+
+
+@scenario('http.shorten')
+def http_shorten(ctx):
+    return lambda: ctx.client.post('/api/v1/shorten', json={'url': ctx.new_url()})
+
+
+@scenario('http.lengthen')
+def http_lengthen(ctx):
+    return lambda: ctx.client.get('/api/v1/lengthen/' + ctx.existing_key())
+
+
+@scenario('http.redirect')
+def http_redirect(ctx):
+    return lambda: ctx.client.get('/' + ctx.existing_key())
+
+
+@scenario('http.redirect.miss')
+def http_redirect_miss(ctx):
+    return lambda: ctx.client.get('/' + ctx.missing_key())
+
+
+# The wsgi.* scenarios call the WSGI application directly, without the
+# overhead of the test client, to compare the redirect fast path with
+# flask's request dispatching.
+
+@scenario('wsgi.redirect')
+def wsgi_redirect(ctx):
+    return lambda: call_wsgi(ctx.app.wsgi_app, '/' + ctx.existing_key())
+
+
+@scenario('wsgi.redirect.untracked')
+def wsgi_redirect_untracked(ctx):
+    ctx.app.config['CLICK_TRACKING'] = False
+    clicks.init_app(ctx.app)
+    return lambda: call_wsgi(ctx.app.wsgi_app, '/' + ctx.existing_key())
+
+
+@scenario('wsgi.redirect.miss')
+def wsgi_redirect_miss(ctx):
+    return lambda: call_wsgi(ctx.app.wsgi_app, '/' + ctx.missing_key())
+
+
+@scenario('wsgi.redirect.flask')
+def wsgi_redirect_flask(ctx):
+    wsgi_app = flask_wsgi_app(ctx.app)
+    return lambda: call_wsgi(wsgi_app, '/' + ctx.existing_key())
+
+
+@scenario('wsgi.redirect.miss.flask')
+def wsgi_redirect_miss_flask(ctx):
+    wsgi_app = flask_wsgi_app(ctx.app)
+    return lambda: call_wsgi(wsgi_app, '/' + ctx.missing_key())
+
+
+def flask_wsgi_app(app):
+    '''Return the WSGI application of app, minus the redirect fast path.'''
+    wsgi_app = app.wsgi_app
+    if isinstance(wsgi_app, RedirectFastPath):
+        wsgi_app = wsgi_app.wsgi_app
+    return wsgi_app
+
+
+def call_wsgi(wsgi_app, path):
+    '''Make a GET request for path to wsgi_app, and return the status.'''
+    status = []
+    environ = dict(_BASE_ENVIRON, PATH_INFO=path)
+    body = wsgi_app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        b''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return status[0]
+
+
+_BASE_ENVIRON = werkzeug.test.create_environ('/', 'http://localhost/')
+
+
+def measure(op, n, warmup):
+    '''Run op warmup times, then n times, and return its statistics.'''
+    for _ in range(warmup):
+        op()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'ops': n,
+        'ops_per_sec': n / elapsed,
+        'mean_ms': sum(latencies) / n * 1e3,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+    }
+
+
+def percentile(sorted_values, p):
+    '''Return the p-th percentile of a sorted list, by nearest rank.'''
+    rank = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[rank]
+
+
+def backend_configs(args, tmpdir):
+    '''Yield (name, config class) for every backend to benchmark.'''
+    for name in args.backends:
+        storage = 'sqlalchemy'
+        uri = 'sqlite:///:memory:'
+        if name == 'sqlite-file':
+            uri = 'sqlite:///' + os.path.join(tmpdir, 'benchmark.db')
+        elif name == 'postgres':
+            if not args.postgres_url:
+                print('skipping postgres: no --postgres-url', file=sys.stderr)
+                continue
+            uri = args.postgres_url
+        elif name.startswith('storage-'):
+            # short URLs bypass SQLAlchemy; the other tables stay in memory
+            storage = name[len('storage-'):]
+        yield name, type('BenchmarkConfig', (TestingConfig,), {
+            'SQLALCHEMY_DATABASE_URI': uri,
+            'STORAGE_BACKEND': storage,
+            'STORAGE_SQLITE_PATH': os.path.join(tmpdir, 'shorturls.db'),
+        })
+
+
+def run(args):
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='shortcake-benchmark-')
+    try:
+        for backend, config in backend_configs(args, tmpdir):
+            app = create_app(config)
+            with app.app_context():
+                db.drop_all()
+                db.create_all()
+                seeded = 0
+                for size in sorted(args.sizes):
+                    print('{}: seeding {} rows'.format(backend, size), file=sys.stderr)
+                    seed(app, seeded, size)
+                    seeded = size
+                    for name in args.scenarios:
+                        results.append(dict(
+                            backend=backend, table_rows=size, scenario=name,
+                            **run_scenario(app, name, size, args, tmpdir)))
+                        print(json.dumps(results[-1]), file=sys.stderr)
+                db.session.remove()
+                db.drop_all()
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def run_scenario(app, name, size, args, tmpdir):
+    '''Run one scenario, restoring the configuration of app afterwards.'''
+    config = dict(app.config)
+    ctx = Context(app, size, args.seed, tmpdir)
+    try:
+        op = SCENARIOS[name](ctx)
+        if op is None:
+            return {'skipped': True}
+        return measure(op, args.ops, args.warmup)
+    finally:
+        if ctx.executor is not None:
+            ctx.executor.shutdown()
+        app.config.clear()
+        app.config.update(config)
+        core.init_app(app)
+        clicks.init_app(app)
+        # drop the rows created by the scenario, so that every scenario sees
+        # the same table. The storage interface can't delete rows, so with the
+        # other storage backends they are kept; they are few compared to the
+        # seeded rows.
+        db.session.rollback()
+        ShortURL.query.filter(ShortURL.url.like('http://www.example.com/new/%')) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+def parse_size(s):
+    '''Parse a table size such as 10000, 10k or 10M.'''
+    multipliers = {'k': 10 ** 3, 'm': 10 ** 6}
+    suffix = s[-1].lower()
+    if suffix in multipliers:
+        return int(float(s[:-1]) * multipliers[suffix])
+    return int(s)
+
+
+def metadata():
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+',
+                        default=['sqlite-memory', 'sqlite-file', 'postgres'],
+                        choices=['sqlite-memory', 'sqlite-file', 'postgres',
+                                 'storage-memory', 'storage-sqlite'])
+    parser.add_argument('--postgres-url',
+                        default=os.environ.get('BENCHMARK_POSTGRES_URL'),
+                        help='URL of a scratch PostgreSQL database')
+    parser.add_argument('--sizes', nargs='+', type=parse_size,
+                        default=[10000, 100000],
+                        help='table sizes to benchmark, e.g. 10k 1M 10M')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS),
+                        choices=list(SCENARIOS))
+    parser.add_argument('--ops', type=int, default=2000,
+                        help='number of measured operations per scenario')
+    parser.add_argument('--warmup', type=int, default=200,
+                        help='number of unmeasured operations per scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='file to write the JSON report to')
+    args = parser.parse_args()
+    report = {'metadata': metadata(), 'results': run(args)}
+    json.dump(report, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -25,16 +25,318 @@ class Config:
        fully-qualified short URLs.
     '''
 
+    SHORTKEY_DERIVATION = os.environ.get('SHORTKEY_DERIVATION') or 'base62'
+    '''How candidate short keys are derived from the hash of a URL. Either
+       ``'base62'``, or ``'legacy'`` to keep deriving the same keys for new
+       URLs as releases prior to the base62 derivation did.
+    '''
+    SHORTKEY_STRATEGY = os.environ.get('SHORTKEY_STRATEGY') or 'hash'
+    '''How keys are allocated to new URLs. ``'hash'`` derives candidate keys
+       from the hash of the URL and probes them for a free one. ``'sequence'``
+       permutes the next id of a sequence into a key, which never collides,
+       so a shorten is a single insert no matter how full the table is.
+    '''
+    SHORTKEY_SEQUENCE_SECRET = os.environ.get('SHORTKEY_SEQUENCE_SECRET')
+    '''The secret keying the permutation of the ``'sequence'`` strategy.
+       Defaults to SECRET_KEY. Must never change once keys have been
+       allocated, or new keys start colliding with existing ones.
+    '''
+    SHORTKEY_LEASE_SIZE = int(os.environ.get('SHORTKEY_LEASE_SIZE') or 10000)
+    '''The number of sequence ids in each range leased by a worker process.'''
+    SHORTKEY_LEASE_TTL = float(os.environ.get('SHORTKEY_LEASE_TTL') or 300)
+    '''How long, in seconds, a lease stays valid without being renewed.
+       After that, the unused ids of a crashed worker are reclaimed.
+    '''
+    SHORTKEY_LEASE_CHECKPOINT_INTERVAL = \
+        int(os.environ.get('SHORTKEY_LEASE_CHECKPOINT_INTERVAL') or 100)
+    '''The number of ids a worker hands out between two checkpoints of its
+       lease. Each checkpoint is one query, and up to this many ids are
+       retried by whichever worker reclaims the lease after a crash.
+    '''
+    MAX_EXPIRES_IN = int(os.environ.get('MAX_EXPIRES_IN') or 10 * 365 * 86400)
+    '''The maximum lifetime, in seconds, of a short URL which expires, i.e.
+       of the ``expires_in`` field of a shorten request.
+    '''
+    SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE') or 1000)
+    '''The maximum number of expired short URLs deleted per transaction by
+       ``flask shortcake sweep``. Smaller batches hold locks for less long.
+    '''
+    BATCH_SHORTEN_MAX_URLS = int(os.environ.get('BATCH_SHORTEN_MAX_URLS') or 10000)
+    '''The maximum number of URLs accepted by a single request to the batch
+       shorten endpoint.
+    '''
+    BATCH_LENGTHEN_MAX_KEYS = \
+        int(os.environ.get('BATCH_LENGTHEN_MAX_KEYS') or 10000)
+    '''The maximum number of keys accepted by a single request to the batch
+       lengthen endpoint, which bounds the size of its response.
+    '''
+    LENGTHEN_BATCH_CHUNK_SIZE = \
+        int(os.environ.get('LENGTHEN_BATCH_CHUNK_SIZE') or 500)
+    '''The maximum number of keys looked up by each query of a batch
+       lengthen. Keep it below the limit of the database on the number of
+       parameters of a query.
+    '''
+
+    WEB_UI = os.environ.get('WEB_UI') != '0'
+    '''Whether the web interface is served. If not, the web interface and
+       Flask-Bootstrap aren't even imported, and short URL redirects are
+       only served by the REDIRECT_FAST_PATH, for GET and HEAD requests.
+    '''
+    MIGRATIONS = True
+    '''Whether Flask-Migrate is set up, which the ``flask db`` commands
+       need. Web workers don't, and skip importing alembic without it.
+    '''
+
+    REDIRECT_FAST_PATH = True
+    '''Whether short URL redirects are served by a minimal WSGI handler in
+       front of the application, rather than by the webapp blueprint.
+    '''
+    REDIRECT_STATUS = int(os.environ.get('REDIRECT_STATUS') or 302)
+    '''The status of short URL redirects: 301, 302, 307 or 308. Browsers
+       cache permanent (301, 308) redirects without being told to, so their
+       later clicks are never seen, nor counted.
+    '''
+
+    # HTTP caching options
+    HTTP_REDIRECT_MAX_AGE = int(os.environ.get('HTTP_REDIRECT_MAX_AGE') or 0)
+    '''How long, in seconds, browsers and CDNs may cache a short URL
+       redirect. Clicks served from a cache aren't counted. If 0, caches
+       must revalidate redirects with the application every time.
+    '''
+    HTTP_LENGTHEN_MAX_AGE = \
+        int(os.environ.get('HTTP_LENGTHEN_MAX_AGE') or 86400)
+    '''How long, in seconds, browsers and CDNs may cache the response of the
+       lengthen endpoint for an existing key. These responses also carry an
+       ETag, so revalidating them costs no body.
+    '''
+    HTTP_NEGATIVE_MAX_AGE = int(os.environ.get('HTTP_NEGATIVE_MAX_AGE') or 5)
+    '''How long, in seconds, browsers and CDNs may cache a response for an
+       unknown key, i.e. a 404 page or a null lengthen result. Keep this
+       short: the key may be created at any time.
+    '''
+
+    # click tracking options
+    CLICK_TRACKING = True
+    '''Whether the clicks on each short URL are counted, per minute.'''
+    CLICK_BUFFER_SIZE = int(os.environ.get('CLICK_BUFFER_SIZE') or 100000)
+    '''The maximum number of clicks buffered in memory by each worker process
+       before they are written to the database.
+    '''
+    CLICK_FLUSH_SIZE = int(os.environ.get('CLICK_FLUSH_SIZE') or 10000)
+    '''The number of buffered clicks which triggers a flush to the database
+       before the flush interval is up.
+    '''
+    CLICK_FLUSH_INTERVAL = float(os.environ.get('CLICK_FLUSH_INTERVAL') or 10)
+    '''How often, in seconds, buffered clicks are written to the database.
+       If 0, clicks are only written when flushed explicitly.
+    '''
+    CLICK_OVERFLOW_POLICY = os.environ.get('CLICK_OVERFLOW_POLICY') or 'drop-newest'
+    '''Which clicks are dropped when the buffer is full: ``'drop-newest'``
+       or ``'drop-oldest'``.
+    '''
+    STATS_MAX_MINUTES = 1440
+    '''The maximum number of per-minute click counts returned by the stats
+       endpoint.
+    '''
+
+    # metrics options
+    METRICS = True
+    '''Whether counters and latency histograms are recorded, and exposed on
+       the ``/metrics`` endpoint in the Prometheus text format.
+    '''
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    '''A directory where every worker process writes snapshots of its
+       metrics, so that ``/metrics`` reports the sum over all the workers of
+       a host, whichever worker serves it. If unset, ``/metrics`` only
+       reports the worker serving it. Empty it when restarting the workers.
+    '''
+    METRICS_SNAPSHOT_INTERVAL = \
+        float(os.environ.get('METRICS_SNAPSHOT_INTERVAL') or 5)
+    '''How often, in seconds, each worker process writes its snapshot.'''
+
+    # profiling options
+    PROFILING = bool(os.environ.get('PROFILING'))
+    '''Whether requests may be profiled, either when they carry the
+       PROFILING_SECRET in an X-Shortcake-Profile header, or at random, at
+       the PROFILING_SAMPLE_RATE.
+    '''
+    PROFILING_DIR = os.environ.get('PROFILING_DIR') or \
+        os.path.join(basedir, 'profiles')
+    '''The directory each profile is written to, as a file named after the
+       time, process, method, path and duration of the request.
+    '''
+    PROFILING_SECRET = os.environ.get('PROFILING_SECRET')
+    '''The value of the X-Shortcake-Profile header which gets a request
+       profiled. If unset, the header is ignored.
+    '''
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE') or 0)
+    '''The fraction of requests profiled at random, e.g. 0.01. The other
+       requests are slowed down by a single random draw.
+    '''
+    PROFILING_MODE = os.environ.get('PROFILING_MODE') or 'cprofile'
+    '''``'cprofile'`` writes cProfile statistics (``.prof``), which are exact
+       but slow the profiled request down severalfold. ``'sampling'`` writes
+       the collapsed stacks of a sampling profiler (``.folded``), for flame
+       graphs, which barely slows the profiled request down.
+    '''
+    PROFILING_SAMPLING_INTERVAL = \
+        float(os.environ.get('PROFILING_SAMPLING_INTERVAL') or 0.001)
+    '''The number of seconds between two samples of the sampling profiler.'''
+    PROFILING_MAX_FILES = int(os.environ.get('PROFILING_MAX_FILES') or 1000)
+    '''The number of profiles kept in PROFILING_DIR, by all worker processes
+       together. Past it, the oldest profiles are deleted. Set to 0 to keep
+       every profile.
+    '''
+    PROFILING_MAX_PER_MINUTE = \
+        int(os.environ.get('PROFILING_MAX_PER_MINUTE') or 10)
+    '''The maximum number of requests each worker process profiles at random
+       per minute, whatever the PROFILING_SAMPLE_RATE and the traffic.
+       Requests carrying the PROFILING_SECRET are always profiled. Set to 0
+       for no limit.
+    '''
+
+    # storage options
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'sqlalchemy'
+    '''Where short URLs are stored. ``'sqlalchemy'`` stores them in the
+       database at SQLALCHEMY_DATABASE_URI. ``'sqlite'`` stores them in an
+       embedded SQLite database in WAL mode at STORAGE_SQLITE_PATH, shared by
+       the worker processes of a single host. ``'memory'`` stores them in a
+       dict private to each process, and is only meant for tests and
+       benchmarks. Click statistics and key leases are always stored in the
+       SQLALCHEMY_DATABASE_URI database.
+    '''
+    STORAGE_SQLITE_PATH = os.environ.get('STORAGE_SQLITE_PATH') or \
+        os.path.join(basedir, 'shorturls.db')
+    '''The path of the database of the ``'sqlite'`` storage backend.'''
+    STORAGE_SQLITE_MMAP_SIZE = \
+        int(os.environ.get('STORAGE_SQLITE_MMAP_SIZE') or 256 * 2 ** 20)
+    '''The number of bytes of the ``'sqlite'`` storage backend's database
+       which are memory-mapped by each worker process.
+    '''
+
     # database options
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    READ_REPLICA_URIS = [
+        uri for uri in (os.environ.get('READ_REPLICA_URLS') or '').split(',')
+        if uri]
+    '''The URIs of read replicas of the SQLALCHEMY_DATABASE_URI database,
+       comma separated in the READ_REPLICA_URLS environment variable. Short
+       URL lookups of the ``'sqlalchemy'`` storage backend are spread over
+       them round-robin; writes, and the reads made while shortening, go to
+       the primary.
+    '''
+    READ_REPLICA_EJECT_SECONDS = \
+        float(os.environ.get('READ_REPLICA_EJECT_SECONDS') or 30)
+    '''How long, in seconds, a read replica whose query failed is left out
+       of the rotation.
+    '''
+    READ_YOUR_WRITES_SECONDS = \
+        float(os.environ.get('READ_YOUR_WRITES_SECONDS') or 10)
+    '''How long, in seconds, the lookups of a key inserted by a worker
+       process are sent to the primary rather than to a replica, which may
+       not have caught up. Should exceed the replication lag, which keys
+       reused after an expiry rely on.
+    '''
+    READ_REPLICA_RECHECK_MISSES = \
+        os.environ.get('READ_REPLICA_RECHECK_MISSES', '1') != '0'
+    '''Whether lookups of keys which a replica doesn't have are retried on
+       the primary, since another worker process may have just created
+       them. This makes every short URL resolvable as soon as a shorten
+       request returns it, whichever worker serves the lookup, but also
+       sends every lookup of an unknown key (dead links, scanners, bots) to
+       the primary, once per LENGTHEN_CACHE_NEGATIVE_TTL per worker. Set
+       READ_REPLICA_RECHECK_MISSES=0 to keep unknown keys off the primary;
+       keys are then only resolvable through other worker processes once
+       replicated.
+    '''
+    READ_REPLICA_TIMEOUT = float(os.environ.get('READ_REPLICA_TIMEOUT') or 1)
+    '''How long, in seconds, connecting to a read replica, or a lookup on
+       it, may take before the replica is ejected.
+    '''
+    ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URL')
+    '''The URI of the database used by the ASGI application, with an async
+       driver. Defaults to SQLALCHEMY_DATABASE_URI, with its driver replaced
+       by asyncpg (PostgreSQL) or aiosqlite (SQLite).
+    '''
+
+    # lookup cache options
+    LENGTHEN_CACHE_SIZE = int(os.environ.get('LENGTHEN_CACHE_SIZE') or 10000)
+    '''The maximum number of short keys whose lookup results are cached by
+       each worker process. Set to 0 to disable the cache.
+    '''
+    LENGTHEN_CACHE_TTL = float(os.environ.get('LENGTHEN_CACHE_TTL') or 300)
+    '''How long, in seconds, a resolved short key stays cached.'''
+    LENGTHEN_CACHE_NEGATIVE_TTL = \
+        float(os.environ.get('LENGTHEN_CACHE_NEGATIVE_TTL') or 5)
+    '''How long, in seconds, an unknown short key stays cached as a miss.
+       Keep this short: a key created by another worker process in the
+       meantime is not resolvable by this one until the miss expires.
+    '''
+
+    # snapshot options
+    SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+    '''The path of a snapshot of the short URLs, written by ``flask shortcake
+       snapshot``, in which keys are looked up before the database. Every
+       worker process of a host maps the same file, which is reopened when
+       replaced. If unset, there is no snapshot.
+    '''
+    SNAPSHOT_CHECK_INTERVAL = \
+        float(os.environ.get('SNAPSHOT_CHECK_INTERVAL') or 10)
+    '''How often, in seconds, each worker process checks whether the
+       snapshot file has been replaced.
+    '''
+
+    # key filter options
+    KEY_FILTER = bool(os.environ.get('KEY_FILTER'))
+    '''Whether each worker process keeps a Bloom filter of the existing short
+       keys, so that the probing of candidate keys when shortening skips the
+       database when a key is definitely not taken. A key created by one
+       worker process is unknown to the filters of the others until they are
+       rebuilt, so they may pick it and lose the insert, and try another.
+    '''
+    KEY_FILTER_CAPACITY = int(os.environ.get('KEY_FILTER_CAPACITY') or 1000000)
+    '''The minimum number of keys the filter is sized for. A filter is sized
+       for twice the number of keys in the table when it is built.
+    '''
+    KEY_FILTER_ERROR_RATE = float(os.environ.get('KEY_FILTER_ERROR_RATE') or 0.01)
+    '''The false positive rate of the filter once it holds as many keys as it
+       is sized for. Each key takes -ln(rate)/ln(2)**2 bits, i.e. 1.2 bytes
+       at 1%.
+    '''
+    KEY_FILTER_REBUILD_INTERVAL = \
+        float(os.environ.get('KEY_FILTER_REBUILD_INTERVAL') or 60)
+    '''How often, in seconds, the filter is rebuilt from the database, which
+       bounds how long keys created by other worker processes go unnoticed.
+    '''
+
+    # group commit options
+    GROUP_COMMIT = bool(os.environ.get('GROUP_COMMIT'))
+    '''Whether the inserts of concurrent shorten requests within a worker
+       process are written in groups, one transaction (and disk flush) per
+       group, instead of one each. Raises the throughput of bursts of
+       shortens, at the cost of up to GROUP_COMMIT_DELAY more latency.
+       Only useful with threaded workers, and not applied to the ASGI app.
+    '''
+    GROUP_COMMIT_DELAY = float(os.environ.get('GROUP_COMMIT_DELAY') or 0.002)
+    '''How long, in seconds, the first insert of a group waits for others
+       before the group is written.
+    '''
+    GROUP_COMMIT_MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS') or 64)
+    '''The number of pending inserts which gets a group written without
+       waiting for GROUP_COMMIT_DELAY to pass.
+    '''
 
 
 class TestingConfig(Config):
     '''A specialized configuration for automated unit tests.'''
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    # clicks are flushed explicitly by the tests
+    CLICK_FLUSH_INTERVAL = 0
+    # the key filter is built synchronously, on first use
+    KEY_FILTER_REBUILD_INTERVAL = 0
 
 
 class DevelopmentConfig(Config):
@@ -46,4 +348,5 @@ class ProductionConfig(Config):
     '''The production configuration.'''
     # in actual fact several options are overridden in this configuration,
     # but they are done so via environment variables
-    pass
+    MIGRATIONS = bool(os.environ.get('MIGRATIONS'))
+    '''Only the release step, which runs the migrations, sets MIGRATIONS.'''
@@ -0,0 +1,23 @@
+'''Gunicorn configuration of the production deployment.
+
+The application is imported once by the master process, and the workers
+are forked from it, so that they start serving requests immediately,
+rather than each importing the application on its own. The bind address
+and the number of workers default to the PORT and WEB_CONCURRENCY
+environment variables.
+'''
+
+import os
+
+
+preload_app = os.environ.get('GUNICORN_PRELOAD') != '0'
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # database connections opened by the master can't be shared
+        from app.db import dispose_engine
+        app = server.app.wsgi()
+        # the ASGI entry point wraps the flask application, whose async
+        # engine is only connected by the workers
+        dispose_engine(getattr(app, 'app', app))
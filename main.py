@@ -3,7 +3,7 @@
 This module is responsible for creating the application and database.
 It also contains a function to generate the application shell context,
 which is used for development purposes. For application initialization,
-see the app module.
+see the app module. For the production entry point, see the wsgi module.
 '''
 
 import os
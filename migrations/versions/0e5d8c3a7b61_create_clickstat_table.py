@@ -0,0 +1,32 @@
+"""create clickStat table
+
+Revision ID: 0e5d8c3a7b61
+Revises: 7b0e6a2d9f14
+Create Date: 2026-10-18 14:05:33.627014
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e5d8c3a7b61'
+down_revision = '7b0e6a2d9f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('clickStat'):
+        return
+    op.create_table(
+        'clickStat',
+        sa.Column('key', sa.String(length=10), nullable=False),
+        sa.Column('minute', sa.DateTime(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('key', 'minute'),
+    )
+
+
+def downgrade():
+    op.drop_table('clickStat')
@@ -0,0 +1,35 @@
+"""add shortURL.expires_at
+
+Revision ID: 4f1a9c6e2d83
+Revises: 0e5d8c3a7b61
+Create Date: 2026-10-18 16:42:10.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f1a9c6e2d83'
+down_revision = '0e5d8c3a7b61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a nullable column without a default, so existing rows are not
+    # rewritten, and they never expire
+    bind = op.get_bind()
+    columns = [c['name'] for c in sa.inspect(bind).get_columns('shortURL')]
+    if 'expires_at' not in columns:
+        with op.batch_alter_table('shortURL') as batch_op:
+            batch_op.add_column(sa.Column('expires_at', sa.DateTime(), nullable=True))
+    indexes = [i['name'] for i in sa.inspect(bind).get_indexes('shortURL')]
+    if 'ix_shortURL_expires_at' not in indexes:
+        op.create_index('ix_shortURL_expires_at', 'shortURL', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_shortURL_expires_at', table_name='shortURL')
+    with op.batch_alter_table('shortURL') as batch_op:
+        batch_op.drop_column('expires_at')
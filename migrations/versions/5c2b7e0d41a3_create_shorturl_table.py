@@ -0,0 +1,33 @@
+"""create shortURL table
+
+Revision ID: 5c2b7e0d41a3
+Revises: 
+Create Date: 2026-10-18 09:12:40.183402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2b7e0d41a3'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases deployed before migrations were introduced already have this
+    # table, created by db.create_all()
+    if sa.inspect(op.get_bind()).has_table('shortURL'):
+        return
+    op.create_table(
+        'shortURL',
+        sa.Column('key', sa.String(length=10), nullable=False),
+        sa.Column('url', sa.String(length=1000), nullable=True),
+        sa.PrimaryKeyConstraint('key'),
+    )
+
+
+def downgrade():
+    op.drop_table('shortURL')
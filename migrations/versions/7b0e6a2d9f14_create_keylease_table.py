@@ -0,0 +1,38 @@
+"""create keyLease table
+
+Revision ID: 7b0e6a2d9f14
+Revises: d3e94b1f7c28
+Create Date: 2026-10-18 12:26:51.311870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b0e6a2d9f14'
+down_revision = 'd3e94b1f7c28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('keyLease'):
+        return
+    op.create_table(
+        'keyLease',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('start', sa.BigInteger(), nullable=False),
+        sa.Column('end', sa.BigInteger(), nullable=False),
+        sa.Column('next_id', sa.BigInteger(), nullable=False),
+        sa.Column('owner', sa.String(length=128), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_keyLease_expires_at', 'keyLease', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_keyLease_expires_at', table_name='keyLease')
+    op.drop_table('keyLease')
@@ -0,0 +1,35 @@
+"""collate shortURL.key bytewise
+
+Revision ID: 9c3e5a1f8b40
+Revises: 4f1a9c6e2d83
+Create Date: 2026-10-19 10:12:36.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3e5a1f8b40'
+down_revision = '4f1a9c6e2d83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keys are scanned in bytewise order, which the primary key index can
+    # only serve if it uses the "C" collation. SQLite compares bytewise by
+    # default. The primary key index is rebuilt.
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('shortURL', 'key',
+                        type_=sa.String(10, collation='C'),
+                        existing_type=sa.String(10),
+                        existing_nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('shortURL', 'key',
+                        type_=sa.String(10),
+                        existing_type=sa.String(10, collation='C'),
+                        existing_nullable=False)
@@ -0,0 +1,76 @@
+"""add shortURL.url_digest
+
+Revision ID: a81f3c9e5b72
+Revises: 5c2b7e0d41a3
+Create Date: 2026-10-18 09:31:05.550917
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a81f3c9e5b72'
+down_revision = '5c2b7e0d41a3'
+branch_labels = None
+depends_on = None
+
+# number of rows backfilled per statement. Each statement binds two
+# parameters per row, which keeps it below SQLite's default limit of 999.
+BACKFILL_CHUNK_SIZE = 400
+
+shorturl = sa.table(
+    'shortURL',
+    sa.column('key', sa.String),
+    sa.column('url', sa.String),
+    sa.column('url_digest', sa.String),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = [c['name'] for c in sa.inspect(bind).get_columns('shortURL')]
+    if 'url_digest' not in columns:
+        with op.batch_alter_table('shortURL') as batch_op:
+            batch_op.add_column(sa.Column('url_digest', sa.String(length=40), nullable=True))
+    indexes = [i['name'] for i in sa.inspect(bind).get_indexes('shortURL')]
+    if 'ix_shortURL_url_digest' not in indexes:
+        op.create_index('ix_shortURL_url_digest', 'shortURL', ['url_digest'])
+    # commit the schema change, then backfill in autocommit mode so that each
+    # chunk is its own short transaction, rather than locking the whole
+    # table until every row has been updated
+    with op.get_context().autocommit_block():
+        backfill(bind)
+
+
+def backfill(bind):
+    '''Fill in the digest of every existing row, one chunk of
+    BACKFILL_CHUNK_SIZE rows per statement, paginating on the primary key.'''
+    last_key = ''
+    while True:
+        rows = bind.execute(
+            sa.select(shorturl.c.key, shorturl.c.url)
+            .where(shorturl.c.key > last_key)
+            .where(shorturl.c.url_digest.is_(None))
+            .where(shorturl.c.url.isnot(None))
+            .order_by(shorturl.c.key)
+            .limit(BACKFILL_CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        digests = {key: hashlib.sha1(url.encode()).hexdigest() for key, url in rows}
+        bind.execute(
+            shorturl.update()
+            .where(shorturl.c.key.between(rows[0][0], rows[-1][0]))
+            .where(shorturl.c.url_digest.is_(None))
+            .values(url_digest=sa.case(digests, value=shorturl.c.key))
+        )
+        last_key = rows[-1][0]
+
+
+def downgrade():
+    op.drop_index('ix_shortURL_url_digest', table_name='shortURL')
+    with op.batch_alter_table('shortURL') as batch_op:
+        batch_op.drop_column('url_digest')
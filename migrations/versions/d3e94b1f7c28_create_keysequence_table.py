@@ -0,0 +1,31 @@
+"""create keySequence table
+
+Revision ID: d3e94b1f7c28
+Revises: a81f3c9e5b72
+Create Date: 2026-10-18 11:02:17.904126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3e94b1f7c28'
+down_revision = 'a81f3c9e5b72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('keySequence'):
+        return
+    op.create_table(
+        'keySequence',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('next_id', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+
+
+def downgrade():
+    op.drop_table('keySequence')
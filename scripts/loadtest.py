@@ -0,0 +1,427 @@
+'''Load test of a running shortcake deployment.
+
+Starts the application (gunicorn, as in the Procfile, or the development
+server) against a database, seeds it with short URLs, then fires a mix of
+``POST /api/v1/shorten``, ``GET /api/v1/lengthen/<key>`` and ``GET /<key>``
+requests at increasing concurrency levels, with the popularity of keys
+following a Zipfian distribution. Alternatively, the requests of an access
+log are replayed, in order. For each concurrency level, the throughput,
+latency percentiles and error rate of every endpoint are reported, which
+shows at which concurrency the deployment saturates. Run from the project
+root, e.g.::
+
+    $ pipenv run python scripts/loadtest.py --workers 4 --threads 8 \\
+        --concurrency 1,4,16,64 --duration 20
+    $ pipenv run python scripts/loadtest.py --url http://staging:8000 \\
+        --access-log access.log
+
+Only the standard library is used on the client side. The client is a
+single process with one thread per concurrent connection, so it can itself
+become the bottleneck past a few thousand requests per second; the CPU
+usage of the client is reported for each level, and should stay well below
+100% for the results to be those of the server.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import bisect
+import random
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+ENDPOINTS = ('shorten', 'lengthen', 'redirect')
+
+# the statuses which count as a success, by endpoint
+EXPECTED_STATUSES = {
+    'shorten': {201},
+    'lengthen': {200, 304},
+    'redirect': {301, 302, 307, 308},
+}
+
+# the request line of a Common or Combined Log Format line
+LOG_REQUEST = re.compile(r'"(?P<method>[A-Z]+) (?P<path>\S+) HTTP/[0-9.]+"')
+KEY_PATH = re.compile(r'^/([0-9A-Za-z]{7,10})$')
+LENGTHEN_PATH = re.compile(r'^/api/v1/lengthen/([0-9A-Za-z]{7,10})$')
+
+
+class ZipfSampler:
+    '''Samples ranks 0..n-1, rank i with a probability proportional to
+    1/(i+1)**s.
+
+    Args:
+        n (int): The number of ranks
+        s (float): The exponent of the distribution; the larger, the more
+                   skewed towards the first ranks
+    '''
+
+    def __init__(self, n, s):
+        total = 0
+        self.cumulative = []
+        for i in range(n):
+            total += 1 / (i + 1) ** s
+            self.cumulative.append(total)
+
+    def sample(self, rng) -> int:
+        return bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])
+
+
+class SyntheticTraffic:
+    '''Yields (endpoint, method, path, body) requests, mixing the endpoints
+    at the given ratios, with keys drawn from a Zipfian distribution.
+
+    Args:
+        keys (list): The existing keys, the most popular first
+        mix (dict): The relative weight of each endpoint
+        zipf_s (float): The exponent of the Zipfian distribution of keys
+    '''
+
+    def __init__(self, keys, mix, zipf_s):
+        self.keys = keys
+        self.endpoints = [e for e in ENDPOINTS if mix.get(e)]
+        self.weights = [mix[e] for e in self.endpoints]
+        self.sampler = ZipfSampler(len(keys), zipf_s) if keys else None
+
+    def requests(self, rng):
+        while True:
+            endpoint = rng.choices(self.endpoints, self.weights)[0]
+            if endpoint == 'shorten':
+                yield endpoint, 'POST', '/api/v1/shorten', shorten_body()
+                continue
+            key = self.keys[self.sampler.sample(rng)]
+            if endpoint == 'lengthen':
+                yield endpoint, 'GET', '/api/v1/lengthen/' + key, None
+            else:
+                yield endpoint, 'GET', '/' + key, None
+
+
+class ReplayTraffic:
+    '''Yields the requests of an access log, in order, shared by every
+    client thread, starting over at the end of the log.
+
+    Args:
+        requests (list): The (endpoint, method, path) requests of the log
+    '''
+
+    def __init__(self, requests):
+        self._requests = itertools.cycle(requests)
+        self._lock = threading.Lock()
+
+    def requests(self, rng):
+        while True:
+            with self._lock:
+                endpoint, method, path = next(self._requests)
+            body = shorten_body() if endpoint == 'shorten' else None
+            yield endpoint, method, path, body
+
+
+def shorten_body() -> bytes:
+    '''Return the body of a request shortening a URL never seen before.'''
+    return json.dumps({'url': 'http://loadtest.example.com/' + uuid.uuid4().hex}).encode()
+
+
+def parse_access_log(path) -> list:
+    '''Return the (endpoint, method, path) requests of an access log to the
+    endpoints under test, in order. Other requests are skipped.'''
+    requests = []
+    with open(path) as f:
+        for line in f:
+            match = LOG_REQUEST.search(line)
+            if match is None:
+                continue
+            method, target = match.group('method'), match.group('path')
+            target = urllib.parse.urlsplit(target).path
+            if method == 'POST' and target == '/api/v1/shorten':
+                requests.append(('shorten', method, target))
+            elif method == 'GET' and LENGTHEN_PATH.match(target):
+                requests.append(('lengthen', method, target))
+            elif method in ('GET', 'HEAD') and KEY_PATH.match(target):
+                requests.append(('redirect', method, target))
+    return requests
+
+
+def log_keys(requests) -> set:
+    '''Return the keys looked up by the requests of an access log.'''
+    keys = set()
+    for endpoint, _, path in requests:
+        if endpoint != 'shorten':
+            keys.add(path.rsplit('/', 1)[1])
+    return keys
+
+
+class Client(threading.Thread):
+    '''Sends requests over a keep-alive connection until stopped, recording
+    the latency and status of each.
+
+    Args:
+        host (str): The host of the server
+        port (int): The port of the server
+        requests (iterator): Yields the (endpoint, method, path, body)
+                             requests to send
+        stop (threading.Event): Set when the client should stop
+    '''
+
+    def __init__(self, host, port, requests, stop):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.requests = requests
+        self.stop = stop
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = dict.fromkeys(ENDPOINTS, 0)
+        self._conn = None
+
+    def run(self):
+        for endpoint, method, path, body in self.requests:
+            if self.stop.is_set():
+                break
+            start = time.perf_counter()
+            try:
+                status = self.send(method, path, body)
+            except (OSError, http.client.HTTPException):
+                # dropped or refused connections are errors too
+                status = None
+                self._conn = None
+            self.latencies[endpoint].append(time.perf_counter() - start)
+            if status not in EXPECTED_STATUSES[endpoint]:
+                self.errors[endpoint] += 1
+        if self._conn is not None:
+            self._conn.close()
+
+    def send(self, method, path, body) -> int:
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        self._conn.request(method, path, body, headers)
+        response = self._conn.getresponse()
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self._conn.close()
+            self._conn = None
+        return response.status
+
+
+def run_level(host, port, traffic, concurrency, duration, seed) -> dict:
+    '''Run concurrency clients for duration seconds, and return the
+    results of each endpoint, plus the totals.'''
+    stop = threading.Event()
+    clients = [Client(host, port, traffic.requests(random.Random(seed + i)), stop)
+               for i in range(concurrency)]
+    cpu_start, start = time.process_time(), time.perf_counter()
+    for client in clients:
+        client.start()
+    time.sleep(duration)
+    stop.set()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    cpu = (time.process_time() - cpu_start) / elapsed
+    results = {}
+    for endpoint in ENDPOINTS + ('total',):
+        if endpoint == 'total':
+            latencies = [x for c in clients for e in ENDPOINTS for x in c.latencies[e]]
+            errors = sum(c.errors[e] for c in clients for e in ENDPOINTS)
+        else:
+            latencies = [x for c in clients for x in c.latencies[endpoint]]
+            errors = sum(c.errors[endpoint] for c in clients)
+        if not latencies:
+            continue
+        latencies.sort()
+        results[endpoint] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'error_rate': errors / len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
+    return {'concurrency': concurrency, 'seconds': elapsed,
+            'client_cpu': cpu, 'endpoints': results}
+
+
+def percentile(values, p):
+    '''Return the p-th percentile of sorted values, by nearest rank.'''
+    return values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))]
+
+
+def report(level):
+    print('concurrency {concurrency}: {seconds:.1f}s, client CPU {cpu:.0%}'.format(
+        concurrency=level['concurrency'], seconds=level['seconds'],
+        cpu=level['client_cpu']))
+    print('  {:<10} {:>9} {:>7} {:>7} {:>9} {:>8} {:>8} {:>8}'.format(
+        'endpoint', 'requests', 'errors', 'err%', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for endpoint, r in level['endpoints'].items():
+        print('  {:<10} {:>9d} {:>7d} {:>6.2f}% {:>9.1f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+            endpoint, r['requests'], r['errors'], r['error_rate'] * 100,
+            r['throughput'], r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000))
+    sys.stdout.flush()
+
+
+def seed_keys(host, port, n, batch_size=1000) -> list:
+    '''Shorten n new URLs through the batch endpoint, and return their keys.'''
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    keys = []
+    prefix = 'http://seed.loadtest.example.com/{}/'.format(uuid.uuid4().hex)
+    while len(keys) < n:
+        urls = [prefix + str(i) for i in range(len(keys), min(n, len(keys) + batch_size))]
+        conn.request('POST', '/api/v1/shorten/batch', json.dumps({'urls': urls}),
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError('seeding failed: {} {}'.format(response.status, body[:200]))
+        keys.extend(r['short_url'].rsplit('/', 1)[1]
+                    for r in json.loads(body)['results'])
+    conn.close()
+    return keys
+
+
+def import_keys(keys, env):
+    '''Create a short URL for each of the given keys, with ``flask shortcake
+    import``, so that the keys of a replayed access log resolve.'''
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+        for key in sorted(keys):
+            f.write(json.dumps({'key': key, 'url': 'http://loadtest.example.com/' + key}) + '\n')
+    try:
+        subprocess.run(['flask', 'shortcake', 'import', f.name],
+                       env=dict(env, MIGRATIONS='1', FLASK_APP='wsgi.py'),
+                       cwd=PROJECT_ROOT, check=True)
+    finally:
+        os.unlink(f.name)
+
+
+def start_server(args, env):
+    '''Migrate the database, start the server, and return its process once
+    it accepts connections.'''
+    subprocess.run(['flask', 'db', 'upgrade'],
+                   env=dict(env, MIGRATIONS='1', FLASK_APP='wsgi.py'),
+                   cwd=PROJECT_ROOT, check=True)
+    bind = '127.0.0.1:{}'.format(args.port)
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '-c', 'gunicorn.conf.py', '--bind', bind,
+                   '--workers', str(args.workers), '--threads', str(args.threads),
+                   '--log-level', 'warning', 'wsgi:app']
+    else:
+        command = ['flask', 'run', '--port', str(args.port), '--with-threads',
+                   '--no-reload']
+    server = subprocess.Popen(command, env=dict(env, FLASK_APP='wsgi.py'), cwd=PROJECT_ROOT)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', args.port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError('the server failed to start')
+            time.sleep(0.2)
+
+
+def parse_mix(s) -> dict:
+    '''Parse e.g. "shorten=5,lengthen=25,redirect=70".'''
+    mix = {}
+    for item in s.split(','):
+        endpoint, _, weight = item.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError('unknown endpoint: ' + endpoint)
+        mix[endpoint] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    target = parser.add_argument_group('target')
+    target.add_argument('--url', help='the base URL of an already running '
+                        'deployment; if omitted, a server is started')
+    target.add_argument('--server', choices=('gunicorn', 'dev'), default='gunicorn')
+    target.add_argument('--database-url', help='the DATABASE_URL of the started '
+                        'server (default: a new SQLite file)')
+    target.add_argument('--port', type=int, default=8765)
+    target.add_argument('--workers', type=int, default=2,
+                        help='gunicorn worker processes')
+    target.add_argument('--threads', type=int, default=4,
+                        help='gunicorn threads per worker')
+    traffic = parser.add_argument_group('traffic')
+    traffic.add_argument('--mix', type=parse_mix,
+                         default='shorten=5,lengthen=25,redirect=70',
+                         help='the relative weight of each endpoint (default: '
+                              '%(default)s)')
+    traffic.add_argument('--keys', type=int, default=10000,
+                         help='number of short URLs created before the test')
+    traffic.add_argument('--zipf-s', type=float, default=1.1,
+                         help='exponent of the Zipfian popularity of keys')
+    traffic.add_argument('--access-log', help='replay the shorten, lengthen and '
+                         'redirect requests of this access log instead')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32,64',
+                        help='comma-separated concurrency levels (default: '
+                             '%(default)s)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per concurrency level')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+
+    server = tmpdir = None
+    if args.url:
+        parsed = urllib.parse.urlsplit(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        host, port = '127.0.0.1', args.port
+        env = dict(os.environ, DOMAIN_NAME='{}:{}'.format(host, port))
+        if args.database_url:
+            env['DATABASE_URL'] = args.database_url
+        else:
+            tmpdir = tempfile.TemporaryDirectory()
+            env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir.name, 'loadtest.db')
+        server = start_server(args, env)
+    try:
+        if args.access_log:
+            requests = parse_access_log(args.access_log)
+            if not requests:
+                parser.error('no requests to replay in ' + args.access_log)
+            if server is not None:
+                import_keys(log_keys(requests), env)
+            traffic = ReplayTraffic(requests)
+            print('replaying {} requests of {}'.format(len(requests), args.access_log))
+        else:
+            keys = seed_keys(host, port, args.keys) if args.keys else []
+            rng = random.Random(args.seed)
+            rng.shuffle(keys)
+            traffic = SyntheticTraffic(keys, args.mix, args.zipf_s)
+            print('seeded {} keys, mix {}'.format(len(keys), args.mix))
+        levels = []
+        for concurrency in map(int, args.concurrency.split(',')):
+            levels.append(run_level(host, port, traffic, concurrency,
+                                    args.duration, args.seed))
+            report(levels[-1])
+        peak = max(levels, key=lambda level: level['endpoints']['total']['throughput'])
+        print('peak: {:.1f} req/s at concurrency {}'.format(
+            peak['endpoints']['total']['throughput'], peak['concurrency']))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(levels, f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
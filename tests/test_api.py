@@ -0,0 +1,142 @@
+import datetime
+
+import pytest
+from config import TestingConfig
+from app import create_app, db, httpcache, storage
+from app.models import ShortURL
+
+
+@pytest.fixture
+def client():
+    app = create_app(TestingConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app.test_client()
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_shorten__common(client):
+    rv = client.post('/api/v1/shorten', json={'url': 'http://www.example.com/'})
+    assert rv.status_code == 201
+    key = rv.get_json()['short_url'].rsplit('/', 1)[1]
+    rv = client.get('/api/v1/lengthen/' + key)
+    assert rv.get_json() == {'url': 'http://www.example.com/'}
+
+
+def test_shorten__expires_in(client):
+    rv = client.post('/api/v1/shorten',
+                     json={'url': 'http://www.example.com/', 'expires_in': 3600})
+    assert rv.status_code == 201
+    key = rv.get_json()['short_url'].rsplit('/', 1)[1]
+    expires_at = datetime.datetime.fromisoformat(rv.get_json()['expires_at'].rstrip('Z'))
+    assert ShortURL.query.get(key).expires_at == expires_at
+    assert client.get('/api/v1/lengthen/' + key).get_json() == \
+        {'url': 'http://www.example.com/'}
+    # once expired, the short URL is missing
+    ShortURL.query.get(key).expires_at = datetime.datetime.utcnow()
+    db.session.commit()
+    client.application.extensions['lengthen_cache'].clear()
+    assert client.get('/api/v1/lengthen/' + key).get_json() == {'url': None}
+
+@pytest.mark.parametrize('expires_in', [0, -1, 1.5, '60', True, 10 ** 12])
+def test_shorten__invalid_expires_in(client, expires_in):
+    rv = client.post('/api/v1/shorten',
+                     json={'url': 'http://www.example.com/', 'expires_in': expires_in})
+    assert rv.status_code == 400
+
+
+def test_shorten_batch__common(client):
+    urls = ['http://www.example.com/', 'not a url', 'http://www.foobar.com/']
+    rv = client.post('/api/v1/shorten/batch', json={'urls': urls})
+    assert rv.status_code == 200
+    results = rv.get_json()['results']
+    assert [r['url'] for r in results] == urls
+    assert results[1] == {'url': 'not a url', 'error': 'invalid URL'}
+    assert 'short_url' in results[0] and 'short_url' in results[2]
+    assert ShortURL.query.count() == 2
+
+@pytest.mark.parametrize('body', [{'url': 'x'}, ['x'], 'x', 1])
+def test_shorten_batch__bad_request(client, body):
+    assert client.post('/api/v1/shorten/batch', json=body).status_code == 400
+
+@pytest.mark.parametrize('body', [['url'], 'url', 1])
+def test_shorten__bad_request(client, body):
+    assert client.post('/api/v1/shorten', json=body).status_code == 400
+
+def test_shorten_batch__too_many_urls(client):
+    client.application.config['BATCH_SHORTEN_MAX_URLS'] = 1
+    rv = client.post('/api/v1/shorten/batch', json={'urls': ['a.com', 'b.com']})
+    assert rv.status_code == 413
+
+def test_shorten_batch__contention(client, monkeypatch):
+    def insert_many(rows):
+        raise storage.KeyConflictError
+    monkeypatch.setattr(client.application.extensions['storage'],
+                        'insert_many', insert_many)
+    rv = client.post('/api/v1/shorten/batch', json={'urls': ['http://www.example.com/']})
+    assert rv.status_code == 503
+    assert b'retry later' in rv.data
+
+
+def test_lengthen__etag(client):
+    rv = client.post('/api/v1/shorten', json={'url': 'http://www.example.com/'})
+    path = '/api/v1/lengthen/' + rv.get_json()['short_url'].rsplit('/', 1)[1]
+    rv = client.get(path)
+    etag = rv.headers['ETag']
+    assert etag.startswith('"') and rv.headers['Cache-Control'] == 'public, max-age=86400'
+    rv = client.get(path, headers={'If-None-Match': 'W/"x", ' + etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+    assert rv.headers['ETag'] == etag
+    assert client.get(path, headers={'If-None-Match': '"x"'}).status_code == 200
+
+def test_lengthen__miss_cache_headers(client):
+    rv = client.get('/api/v1/lengthen/7OuG89A')
+    assert rv.get_json() == {'url': None}
+    assert rv.headers['Cache-Control'] == 'public, max-age=5'
+    assert 'ETag' not in rv.headers
+
+def test_lengthen__expiring_cache_headers(client):
+    rv = client.post('/api/v1/shorten',
+                     json={'url': 'http://www.example.com/', 'expires_in': 60})
+    path = '/api/v1/lengthen/' + rv.get_json()['short_url'].rsplit('/', 1)[1]
+    for _ in range(2):  # uncached, then cached
+        rv = client.get(path)
+        max_age = int(rv.headers['Cache-Control'].split('max-age=')[1])
+        assert 58 <= max_age <= 60
+        assert 'ETag' in rv.headers
+
+def test_cache_headers__expiry():
+    now = datetime.datetime.utcnow()
+    assert httpcache.cache_headers(3600, now + datetime.timedelta(seconds=30.5))[0] == \
+        ('Cache-Control', 'public, max-age=30')
+    assert httpcache.cache_headers(20, now + datetime.timedelta(seconds=60))[0] == \
+        ('Cache-Control', 'public, max-age=20')
+    assert httpcache.cache_headers(3600, now + datetime.timedelta(seconds=0.5)) == \
+        [('Cache-Control', 'no-cache')]
+    assert httpcache.cache_headers(3600, now - datetime.timedelta(seconds=1)) == \
+        [('Cache-Control', 'no-cache')]
+
+def test_lengthen_batch__common(client):
+    rv = client.post('/api/v1/shorten', json={'url': 'http://www.example.com/'})
+    key = rv.get_json()['short_url'].rsplit('/', 1)[1]
+    rv = client.post('/api/v1/lengthen/batch',
+                     json={'keys': [key, '7OuG89A', 'abc', key]})
+    assert rv.status_code == 200
+    assert rv.get_json() == {'results': {
+        key: {'url': 'http://www.example.com/'},
+        '7OuG89A': {'url': None},
+        'abc': {'error': 'invalid key'},
+    }}
+
+def test_lengthen_batch__bad_request(client):
+    assert client.post('/api/v1/lengthen/batch', json={'key': 'x'}).status_code == 400
+    assert client.post('/api/v1/lengthen/batch', json={'keys': [1]}).status_code == 400
+
+def test_lengthen_batch__too_many_keys(client):
+    client.application.config['BATCH_LENGTHEN_MAX_KEYS'] = 2
+    rv = client.post('/api/v1/lengthen/batch', json={'keys': ['7OuG89A'] * 3})
+    assert rv.status_code == 413
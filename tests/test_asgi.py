@@ -0,0 +1,159 @@
+import json
+import asyncio
+import datetime
+import pytest
+from config import TestingConfig
+from app import create_app, db, core, aio
+from app.asgi import create_asgi_app
+
+
+@pytest.fixture(params=['sqlalchemy', 'memory'])
+def app(request, tmpdir):
+    # the async engine has connections of its own, so the database can't
+    # be in memory
+    class AsyncConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmpdir.join('app.db'))
+        STORAGE_BACKEND = request.param
+    app = create_app(AsyncConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+async def call(asgi_app, method, path, body=None, headers=()):
+    '''Send a request to an ASGI application, and return the status,
+    headers and body of its response.'''
+    headers = list(headers)
+    if body is not None:
+        body = json.dumps(body).encode()
+        headers.append((b'content-type', b'application/json'))
+    messages = [{'type': 'http.request', 'body': body or b''}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app({'type': 'http', 'method': method, 'path': path,
+                    'headers': headers}, receive, send)
+    start, body = sent
+    return (start['status'], dict((k.decode(), v.decode()) for k, v in start['headers']),
+            body['body'])
+
+
+def run(app, coroutine):
+    '''Run a coroutine, within an application context, and return its result.'''
+    async def main():
+        try:
+            with app.app_context():
+                return await coroutine
+        finally:
+            await aio.dispose(app)
+    return asyncio.run(main())
+
+
+def test_async_database_uri():
+    assert aio.async_database_uri('sqlite:////tmp/app.db') == 'sqlite+aiosqlite:////tmp/app.db'
+    assert aio.async_database_uri('postgres://u:p@host/db') == 'postgresql+asyncpg://u:p@host/db'
+    assert aio.async_database_uri('postgresql+psycopg2://host/db') == 'postgresql+asyncpg://host/db'
+    with pytest.raises(ValueError):
+        aio.async_database_uri('mysql://host/db')
+
+def test_shorten_url__same_key_as_sync(app):
+    aio.init_app(app)
+    key = run(app, aio.shorten_url('http://www.example.com/'))
+    assert key == core.shorten_url('http://www.example.com/')
+    assert run(app, aio.lengthen_url(key)) == 'http://www.example.com/'
+    assert run(app, aio.shorten_url('http://www.example.com/')) == key
+
+def test_shorten_url__taken_candidates(app):
+    aio.init_app(app)
+    candidates = core._candidate_keys(core.url_digest('http://www.example.com/'))
+    for key in candidates[:3]:
+        core._try_insert(key, 'http://www.foobar.com/')
+    assert run(app, aio.shorten_url('http://www.example.com/')) == candidates[3]
+    assert not run(app, aio._try_insert(candidates[0], 'http://www.example.com/'))
+    assert run(app, aio._try_insert(candidates[0], 'http://www.foobar.com/'))
+
+def test_shorten_url__expiry(app):
+    aio.init_app(app)
+    now = datetime.datetime.utcnow()
+    candidates = core._candidate_keys(core.url_digest('http://www.example.com/'))
+    core.shorten_url('http://www.example.com/', now - datetime.timedelta(minutes=1))
+    # the key of the expired short URL is taken until swept
+    key = run(app, aio.shorten_url('http://www.example.com/'))
+    assert key == candidates[1]
+    expiring = run(app, aio.shorten_url('http://www.example.com/',
+                                        now + datetime.timedelta(hours=1)))
+    assert expiring == candidates[2]
+    assert run(app, aio.lengthen_url(candidates[0])) is None
+    assert run(app, aio.lengthen_url(expiring)) == 'http://www.example.com/'
+
+def test_shorten_url__concurrent(app):
+    aio.init_app(app)
+    urls = ['http://www.example.com/{}'.format(i) for i in range(20)]
+    async def shorten_all():
+        return await asyncio.gather(*map(aio.shorten_url, urls))
+    keys = run(app, shorten_all())
+    assert len(set(keys)) == len(urls)
+    assert [core.lengthen_url(key) for key in keys] == urls
+
+def test_lengthen_url__invalid_key(app):
+    aio.init_app(app)
+    with pytest.raises(core.InvalidShortKeyError):
+        run(app, aio.lengthen_url('abc'))
+    assert run(app, aio.lengthen_url('7OuG89A')) is None
+
+def test_asgi__api(app):
+    asgi_app = create_asgi_app(app)
+    async def requests():
+        status, _, body = await call(asgi_app, 'POST', '/api/v1/shorten',
+                                     {'url': 'http://www.example.com/'})
+        assert status == 201
+        key = json.loads(body)['short_url'].rsplit('/', 1)[1]
+        status, headers, body = await call(asgi_app, 'GET', '/api/v1/lengthen/' + key)
+        assert json.loads(body) == {'url': 'http://www.example.com/'}
+        status, _, body = await call(asgi_app, 'GET', '/api/v1/lengthen/' + key,
+                                     headers=[(b'if-none-match', headers['etag'].encode())])
+        assert status == 304 and body == b''
+        status, _, body = await call(asgi_app, 'POST', '/api/v1/shorten/batch',
+                                     {'urls': ['http://www.example.com/', 'not a url']})
+        results = json.loads(body)['results']
+        assert results[0]['short_url'].endswith('/' + key)
+        assert results[1] == {'url': 'not a url', 'error': 'invalid URL'}
+        status, _, body = await call(asgi_app, 'POST', '/api/v1/lengthen/batch',
+                                     {'keys': [key, 'abc']})
+        assert json.loads(body) == {'results': {
+            key: {'url': 'http://www.example.com/'}, 'abc': {'error': 'invalid key'}}}
+        status, _, body = await call(asgi_app, 'GET', '/api/v1/stats/' + key)
+        assert json.loads(body) == {'key': key, 'clicks': 0, 'minutes': []}
+        assert (await call(asgi_app, 'POST', '/api/v1/shorten', {'x': 1}))[0] == 400
+        assert (await call(asgi_app, 'POST', '/api/v1/shorten', {'url': 'x'}))[0] == 400
+        assert (await call(asgi_app, 'GET', '/api/v1/lengthen/abc'))[0] == 400
+        assert (await call(asgi_app, 'GET', '/api/v1/stats/7OuG89A'))[0] == 404
+        assert (await call(asgi_app, 'GET', '/api/v1/shorten'))[0] == 405
+    run(app, requests())
+
+def test_asgi__redirect(app):
+    core._try_insert('7OuG89A', 'www.example.com')
+    asgi_app = create_asgi_app(app)
+    async def requests():
+        status, headers, body = await call(asgi_app, 'GET', '/7OuG89A')
+        assert status == 302
+        assert headers['location'] == 'http://www.example.com'
+        assert headers['cache-control'] == 'no-cache'
+        status, headers, body = await call(asgi_app, 'HEAD', '/7OuG89A')
+        assert status == 302 and body == b''
+        status, headers, body = await call(asgi_app, 'GET', '/7OuG89B')
+        assert status == 404
+        assert headers['content-type'] == 'text/html; charset=utf-8'
+        assert b'Not Found' in body
+        assert (await call(asgi_app, 'GET', '/not-a-key'))[0] == 404
+    run(app, requests())
+    assert app.extensions['click_recorder'].flush() == 2
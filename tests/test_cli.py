@@ -0,0 +1,98 @@
+import json
+import datetime
+import pytest
+from config import TestingConfig
+from app import create_app, db, core
+from app.models import ShortURL, ClickStat, url_digest
+
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'jsonl'])
+def test_export_import__roundtrip(app, tmpdir, fmt):
+    rows = [ShortURL(key='{:07d}'.format(i), url='http://www.example.com/{}'.format(i))
+            for i in range(25)]
+    db.session.add_all(rows)
+    db.session.commit()
+    path = str(tmpdir.join('backup.' + fmt))
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['shortcake', 'export', path, '--batch-size', '10'])
+    assert result.exit_code == 0
+
+    ShortURL.query.delete()
+    db.session.commit()
+    result = runner.invoke(args=['shortcake', 'import', path, '--batch-size', '10'])
+    assert result.exit_code == 0
+    assert 'imported 25 rows' in result.output
+    imported = ShortURL.query.order_by(ShortURL.key).all()
+    assert [(r.key, r.url) for r in imported] == [(r.key, r.url) for r in rows]
+    assert all(r.url_digest == url_digest(r.url) for r in imported)
+
+
+def test_import__resume(app, tmpdir):
+    path = tmpdir.join('backup.jsonl')
+    path.write(''.join(
+        json.dumps({'key': '{:07d}'.format(i), 'url': 'http://www.example.com/'}) + '\n'
+        for i in range(10)))
+    # a record which was imported before the interruption is skipped anyway
+    db.session.add(ShortURL(key='0000005', url='http://www.example.com/'))
+    db.session.commit()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['shortcake', 'import', str(path), '--skip', '4'])
+    assert result.exit_code == 0
+    assert [r.key for r in ShortURL.query.order_by(ShortURL.key)] == \
+        ['{:07d}'.format(i) for i in range(4, 10)]
+
+
+def test_export_import__expiry(app, tmpdir):
+    expires_at = datetime.datetime.utcnow().replace(microsecond=0) + \
+        datetime.timedelta(days=1)
+    db.session.add_all([
+        ShortURL(key='7OuG89A', url='http://www.example.com/', expires_at=expires_at),
+        ShortURL(key='7OuG89B', url='http://www.example.com/',
+                 expires_at=expires_at - datetime.timedelta(days=2)),
+        ShortURL(key='7OuG89C', url='http://www.foobar.com/')])
+    db.session.commit()
+    path = str(tmpdir.join('backup.csv'))
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['shortcake', 'export', path]).exit_code == 0
+    ShortURL.query.delete()
+    db.session.commit()
+    assert runner.invoke(args=['shortcake', 'import', path]).exit_code == 0
+    # the expired short URL is left out
+    assert [(r.key, r.expires_at) for r in ShortURL.query.order_by(ShortURL.key)] == \
+        [('7OuG89A', expires_at), ('7OuG89C', None)]
+
+
+def test_sweep(app):
+    url = 'http://www.example.com/'
+    candidates = core._candidate_keys(url_digest(url))
+    expired = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    db.session.add(ShortURL(key=candidates[0], url=url, expires_at=expired))
+    db.session.add_all(ShortURL(key='{:07d}'.format(i), url=url, expires_at=expired)
+                       for i in range(4))
+    db.session.add(ShortURL(key='7OuG89A', url='http://www.foobar.com/'))
+    db.session.add(ClickStat(key=candidates[0], minute=expired, count=3))
+    db.session.commit()
+    assert core.shorten_url(url) == candidates[1]
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['shortcake', 'sweep', '--batch-size', '2'])
+    assert result.exit_code == 0
+    assert 'swept 5 rows' in result.output
+    assert [r.key for r in ShortURL.query.order_by(ShortURL.key)] == \
+        ['7OuG89A', candidates[1]]
+    assert ClickStat.query.count() == 0
+    # the key of the expired short URL is free again
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    assert core.shorten_url(url, expires_at) == candidates[0]
@@ -0,0 +1,100 @@
+import time
+import threading
+
+import pytest
+from config import TestingConfig
+from app import create_app, db, clicks
+from app.models import ShortURL, ClickStat
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    db.session.add(ShortURL(key='7OuG89A', url='http://www.example.com/'))
+    db.session.commit()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_ClickRecorder__aggregates(app):
+    clock = Clock(1579700000.0)
+    recorder = clicks.ClickRecorder(app, 100, 100, 0, clock=clock)
+    recorder.record('7OuG89A')
+    recorder.record('7OuG89B')
+    recorder.record('7OuG89A')
+    clock.now += 60
+    recorder.record('7OuG89A')
+    assert recorder.flush() == 4
+    assert ClickStat.query.count() == 3
+    # a second flush adds to the existing counts
+    recorder.record('7OuG89A')
+    assert recorder.flush() == 1
+    assert clicks.stats('7OuG89A', 10)['clicks'] == 4
+    assert [count for _, count in clicks.stats('7OuG89A', 10)['minutes']] == [2, 2]
+    assert clicks.stats('7OuG89A', 1)['minutes'][0][1] == 2
+
+@pytest.mark.parametrize('policy,kept', [('drop-newest', ['a', 'b']),
+                                         ('drop-oldest', ['b', 'c'])])
+def test_ClickRecorder__overflow(app, policy, kept):
+    recorder = clicks.ClickRecorder(app, 2, 100, 0, overflow_policy=policy)
+    for key in ['a', 'b', 'c']:
+        recorder.record(key)
+    assert recorder.dropped == 1
+    assert [key for key, _ in recorder._buffer] == kept
+
+def test_ClickRecorder__background_flush(app):
+    recorder = clicks.ClickRecorder(app, 100, 2, 60)
+    recorder.record('7OuG89A')
+    recorder.record('7OuG89A')
+    # reaching the flush size wakes up the flusher thread
+    recorder._thread.join(0.5)
+    assert clicks.stats('7OuG89A', 10)['clicks'] == 2
+
+def test_ClickRecorder__concurrent_start(app, monkeypatch):
+    recorder = clicks.ClickRecorder(app, 100, 100, 60)
+    started = []
+    def start():
+        started.append(None)
+        time.sleep(0.05)
+        recorder._thread = threading.current_thread()
+    monkeypatch.setattr(recorder, '_start', start)
+    barrier = threading.Barrier(8)
+    def record():
+        barrier.wait()
+        recorder.record('7OuG89A')
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(started) == 1
+    assert len(recorder._buffer) == 8
+
+
+def test_stats__redirects_are_counted(app):
+    client = app.test_client()
+    for _ in range(3):
+        assert client.get('/7OuG89A').status_code == 302
+    client.get('/7OuG89B')
+    app.extensions['click_recorder'].flush()
+    rv = client.get('/api/v1/stats/7OuG89A')
+    assert rv.status_code == 200
+    assert rv.get_json()['clicks'] == 3
+    assert rv.get_json()['minutes'][0]['clicks'] == 3
+
+def test_stats__unknown_key(app):
+    client = app.test_client()
+    assert client.get('/api/v1/stats/7OuG89B').status_code == 404
+    assert client.get('/api/v1/stats/nope').status_code == 400
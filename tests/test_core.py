@@ -1,7 +1,10 @@
+import random
+import collections
 import pytest
+import sqlalchemy
 from config import TestingConfig
-from app import create_app, db, core
-from app.models import ShortURL
+from app import create_app, db, core, storage
+from app.models import ShortURL, url_digest
 
 
 @pytest.fixture
@@ -97,7 +100,7 @@ def test__key_from_hex__fillvalue():
     # there's a case where the converted value of a sextet is greater than
     # 62, in which case the fill value is injected. Craft a custom input
     # such that the fill value is triggered for all sextets.
-    k = core._key_from_hex('ffffffffffffffffffffffffffffffffffffffff')
+    k = core._legacy_key_from_hex('ffffffffffffffffffffffffffffffffffffffff')
     # TODO what should this output?
     assert True
 
@@ -122,6 +125,13 @@ def test_shorten_url__common(app):
     # should get the same thing if we do it again
     assert k == core.shorten_url('http://www.example.com')
 
+def test_shorten_url__known_url(app):
+    # the key of a known URL is found even if it isn't one of its windows
+    db.session.add(ShortURL(key='7OuG89A' , url='http://www.example.com'))
+    db.session.commit()
+    assert ShortURL.query.get('7OuG89A').url_digest == url_digest('http://www.example.com')
+    assert core.shorten_url('http://www.example.com') == '7OuG89A'
+
 def test_shorten_url__invalid_url(app):
     with pytest.raises(core.InvalidURLError):
         core.shorten_url('lssldkakdk')
@@ -145,3 +155,218 @@ def test_lengthen_url__nonexistent_key(app):
 def test_lengthen_url__invalid_key():
     with pytest.raises(core.InvalidShortKeyError):
         core.lengthen_url('aah!!!')
+
+
+def test_lengthen_url__cached(app):
+    db.session.add(ShortURL(key='7OuG89A' , url='http://www.example.com/'))
+    db.session.commit()
+    cache = app.extensions['lengthen_cache']
+    assert 'http://www.example.com/' == core.lengthen_url('7OuG89A')
+    # remove the entry behind the cache's back; the cached URL is still served
+    ShortURL.query.filter_by(key='7OuG89A').delete()
+    db.session.commit()
+    assert 'http://www.example.com/' == core.lengthen_url('7OuG89A')
+    assert cache.hits == 1 and cache.misses == 1
+
+def test_lengthen_url__cached_miss_invalidated_by_insert(app):
+    assert core.lengthen_url('7OuG89A') == None
+    assert core.lengthen_url('7OuG89A') == None
+    assert app.extensions['lengthen_cache'].hits == 1
+    assert core._try_insert('7OuG89A', 'http://www.example.com/')
+    assert 'http://www.example.com/' == core.lengthen_url('7OuG89A')
+
+
+def test_LookupCache__lru_eviction():
+    cache = core.LookupCache(2, ttl=60, negative_ttl=60)
+    cache.put('a', 'http://a.com/')
+    cache.put('b', 'http://b.com/')
+    # touch 'a' so that 'b' is the least recently used entry
+    cache.get('a')
+    cache.put('c', None)
+    assert cache.get('b') is cache.MISSING
+    assert cache.get('a') == 'http://a.com/'
+    assert cache.get('c') == None
+
+def test_LookupCache__expiry():
+    now = [0]
+    cache = core.LookupCache(10, ttl=60, negative_ttl=5, clock=lambda: now[0])
+    cache.put('a', 'http://a.com/')
+    cache.put('b', None)
+    now[0] = 10
+    assert cache.get('a') == 'http://a.com/'
+    assert cache.get('b') is cache.MISSING
+    now[0] = 61
+    assert cache.get('a') is cache.MISSING
+    assert len(cache) == 0
+
+def test_LookupCache__capped_ttl():
+    now = [0]
+    cache = core.LookupCache(10, ttl=60, negative_ttl=5, clock=lambda: now[0])
+    # e.g. a short URL expiring in 20 seconds
+    cache.put('a', 'http://a.com/', ttl=20)
+    cache.put('b', 'http://b.com/', ttl=600)
+    cache.put('c', 'http://c.com/', ttl=-1)
+    assert cache.get('c') is cache.MISSING
+    now[0] = 21
+    assert cache.get('a') is cache.MISSING
+    assert cache.get('b') == 'http://b.com/'
+    now[0] = 61
+    assert cache.get('b') is cache.MISSING
+
+
+def test_shorten_urls__common(app):
+    urls = ['http://www.example.com', 'lssldkakdk', 'http://www.foobar.com/',
+            'http://www.example.com']
+    keys = core.shorten_urls(urls)
+    assert isinstance(keys[1], core.InvalidURLError)
+    assert keys[0] == keys[3] == core.shorten_url('http://www.example.com')
+    assert keys[2] == core.shorten_url('http://www.foobar.com/')
+    assert ShortURL.query.count() == 2
+
+def test_shorten_urls__key_taken(app):
+    # claim the first candidate key of the URL for another URL
+    candidates = core._candidate_keys(url_digest('http://www.example.com'))
+    db.session.add(ShortURL(key=candidates[0], url='http://www.foobar.com/'))
+    db.session.commit()
+    [k] = core.shorten_urls(['http://www.example.com'])
+    assert k == candidates[1]
+    assert core.lengthen_url(k) == 'http://www.example.com'
+
+def test_shorten_urls__contention(app, monkeypatch):
+    # simulate other processes claiming one of the keys on every attempt
+    attempts = []
+    def insert_many(rows):
+        attempts.append(rows)
+        raise storage.KeyConflictError
+    monkeypatch.setattr(app.extensions['storage'], 'insert_many', insert_many)
+    with pytest.raises(core.KeyContentionError):
+        core.shorten_urls(['http://www.example.com'])
+    assert len(attempts) == 3
+
+def test_lengthen_urls__chunked_queries(app):
+    app.config['LENGTHEN_BATCH_CHUNK_SIZE'] = 4
+    keys = ['{:07d}'.format(i) for i in range(10)]
+    db.session.add_all(ShortURL(key=key, url='http://www.example.com/' + key)
+                       for key in keys[::2])
+    db.session.commit()
+    core.lengthen_url(keys[0])
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        urls = core.lengthen_urls(keys + ['abc'])
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+    # the cached key isn't looked up again
+    assert len(statements) == 3
+    assert isinstance(urls.pop('abc'), core.InvalidShortKeyError)
+    assert urls == {key: 'http://www.example.com/' + key if i % 2 == 0 else None
+                    for i, key in enumerate(keys)}
+
+def test_shorten_url__round_trips(app):
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db.engine
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+    try:
+        # a handful of taken windows still costs a digest lookup, one window
+        # lookup and one insert
+        candidates = core._candidate_keys(url_digest('http://www.example.com'))
+        for key in candidates[:5]:
+            db.session.add(ShortURL(key=key, url='http://www.foobar.com/'))
+        db.session.commit()
+        del statements[:]
+        assert core.shorten_url('http://www.example.com') == candidates[5]
+        assert len(statements) == 3
+        # shortening the same URL again is a single digest lookup
+        del statements[:]
+        assert core.shorten_url('http://www.example.com') == candidates[5]
+        assert len(statements) == 1
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+
+def test_shorten_url__dense_key_range(app):
+    # every window, and the 2500 keys following the last one, are taken
+    url = 'http://www.example.com'
+    candidates = core._candidate_keys(url_digest(url))
+    last = core._key_to_int(candidates[-1])
+    taken = set(candidates) | {core._int_to_key(last + i, 7) for i in range(2501)}
+    db.session.execute(ShortURL.__table__.insert(),
+                       [{'key': key, 'url': 'http://www.foobar.com/'} for key in taken])
+    db.session.commit()
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        key = core.shorten_url(url)
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+    assert key == core._int_to_key(last + 2501, 7)
+    # a digest lookup, a window lookup, three pages of keys, and an insert
+    assert len(statements) == 6
+
+def test__next_free_key__wraparound(app):
+    for key in ['zzzzzzz', '0000000', '0000001']:
+        db.session.add(ShortURL(key=key, url='http://www.foobar.com/'))
+    db.session.commit()
+    assert core._next_free_key('zzzzzzy', 'http://www.example.com', {}) == ('0000002', 4)
+    # keys claimed since the taken dict was filled in are skipped too
+    assert core._next_free_key('zzzzzzy', 'http://www.example.com',
+                               {'0000002': None}) == ('0000003', 5)
+
+def test__key_to_int():
+    assert core._key_to_int('0000000') == 0
+    assert core._key_to_int('000000z') == 61
+    assert core._key_to_int('0000010') == 62
+    assert core._key_to_int('zzzzzzz') == 62 ** 7 - 1
+    assert core._int_to_key(core._key_to_int('7OuG89A'), 7) == '7OuG89A'
+
+def test_shorten_url__lost_race(app, monkeypatch):
+    # simulate another process claiming the first candidate key between the
+    # lookup and the insert
+    candidates = core._candidate_keys(url_digest('http://www.example.com'))
+    lookup_keys = core._lookup_keys
+    def racing_lookup_keys(keys):
+        found = lookup_keys(keys)
+        db.session.add(ShortURL(key=candidates[0], url='http://www.foobar.com/'))
+        db.session.commit()
+        return found
+    monkeypatch.setattr(core, '_lookup_keys', racing_lookup_keys)
+    assert core.shorten_url('http://www.example.com') == candidates[1]
+
+def test__key_from_hex__uniform():
+    # chi-squared test of the distribution of the characters of the first
+    # key window over many random digests. The threshold is the critical
+    # value for 61 degrees of freedom at p = 0.001.
+    rng = random.Random(0)
+    n = 20000
+    counts = [collections.Counter() for _ in range(core.SHORTKEY_LENGTH)]
+    for _ in range(n):
+        key = core._key_from_hex('{:040x}'.format(rng.getrandbits(160)))
+        for i, c in enumerate(key[:core.SHORTKEY_LENGTH]):
+            counts[i][c] += 1
+    expected = n / core.N_SHORTKEY_CHARS
+    for counter in counts:
+        assert set(counter) <= set(core.SHORTKEY_CHARSET)
+        chi2 = sum((counter[c] - expected) ** 2 / expected
+                   for c in core.SHORTKEY_CHARSET)
+        assert chi2 < 100.9
+
+def test__key_from_hex__leading_zeros():
+    # the width of the key only depends on the length of the argument
+    assert len(core._key_from_hex('00' * 20)) == len(core._key_from_hex('ff' * 20)) == 27
+    assert core._key_from_hex('00' * 20) == '0' * 27
+
+def test__legacy_key_from_hex():
+    # the legacy derivation must keep producing the keys it always has
+    assert core._legacy_key_from_hex('f0c740728f139362bbbe572391fa1bee03b6271e') \
+        == 'yCU1oZvoUAxlgySZzRxksdy'
+
+def test__candidate_keys__legacy_derivation(app):
+    digest = url_digest('http://www.example.com')
+    assert core._candidate_keys(digest)[0] == core._key_from_hex(digest)[:7]
+    app.config['SHORTKEY_DERIVATION'] = 'legacy'
+    assert core._candidate_keys(digest)[0] == core._legacy_key_from_hex(digest)[:7]
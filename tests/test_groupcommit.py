@@ -0,0 +1,129 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from config import TestingConfig
+from app import create_app, db, core, storage
+from app.groupcommit import GroupCommitter, GroupCommitError
+
+
+class RecordingStorage(storage.MemoryStorage):
+    '''A MemoryStorage which records the groups it inserts.'''
+
+    def __init__(self):
+        super().__init__()
+        self.groups = []
+
+    def insert_if_absent_many(self, rows):
+        self.groups.append(list(rows))
+        return super().insert_if_absent_many(rows)
+
+
+class FailingStorage(storage.MemoryStorage):
+
+    def insert_if_absent_many(self, rows):
+        raise RuntimeError('database is gone')
+
+
+def insert_concurrently(committer, rows):
+    barrier = threading.Barrier(len(rows))
+    def insert(row):
+        barrier.wait()
+        return committer.insert_if_absent(*row)
+    with ThreadPoolExecutor(len(rows)) as executor:
+        return list(executor.map(insert, rows))
+
+
+def test_GroupCommitter__own_results():
+    store = RecordingStorage()
+    store.insert_if_absent('7OuG89A', 'http://www.example.com/')
+    committer = GroupCommitter(store, 1, 4)
+    rows = [('7OuG89A', 'http://www.foobar.com/'),
+            ('7OuG89B', 'http://www.foobar.com/'),
+            ('7OuG89C', 'http://www.example.org/'),
+            ('7OuG89C', 'http://www.example.net/')]
+    results = insert_concurrently(committer, rows)
+    # a single group, written as soon as max_rows were pending
+    assert len(store.groups) == 1
+    assert results[:2] == [False, True]
+    # exactly one of the rows with the same key won
+    assert sorted(results[2:]) == [False, True]
+    winner = rows[2 + results[2:].index(True)][1]
+    assert store.get('7OuG89C') == winner
+
+def test_GroupCommitter__max_delay():
+    store = RecordingStorage()
+    committer = GroupCommitter(store, 0.01, 100)
+    assert committer.insert_if_absent('7OuG89A', 'http://www.example.com/')
+    assert not committer.insert_if_absent('7OuG89A', 'http://www.foobar.com/')
+    assert len(store.groups) == 2
+
+def test_GroupCommitter__error():
+    committer = GroupCommitter(FailingStorage(), 1, 3)
+    with ThreadPoolExecutor(3) as executor:
+        futures = [executor.submit(committer.insert_if_absent,
+                                   '7OuG89' + c, 'http://www.example.com/')
+                   for c in 'ABC']
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+
+
+class InterruptedStorage(storage.MemoryStorage):
+
+    def insert_if_absent_many(self, rows):
+        raise SystemExit
+
+
+def test_GroupCommitter__interrupted():
+    committer = GroupCommitter(InterruptedStorage(), 1, 3)
+    barrier = threading.Barrier(3)
+    def insert(c):
+        barrier.wait()
+        try:
+            return committer.insert_if_absent('7OuG89' + c, 'http://www.example.com/')
+        except BaseException as e:
+            return type(e)
+    with ThreadPoolExecutor(3) as executor:
+        results = list(executor.map(insert, 'ABC'))
+    # the leader got SystemExit, and the others were released with an error
+    assert sorted(map(str, results)) == sorted(map(str, [
+        SystemExit, GroupCommitError, GroupCommitError]))
+    # the committer isn't stuck
+    committer.storage = storage.MemoryStorage()
+    committer.max_delay = 0
+    assert committer.insert_if_absent('7OuG89A', 'http://www.example.com/')
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def app(request, tmpdir):
+    class GroupCommitConfig(TestingConfig):
+        STORAGE_BACKEND = request.param
+        STORAGE_SQLITE_PATH = str(tmpdir.join('shorturls.db'))
+        GROUP_COMMIT = True
+        GROUP_COMMIT_DELAY = 0.05
+    app = create_app(GroupCommitConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_shorten_url__group_commit(app):
+    urls = ['http://www.example.com/{}'.format(i) for i in range(8)] * 2
+    def shorten(url):
+        with app.app_context():
+            return core.shorten_url(url)
+    with ThreadPoolExecutor(len(urls)) as executor:
+        keys = list(executor.map(shorten, urls))
+    assert keys[:8] == keys[8:]
+    assert len(set(keys)) == 8
+    for url, key in zip(urls, keys):
+        assert core.lengthen_url(key) == url
+
+def test_init_app__disabled():
+    app = create_app(TestingConfig)
+    assert 'group_committer' not in app.extensions
@@ -0,0 +1,101 @@
+import random
+import pytest
+import sqlalchemy
+from config import TestingConfig
+from app import create_app, db, core, keyfilter
+from app.models import ShortURL, url_digest
+
+
+class KeyFilterConfig(TestingConfig):
+    KEY_FILTER = True
+
+
+@pytest.fixture
+def app():
+    app = create_app(KeyFilterConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+@pytest.fixture
+def statements(app):
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+    yield statements
+    sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+
+
+def random_keys(rng, n):
+    return [core._int_to_key(rng.randrange(62 ** 7), 7) for _ in range(n)]
+
+
+def test_BloomFilter__no_false_negatives():
+    rng = random.Random(0)
+    keys = random_keys(rng, 10000)
+    bloom = keyfilter.BloomFilter(10000, 0.01)
+    bloom.update(keys[:5000])
+    for key in keys[5000:]:
+        bloom.add(key)
+    assert len(bloom) == 10000
+    assert all(key in bloom for key in keys)
+    # 9.6 bits per key
+    assert bloom.nbytes == 11982
+
+def test_BloomFilter__false_positive_rate():
+    rng = random.Random(0)
+    bloom = keyfilter.BloomFilter(10000, 0.01)
+    bloom.update(random_keys(rng, 10000))
+    others = random_keys(rng, 20000)
+    rate = sum(key in bloom for key in others) / len(others)
+    assert 0.005 < rate < 0.015
+
+def test_KeyFilter__built_from_table(app):
+    db.session.add(ShortURL(key='7OuG89A', url='http://www.example.com/'))
+    db.session.commit()
+    key_filter = app.extensions['key_filter']
+    assert key_filter.might_contain('7OuG89A')
+    assert not key_filter.might_contain('7OuG89B')
+    # keys inserted by another process are only seen after a rebuild
+    db.session.add(ShortURL(key='7OuG89B', url='http://www.foobar.com/'))
+    db.session.commit()
+    assert not key_filter.might_contain('7OuG89B')
+    key_filter.rebuild()
+    assert key_filter.might_contain('7OuG89B')
+
+def test_lengthen_url__ignores_filter(app):
+    core.shorten_url('http://www.example.com')
+    # created by another worker process, unknown to this one's filter
+    db.session.add(ShortURL(key='7OuG89B', url='http://www.foobar.com/'))
+    db.session.commit()
+    assert not app.extensions['key_filter'].might_contain('7OuG89B')
+    assert core.lengthen_url('7OuG89B') == 'http://www.foobar.com/'
+    assert core.lengthen_urls(['7OuG89B']) == {'7OuG89B': 'http://www.foobar.com/'}
+
+def test_shorten_url__skips_lookups(app, statements):
+    url = 'http://www.example.com'
+    candidates = core._candidate_keys(url_digest(url))
+    db.session.add(ShortURL(key=candidates[0], url='http://www.foobar.com/'))
+    db.session.commit()
+    app.extensions['key_filter'].rebuild()
+    del statements[:]
+    # a digest lookup, a lookup of the first (taken) window, and an insert
+    key = core.shorten_url(url)
+    assert key == candidates[1]
+    assert len(statements) == 3
+    # the new key was added to the filter, and is looked up
+    del statements[:]
+    app.extensions['lengthen_cache'].clear()
+    assert core.lengthen_url(key) == url
+    assert len(statements) == 1
+
+def test_shorten_urls__updates_filter(app):
+    keys = core.shorten_urls(['http://www.example.com', 'http://www.foobar.com/'])
+    key_filter = app.extensions['key_filter']
+    assert all(key_filter.might_contain(key) for key in keys)
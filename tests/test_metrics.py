@@ -0,0 +1,114 @@
+import json
+import pytest
+from config import TestingConfig
+from app import create_app, db, core, metrics
+
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def scrape(client):
+    rv = client.get('/metrics')
+    assert rv.status_code == 200
+    return rv.get_data(as_text=True).splitlines()
+
+
+def test_Metrics__histogram():
+    registry = metrics.Metrics()
+    for value in [0.00005, 0.0003, 0.0003, 10]:
+        registry.observe('shortcake_core_seconds', {'operation': 'x'}, value)
+    lines = registry.render().splitlines()
+    assert 'shortcake_core_seconds_bucket{operation="x",le="0.0001"} 1' in lines
+    assert 'shortcake_core_seconds_bucket{operation="x",le="0.00025"} 1' in lines
+    assert 'shortcake_core_seconds_bucket{operation="x",le="0.0005"} 3' in lines
+    assert 'shortcake_core_seconds_bucket{operation="x",le="2.5"} 3' in lines
+    assert 'shortcake_core_seconds_bucket{operation="x",le="+Inf"} 4' in lines
+    assert 'shortcake_core_seconds_count{operation="x"} 4' in lines
+
+def test_Metrics__merges_processes(tmpdir):
+    registry = metrics.Metrics(str(tmpdir), snapshot_interval=60)
+    registry.inc('shortcake_shorten_total', {'source': 'window'}, 2)
+    registry.observe('shortcake_shorten_probe_depth', {}, 1)
+    # the snapshot of another worker process
+    tmpdir.join('metrics-1.json').write(json.dumps({
+        'counters': [['shortcake_shorten_total', {'source': 'window'}, 3]],
+        'histograms': [['shortcake_shorten_probe_depth', {},
+                        [0, 1] + [0] * 8 + [2]]],
+    }))
+    lines = registry.render().splitlines()
+    assert 'shortcake_shorten_total{source="window"} 5' in lines
+    assert 'shortcake_shorten_probe_depth_bucket{le="1"} 1' in lines
+    assert 'shortcake_shorten_probe_depth_bucket{le="2"} 2' in lines
+    assert 'shortcake_shorten_probe_depth_sum 3' in lines
+    assert 'shortcake_shorten_probe_depth_count 2' in lines
+    registry.write_snapshot()
+    assert len(tmpdir.listdir('*.json')) == 2
+
+def test_Metrics__fold_exited(tmpdir):
+    registry = metrics.Metrics(str(tmpdir), snapshot_interval=60)
+    registry.inc('shortcake_shorten_total', {'source': 'window'}, 1)
+    registry.write_snapshot()
+    # the snapshots of two exited worker processes, one of them with the pid
+    # of the other, and of a live one
+    dead_pid = 2 ** 22 + 1
+    for filename, value in [('metrics-{}-aaaa.json'.format(dead_pid), 2),
+                            ('metrics-{}-bbbb.json'.format(dead_pid), 3),
+                            ('metrics-1-cccc.json', 4)]:
+        tmpdir.join(filename).write(json.dumps({
+            'counters': [['shortcake_shorten_total', {'source': 'window'}, value]],
+            'histograms': [],
+        }))
+    assert 'shortcake_shorten_total{source="window"} 10' in registry.render().splitlines()
+    assert registry.fold_exited() == 2
+    assert {f.basename for f in tmpdir.listdir('*.json')} == \
+        {'metrics-1-cccc.json', 'metrics-exited.json', registry._filename}
+    assert 'shortcake_shorten_total{source="window"} 10' in registry.render().splitlines()
+    assert registry.fold_exited() == 0
+
+def test_Metrics__fork_resets_lock():
+    registry = metrics.Metrics()
+    registry.inc('shortcake_shorten_total', {'source': 'window'})
+    # as in a child forked while another thread held the lock
+    registry._lock.acquire()
+    registry._pid = -1
+    registry.inc('shortcake_shorten_total', {'source': 'window'})
+    assert 'shortcake_shorten_total{source="window"} 1' in registry.render().splitlines()
+
+def test_metrics__endpoint(app):
+    client = app.test_client()
+    rv = client.post('/api/v1/shorten', json={'url': 'http://www.example.com'})
+    key = rv.get_json()['short_url'].rsplit('/', 1)[1]
+    client.get('/' + key)
+    client.get('/' + key)
+    lines = scrape(client)
+    assert 'shortcake_shorten_total{source="window"} 1' in lines
+    assert 'shortcake_shorten_probe_depth_count 1' in lines
+    assert 'shortcake_lengthen_total{source="storage_hit"} 1' in lines
+    assert 'shortcake_lengthen_total{source="cache"} 1' in lines
+    assert 'shortcake_try_insert_total{outcome="inserted"} 1' in lines
+    assert 'shortcake_http_request_seconds_count{endpoint="api.shorten",status="201"} 1' in lines
+    assert 'shortcake_http_request_seconds_count{endpoint="redirect_fast_path",status="302"} 2' in lines
+    assert 'shortcake_core_seconds_count{operation="shorten_url"} 1' in lines
+    for phase in ['validate', 'lookup', 'derive', 'probe', 'insert']:
+        assert 'shortcake_shorten_phase_seconds_count{{phase="{}"}} 1'.format(phase) in lines
+    queries = [line for line in lines if line.startswith('shortcake_db_queries_total')]
+    assert int(queries[0].split()[1]) >= 3
+
+def test_metrics__fallback(app):
+    candidates = core._candidate_keys(core.url_digest('http://www.example.com'))
+    for key in candidates:
+        core._try_insert(key, 'http://www.foobar.com/')
+    core.shorten_url('http://www.example.com')
+    lines = scrape(app.test_client())
+    assert 'shortcake_shorten_total{source="fallback"} 1' in lines
+    assert 'shortcake_shorten_probe_depth_bucket{le="21"} 0' in lines
+    assert 'shortcake_shorten_probe_depth_bucket{le="50"} 1' in lines
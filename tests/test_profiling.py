@@ -0,0 +1,85 @@
+import time
+import pstats
+import pytest
+from config import TestingConfig
+from app import create_app, db, profiling
+
+
+@pytest.fixture
+def make_app(tmpdir):
+    apps = []
+    def make_app(**config):
+        config = dict(dict(PROFILING=True, PROFILING_DIR=str(tmpdir),
+                           PROFILING_SECRET='letmein'), **config)
+        app = create_app(type('ProfilingConfig', (TestingConfig,), config))
+        app_context = app.app_context()
+        app_context.push()
+        db.create_all()
+        apps.append(app_context)
+        return app
+    yield make_app
+    for app_context in apps:
+        db.session.remove()
+        db.drop_all()
+        app_context.pop()
+
+
+def test_profiling__secret_header(make_app, tmpdir):
+    client = make_app().test_client()
+    assert client.get('/api/v1/lengthen/7OuG89A').status_code == 200
+    assert client.get('/api/v1/lengthen/7OuG89A',
+                      headers={'X-Shortcake-Profile': 'wrong'}).status_code == 200
+    assert tmpdir.listdir() == []
+    rv = client.get('/api/v1/lengthen/7OuG89A',
+                    headers={'X-Shortcake-Profile': 'letmein'})
+    assert rv.status_code == 200
+    assert rv.get_json() == {'url': None}
+    [path] = tmpdir.listdir()
+    assert path.basename.endswith('.prof')
+    assert '-GET-api.v1.lengthen.7OuG89A-' in path.basename
+    assert pstats.Stats(str(path)).total_calls > 0
+
+def test_profiling__sample_rate(make_app, tmpdir):
+    client = make_app(PROFILING_SAMPLE_RATE=1, PROFILING_SECRET=None).test_client()
+    client.get('/7OuG89A')
+    client.get('/7OuG89B', headers={'X-Shortcake-Profile': ''})
+    assert len(tmpdir.listdir()) == 2
+
+def test_profiling__max_files(make_app, tmpdir):
+    client = make_app(PROFILING_MAX_FILES=2).test_client()
+    for key in ('7OuG89A', '7OuG89B', '7OuG89C', '7OuG89D'):
+        client.get('/' + key, headers={'X-Shortcake-Profile': 'letmein'})
+    # the two newest profiles are kept
+    assert sorted(path.basename.split('-')[3] for path in tmpdir.listdir()) == \
+        ['7OuG89C', '7OuG89D']
+
+def test_ProfilingMiddleware__max_per_minute(tmpdir):
+    now = [0.0]
+    middleware = profiling.ProfilingMiddleware(
+        None, str(tmpdir), 'letmein', sample_rate=1, max_per_minute=3,
+        clock=lambda: now[0])
+    assert [middleware.should_profile({}) for _ in range(5)] == \
+        [True, True, True, False, False]
+    # the secret header isn't limited
+    assert middleware.should_profile({profiling.PROFILE_HEADER: 'letmein'})
+    now[0] = 60.0
+    assert middleware.should_profile({})
+
+def test_profiling__sampling_mode(make_app, tmpdir):
+    client = make_app(PROFILING_MODE='sampling').test_client()
+    client.get('/7OuG89A', headers={'X-Shortcake-Profile': 'letmein'})
+    [path] = tmpdir.listdir()
+    assert path.basename.endswith('.folded')
+
+def test_SamplingProfiler():
+    def busy():
+        deadline = time.perf_counter() + 0.2
+        while time.perf_counter() < deadline:
+            pass
+    profiler = profiling.SamplingProfiler(0.001)
+    profiler.start()
+    busy()
+    profiler.stop()
+    assert sum(profiler.stacks.values()) > 10
+    stack, _ = profiler.stacks.most_common(1)[0]
+    assert stack.split(';')[-1].split(':')[1] == 'busy'
@@ -0,0 +1,121 @@
+import datetime
+
+import pytest
+from config import TestingConfig
+from app import create_app, db, redirect
+from app.models import ShortURL
+
+
+class SlowPathConfig(TestingConfig):
+    REDIRECT_FAST_PATH = False
+
+
+@pytest.fixture(params=[TestingConfig, SlowPathConfig])
+def client(request):
+    app = create_app(request.param)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    db.session.add(ShortURL(key='7OuG89A', url='http://www.example.com/'))
+    db.session.add(ShortURL(key='7OuG89B', url='www.foobar.com'))
+    db.session.commit()
+    yield app.test_client()
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_is_key_path():
+    assert redirect.is_key_path('/7OuG89h')
+    assert redirect.is_key_path('/2tzIJGEQm4')
+    assert not redirect.is_key_path('/')
+    assert not redirect.is_key_path('/2t3d0d')
+    assert not redirect.is_key_path('/2tzIJGEQm4y')
+    assert not redirect.is_key_path('/t-IEQm4y')
+    assert not redirect.is_key_path('/static/x')
+    assert not redirect.is_key_path('7OuG89hh')
+
+
+def test_redirect__common(client):
+    rv = client.get('/7OuG89A')
+    assert rv.status_code == 302
+    assert rv.headers['Location'] == 'http://www.example.com/'
+
+def test_redirect__domain_only(client):
+    rv = client.get('/7OuG89B')
+    assert rv.headers['Location'] == 'http://www.foobar.com'
+
+def test_redirect__head(client):
+    rv = client.head('/7OuG89A')
+    assert rv.status_code == 302
+    assert rv.data == b''
+
+def test_redirect__not_found(client):
+    rv = client.get('/7OuG89C')
+    assert rv.status_code == 404
+    assert b"We don't know that URL" in rv.data
+    # the fast path serves the same page as the webapp blueprint
+    assert rv.data == client.get('/7OuG89').data
+
+def test_redirect__cache_headers(client):
+    rv = client.get('/7OuG89A')
+    assert rv.headers['Cache-Control'] == 'no-cache'
+    client.application.config['HTTP_REDIRECT_MAX_AGE'] = 3600
+    rv = client.get('/7OuG89A')
+    assert rv.headers['Cache-Control'] == 'public, max-age=3600'
+    assert 'Expires' in rv.headers
+    rv = client.get('/7OuG89C')
+    assert rv.headers['Cache-Control'] == 'public, max-age=5'
+
+def test_redirect__expiring_cache_headers(client):
+    db.session.add(ShortURL(
+        key='7OuG89C', url='http://www.example.com/',
+        expires_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=60)))
+    db.session.commit()
+    client.application.config['HTTP_REDIRECT_MAX_AGE'] = 3600
+    rv = client.get('/7OuG89C')
+    assert rv.status_code == 302
+    max_age = int(rv.headers['Cache-Control'].split('max-age=')[1])
+    assert 58 <= max_age <= 60
+
+@pytest.mark.parametrize('fast_path', [True, False])
+@pytest.mark.parametrize('status', [301, 307, 308])
+def test_redirect__status(status, fast_path):
+    app = create_app(type('StatusConfig', (TestingConfig,), {
+        'REDIRECT_STATUS': status, 'REDIRECT_FAST_PATH': fast_path}))
+    with app.app_context():
+        db.create_all()
+        db.session.add(ShortURL(key='7OuG89A', url='http://www.example.com/'))
+        db.session.commit()
+        rv = app.test_client().get('/7OuG89A')
+        assert rv.status_code == status
+        assert rv.headers['Location'] == 'http://www.example.com/'
+        db.session.remove()
+        db.drop_all()
+
+def test_redirect__invalid_status():
+    with pytest.raises(ValueError):
+        create_app(type('StatusConfig', (TestingConfig,), {'REDIRECT_STATUS': 200}))
+
+def test_redirect__falls_through(client):
+    assert client.get('/').status_code == 200
+    assert client.get('/api/v1/lengthen/7OuG89A').get_json() == \
+        {'url': 'http://www.example.com/'}
+    assert client.post('/7OuG89A').status_code == 405
+
+def test_redirect__api_only():
+    app = create_app(type('ApiOnlyConfig', (TestingConfig,),
+                          {'WEB_UI': False, 'MIGRATIONS': False}))
+    assert 'webapp' not in app.blueprints
+    assert 'migrate' not in app.extensions
+    with app.app_context():
+        db.create_all()
+        db.session.add(ShortURL(key='7OuG89A', url='http://www.example.com/'))
+        db.session.commit()
+        client = app.test_client()
+        assert client.get('/7OuG89A').status_code == 302
+        rv = client.get('/7OuG89B')
+        assert rv.status_code == 404
+        assert rv.data == b'<h1>Not Found</h1>'
+        db.session.remove()
+        db.drop_all()
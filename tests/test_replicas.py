@@ -0,0 +1,131 @@
+import pytest
+import sqlalchemy
+from config import TestingConfig
+from app import create_app, db, core, storage
+from app.models import ShortURL
+from app.replicas import ReplicaSet, _connect_args
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def replica_uri(tmpdir, name, rows=()):
+    '''Return the URI of a new replica database holding rows.'''
+    uri = 'sqlite:///' + str(tmpdir.join(name + '.db'))
+    engine = sqlalchemy.create_engine(uri)
+    ShortURL.__table__.create(engine)
+    with engine.begin() as conn:
+        for key, url in rows:
+            conn.execute(ShortURL.__table__.insert().values(key=key, url=url))
+    engine.dispose()
+    return uri
+
+
+@pytest.fixture
+def app(tmpdir):
+    class ReplicaConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmpdir.join('primary.db'))
+        READ_REPLICA_URIS = [
+            replica_uri(tmpdir, 'replica', [('7OuG89A', 'http://www.example.com/')])]
+    app = create_app(ReplicaConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_lengthen_url__replica(app):
+    # the row is only in the replica
+    assert core.lengthen_url('7OuG89A') == 'http://www.example.com/'
+    assert core.lengthen_urls(['7OuG89A']) == {'7OuG89A': 'http://www.example.com/'}
+
+def test_lengthen_url__read_your_writes(app):
+    key = core.shorten_url('http://www.foobar.com/')
+    assert app.extensions['read_replicas'].written_recently([key])
+    assert core.lengthen_url(key) == 'http://www.foobar.com/'
+
+def test_lengthen_url__replica_miss(app):
+    app.extensions['read_replicas'].window = 0
+    key = core.shorten_url('http://www.foobar.com/')
+    assert not app.extensions['read_replicas'].written_recently([key])
+    assert core.lengthen_url(key) == 'http://www.foobar.com/'
+    assert core.lengthen_urls([key, '7OuG89A']) == {
+        key: 'http://www.foobar.com/', '7OuG89A': 'http://www.example.com/'}
+
+def test_lengthen_url__no_miss_recheck(app):
+    app.extensions['read_replicas'].window = 0
+    app.extensions['read_replicas'].recheck_misses = False
+    key = core.shorten_url('http://www.foobar.com/')
+    # not replicated yet, and the primary isn't asked
+    assert core.lengthen_url(key) is None
+    assert core.lengthen_url('7OuG89A') == 'http://www.example.com/'
+
+def test_get__stale_replica(app):
+    store = app.extensions['storage']
+    # the replica still holds a previous short URL of the key
+    assert store.insert_if_absent('7OuG89A', 'http://www.foobar.com/')
+    assert store.get('7OuG89A') == 'http://www.foobar.com/'
+    assert store.get_many(['7OuG89A']) == {'7OuG89A': 'http://www.foobar.com/'}
+
+def test_ReplicaSet__round_robin(app, tmpdir):
+    store = storage.SQLAlchemyStorage(ReplicaSet(
+        [replica_uri(tmpdir, 'a', [('7OuG89A', 'http://a/')]),
+         replica_uri(tmpdir, 'b', [('7OuG89A', 'http://b/')])], 30, 10))
+    assert [store.get('7OuG89A') for _ in range(4)] == \
+        ['http://a/', 'http://b/', 'http://a/', 'http://b/']
+
+def test_ReplicaSet__ejection(app, tmpdir):
+    clock = Clock()
+    broken = 'sqlite:///' + str(tmpdir.join('missing', 'broken.db'))
+    replicas = ReplicaSet(
+        [broken, replica_uri(tmpdir, 'a', [('7OuG89A', 'http://a/')])], 30, 10,
+        clock=clock)
+    store = storage.SQLAlchemyStorage(replicas)
+    assert [store.get('7OuG89A') for _ in range(3)] == ['http://a/'] * 3
+    assert replicas._ejected_until == [1030.0, 0.0]
+    # the broken replica is tried again once its ejection is over
+    clock.now = 1031.0
+    assert [store.get('7OuG89A') for _ in range(2)] == ['http://a/'] * 2
+    assert replicas._ejected_until == [1061.0, 0.0]
+
+def test_ReplicaSet__all_ejected(app, tmpdir):
+    store = storage.SQLAlchemyStorage(ReplicaSet(
+        ['sqlite:///' + str(tmpdir.join('missing', 'broken.db'))], 30, 10))
+    db.session.add(ShortURL(key='7OuG89A', url='http://www.foobar.com/'))
+    db.session.commit()
+    assert store.get('7OuG89A') == 'http://www.foobar.com/'
+    assert store.get('7OuG89B') is None
+
+def test_ReplicaSet__window(app):
+    clock = Clock()
+    replicas = ReplicaSet([], 30, 10, clock=clock)
+    replicas.wrote(['7OuG89A'])
+    clock.now += 5
+    replicas.wrote(['7OuG89B'])
+    assert replicas.written_recently(['7OuG89A', '7OuG89C'])
+    clock.now += 6
+    assert not replicas.written_recently(['7OuG89A'])
+    assert replicas.written_recently(['7OuG89B'])
+    replicas.wrote([])
+    assert list(replicas._written) == ['7OuG89B']
+
+def test_connect_args():
+    assert _connect_args('postgresql://replica/shortcake', 0.25) == {
+        'connect_timeout': 1, 'options': '-c statement_timeout=250'}
+    assert _connect_args('postgresql+psycopg2://replica/shortcake', 2.5) == {
+        'connect_timeout': 3, 'options': '-c statement_timeout=2500'}
+    assert _connect_args('sqlite:///replica.db', 0.5) == {'timeout': 0.5}
+    assert _connect_args('mysql://replica/shortcake', 1) == {}
+
+def test_init_app__no_replicas():
+    app = create_app(TestingConfig)
+    assert 'read_replicas' not in app.extensions
+    assert app.extensions['storage'].replicas is None
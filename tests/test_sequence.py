@@ -0,0 +1,145 @@
+import datetime
+import pytest
+import sqlalchemy
+from config import TestingConfig
+from app import create_app, db, core, sequence
+from app.models import ShortURL, KeyLease
+
+
+class SequenceConfig(TestingConfig):
+    SHORTKEY_STRATEGY = 'sequence'
+    SHORTKEY_LEASE_SIZE = 10
+    SHORTKEY_LEASE_CHECKPOINT_INTERVAL = 4
+
+
+@pytest.fixture
+def app():
+    app = create_app(SequenceConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_FeistelPermutation__bijective():
+    # small enough to check exhaustively
+    permutation = sequence.FeistelPermutation(b'secret', 62, 62 * 2)
+    images = [permutation.permute(n) for n in range(len(permutation))]
+    assert sorted(images) == list(range(len(permutation)))
+    assert all(permutation.invert(m) == n for n, m in enumerate(images))
+
+def test_FeistelPermutation__keyed():
+    a = sequence.FeistelPermutation(b'secret', 62 ** 3, 62 ** 4)
+    b = sequence.FeistelPermutation(b'other secret', 62 ** 3, 62 ** 4)
+    assert [a.permute(n) for n in range(10)] != [b.permute(n) for n in range(10)]
+    # consecutive ids are scattered over the key space
+    assert max(a.permute(n) for n in range(10)) > len(a) // 2
+
+
+def test_reserve_ids(app):
+    assert sequence.reserve_ids('test', 5) == 0
+    assert sequence.reserve_ids('test', 5) == 5
+    assert sequence.reserve_ids('other', 1) == 0
+
+class Clock:
+    def __init__(self):
+        self.now = datetime.datetime(2020, 1, 1)
+    def __call__(self):
+        return self.now
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+def test_LeaseAllocator__common(app):
+    allocator = sequence.LeaseAllocator('test', 3, ttl=60, checkpoint_interval=2)
+    assert [allocator.next_id() for _ in range(7)] == list(range(7))
+    # the allocator leased three ranges, and finished the first two
+    assert sequence.reserve_ids('test', 1) == 9
+    [lease] = KeyLease.query.all()
+    assert (lease.start, lease.end, lease.owner) == (6, 9, allocator.owner)
+
+def test_LeaseAllocator__checkpoint(app):
+    clock = Clock()
+    allocator = sequence.LeaseAllocator('test', 100, ttl=60, checkpoint_interval=5,
+                                        clock=clock)
+    for _ in range(7):
+        allocator.next_id()
+    lease = KeyLease.query.one()
+    assert lease.next_id == 5
+    # the lease is renewed before it expires, even if few ids are handed out
+    clock.advance(50)
+    allocator.next_id()
+    db.session.refresh(lease)
+    assert lease.next_id == 7
+    assert lease.expires_at == clock.now + datetime.timedelta(seconds=60)
+
+def test_LeaseAllocator__reclaim(app):
+    clock = Clock()
+    crashed = sequence.LeaseAllocator('test', 100, ttl=60, checkpoint_interval=5,
+                                      clock=clock)
+    for _ in range(12):
+        crashed.next_id()
+    other = sequence.LeaseAllocator('test', 100, ttl=60, checkpoint_interval=5,
+                                    clock=clock)
+    # the lease of the crashed allocator is still valid
+    assert other.next_id() == 100
+    clock.advance(61)
+    # the lease expired, and is resumed from its last checkpoint
+    third = sequence.LeaseAllocator('test', 100, ttl=60, checkpoint_interval=5,
+                                    clock=clock)
+    assert third.next_id() == 10
+    # when the crashed allocator comes back, it finds out its lease is gone,
+    # and reclaims the one the other allocator let expire
+    assert crashed.next_id() == 100
+
+def test_LeaseAllocator__release(app):
+    allocator = sequence.LeaseAllocator('test', 100, ttl=60, checkpoint_interval=50)
+    for _ in range(3):
+        allocator.next_id()
+    allocator.release()
+    other = sequence.LeaseAllocator('test', 100, ttl=60, checkpoint_interval=50)
+    assert other.next_id() == 3
+
+
+def test_shorten_url__sequence(app):
+    k1 = core.shorten_url('http://www.example.com/')
+    k2 = core.shorten_url('http://www.foobar.com/')
+    assert core._is_valid_key(k1) and core._is_valid_key(k2) and k1 != k2
+    assert core.shorten_url('http://www.example.com/') == k1
+    assert core.lengthen_url(k2) == 'http://www.foobar.com/'
+
+def test_shorten_url__sequence_single_insert(app):
+    core.shorten_url('http://www.example.com/0')
+    statements = []
+    def count(conn, cursor, statement, *args):
+        # leases are only queried every few shortens
+        if 'keyLease' not in statement and 'keySequence' not in statement:
+            statements.append(statement)
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        # the table filling up doesn't change the cost of a shorten
+        for i in range(1, 9):
+            del statements[:]
+            core.shorten_url('http://www.example.com/{}'.format(i))
+            assert len(statements) == 2
+            assert statements[1].startswith('INSERT')
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+
+def test_shorten_url__sequence_key_taken(app):
+    # the key of the first id is already taken by a URL of the hash strategy
+    permutation = app.extensions['key_permutation']
+    key = core._int_to_key(permutation.permute(0), core.SHORTKEY_LENGTH)
+    db.session.add(ShortURL(key=key, url='http://www.foobar.com/'))
+    db.session.commit()
+    assert core.shorten_url('http://www.example.com/') != key
+
+def test_shorten_urls__sequence(app):
+    keys = core.shorten_urls(['http://www.example.com/', 'nonsense',
+                              'http://www.foobar.com/', 'http://www.example.com/'])
+    assert isinstance(keys[1], core.InvalidURLError)
+    assert keys[0] == keys[3] != keys[2]
+    assert ShortURL.query.count() == 2
@@ -0,0 +1,91 @@
+import pytest
+from config import TestingConfig
+from app import create_app, db, core, snapshot
+from app.models import ShortURL
+
+
+@pytest.fixture
+def app(tmpdir):
+    class SnapshotConfig(TestingConfig):
+        SNAPSHOT_PATH = str(tmpdir.join('urls.snapshot'))
+        SNAPSHOT_CHECK_INTERVAL = 0
+    app = create_app(SnapshotConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+def test_write_snapshot__lookup(tmpdir):
+    path = str(tmpdir.join('urls.snapshot'))
+    pairs = [('{:07d}'.format(i), 'http://www.example.com/{}'.format(i))
+             for i in range(0, 1000, 3)]
+    pairs.append(('zzzzzzzzzz', 'http://www.example.com/é'))
+    assert snapshot.write_snapshot(pairs, path, created=42) == len(pairs)
+    snap = snapshot.Snapshot(path)
+    assert len(snap) == len(pairs) and snap.created == 42
+    for key, url in pairs:
+        assert snap.get(key) == url
+    assert snap.get('0000001') is None
+    assert snap.get('zzzzzzz') is None
+    assert snap.get('00000000000') is None
+    assert '0000003' in snap and '0000004' not in snap
+    assert tmpdir.listdir() == [tmpdir.join('urls.snapshot')]
+
+def test_write_snapshot__empty(tmpdir):
+    path = str(tmpdir.join('urls.snapshot'))
+    assert snapshot.write_snapshot([], path) == 0
+    assert snapshot.Snapshot(path).get('7OuG89A') is None
+
+def test_write_snapshot__out_of_order(tmpdir):
+    path = tmpdir.join('urls.snapshot')
+    path.write('previous')
+    with pytest.raises(ValueError):
+        snapshot.write_snapshot([('7OuG89B', 'x'), ('7OuG89A', 'y')], str(path))
+    # the previous file is left untouched
+    assert path.read() == 'previous'
+    assert tmpdir.listdir() == [path]
+
+def test_Snapshot__invalid(tmpdir):
+    path = tmpdir.join('urls.snapshot')
+    path.write('not a snapshot, but long enough to have a header')
+    with pytest.raises(snapshot.SnapshotFormatError):
+        snapshot.Snapshot(str(path))
+
+def test_lengthen_url__snapshot(app):
+    db.session.add(ShortURL(key='7OuG89A', url='http://www.example.com/'))
+    db.session.add(ShortURL(key='7OuG89b', url='http://www.foobar.com/'))
+    db.session.commit()
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['shortcake', 'snapshot'])
+    assert result.exit_code == 0
+    assert 'snapshotted 2 rows' in result.output
+    # served from the snapshot, even though the database no longer has it
+    ShortURL.query.filter_by(key='7OuG89A').delete()
+    db.session.commit()
+    assert core.lengthen_url('7OuG89A') == 'http://www.example.com/'
+    # keys newer than the snapshot are looked up in the database
+    core._try_insert('7OuG89C', 'http://www.example.org/')
+    assert core.lengthen_url('7OuG89C') == 'http://www.example.org/'
+    assert core.lengthen_url('7OuG89D') is None
+
+def test_SnapshotReader__reload(tmpdir):
+    path = str(tmpdir.join('urls.snapshot'))
+    now = [0]
+    reader = snapshot.SnapshotReader(path, check_interval=10, clock=lambda: now[0])
+    assert reader.get('7OuG89A') is None
+    snapshot.write_snapshot([('7OuG89A', 'http://www.example.com/')], path)
+    assert reader.get('7OuG89A') is None
+    now[0] = 10
+    assert reader.get('7OuG89A') == 'http://www.example.com/'
+    old = reader.snapshot
+    snapshot.write_snapshot([('7OuG89A', 'http://www.example.com/'),
+                             ('7OuG89B', 'http://www.foobar.com/')], path)
+    now[0] = 20
+    assert reader.get('7OuG89B') == 'http://www.foobar.com/'
+    assert reader.snapshot is not old
+    # a snapshot in use still works once replaced
+    assert old.get('7OuG89A') == 'http://www.example.com/'
@@ -0,0 +1,157 @@
+import datetime
+
+import pytest
+from config import TestingConfig
+from app import create_app, db, core, storage
+
+
+BACKENDS = ['sqlalchemy', 'memory', 'sqlite']
+
+
+@pytest.fixture(params=BACKENDS)
+def app(request, tmpdir):
+    class StorageConfig(TestingConfig):
+        STORAGE_BACKEND = request.param
+        STORAGE_SQLITE_PATH = str(tmpdir.join('shorturls.db'))
+    app = create_app(StorageConfig)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    yield app
+    db.session.remove()
+    db.drop_all()
+    app_context.pop()
+
+
+@pytest.fixture
+def store(app):
+    return app.extensions['storage']
+
+
+def test_insert_if_absent(store):
+    assert store.insert_if_absent('7OuG89A', 'http://www.example.com/')
+    assert not store.insert_if_absent('7OuG89A', 'http://www.foobar.com/')
+    assert store.get('7OuG89A') == 'http://www.example.com/'
+    assert store.get('7OuG89B') is None
+    assert store.find_key('http://www.example.com/') == '7OuG89A'
+    assert store.find_key('http://www.foobar.com/') is None
+
+def test_insert_if_absent_many(store):
+    store.insert_if_absent('7OuG89A', 'http://www.example.com/')
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    assert store.insert_if_absent_many([
+        ('7OuG89A', 'http://www.foobar.com/'),
+        ('7OuG89B', 'http://www.foobar.com/', expires_at),
+        ('7OuG89C', 'http://www.example.org/'),
+        ('7OuG89C', 'http://www.example.net/'),
+    ]) == [False, True, True, False]
+    assert store.get_entry('7OuG89A') == ('http://www.example.com/', None)
+    assert store.get_entry('7OuG89B') == ('http://www.foobar.com/', expires_at)
+    assert store.get('7OuG89C') == 'http://www.example.org/'
+    assert store.insert_if_absent_many([]) == []
+
+def test_insert_many(store):
+    store.insert_many([('7OuG89A', 'http://www.example.com/'),
+                       ('7OuG89B', 'http://www.foobar.com/')])
+    assert store.get_many(['7OuG89A', '7OuG89B', '7OuG89C']) == {
+        '7OuG89A': 'http://www.example.com/',
+        '7OuG89B': 'http://www.foobar.com/',
+    }
+    assert store.find_keys(['http://www.foobar.com/', 'http://www.baz.com/']) == {
+        'http://www.foobar.com/': '7OuG89B',
+    }
+    assert store.count() == 2
+
+def test_insert_many__conflict(store):
+    store.insert_if_absent('7OuG89B', 'http://www.foobar.com/')
+    pairs = [('7OuG89A', 'http://www.example.com/'),
+             ('7OuG89B', 'http://www.example.com/')]
+    with pytest.raises(storage.KeyConflictError):
+        store.insert_many(pairs)
+    # all or nothing
+    assert store.get('7OuG89A') is None
+    store.insert_many(pairs, skip_existing=True)
+    assert store.get('7OuG89A') == 'http://www.example.com/'
+    assert store.get('7OuG89B') == 'http://www.foobar.com/'
+
+def test_insert_many__skip_existing_fallback(app, store, monkeypatch):
+    # a database without ON CONFLICT clauses
+    monkeypatch.setattr(storage, '_dialect_insert', lambda dialect=None: None)
+    store.insert_if_absent('7OuG89B', 'http://www.foobar.com/')
+    store.insert_many([('7OuG89A', 'http://www.example.com/'),
+                       ('7OuG89B', 'http://www.example.com/'),
+                       ('7OuG89A', 'http://www.example.org/')],
+                      skip_existing=True)
+    assert store.get('7OuG89A') == 'http://www.example.com/'
+    assert store.get('7OuG89B') == 'http://www.foobar.com/'
+    assert store.count() == 2
+    store.insert_many([('7OuG89B', 'http://www.example.com/')],
+                      skip_existing=True)
+    assert store.count() == 2
+
+def test_scan(store):
+    pairs = [('{:07d}'.format(i), 'http://www.example.com/{}'.format(i))
+             for i in reversed(range(25))]
+    store.insert_many(pairs)
+    assert list(store.scan(batch_size=10)) == \
+        [(key, url, None) for key, url in sorted(pairs)]
+    assert sorted(store.scan_keys(batch_size=10)) == sorted(k for k, _ in pairs)
+
+def test_keys_from(store):
+    store.insert_many([('0000001', 'http://www.example.com/'),
+                       ('0000003', 'http://www.example.com/'),
+                       ('00000020', 'http://www.example.com/'),
+                       ('000000a', 'http://www.example.com/'),
+                       ('000000B', 'http://www.example.com/')])
+    # keys of other lengths are left out, and lowercase sorts last
+    assert store.keys_from('0000002', 10) == ['0000003', '000000B', '000000a']
+    assert store.keys_from('0000000', 2) == ['0000001', '0000003']
+    assert store.keys_from('000000b', 10) == []
+
+def test_expiry(store):
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    past, future = now - datetime.timedelta(hours=1), now + datetime.timedelta(hours=1)
+    store.insert_many([('7OuG89A', 'http://www.example.com/', past),
+                       ('7OuG89B', 'http://www.example.com/', future),
+                       ('7OuG89C', 'http://www.foobar.com/')])
+    assert store.get('7OuG89A') is None
+    assert store.get_entry('7OuG89A') is None
+    assert store.get_entry('7OuG89B') == ('http://www.example.com/', future)
+    assert store.get_entry('7OuG89C') == ('http://www.foobar.com/', None)
+    assert store.get_many(['7OuG89A', '7OuG89B']) == {'7OuG89B': 'http://www.example.com/'}
+    # expiring keys are taken, but never shared
+    assert store.get_taken(['7OuG89A', '7OuG89B', '7OuG89C', '7OuG89D']) == {
+        '7OuG89A': None, '7OuG89B': None, '7OuG89C': 'http://www.foobar.com/'}
+    assert store.find_key('http://www.example.com/') is None
+    assert not store.insert_if_absent('7OuG89A', 'http://www.example.com/')
+    assert [row[0] for row in store.scan()] == ['7OuG89B', '7OuG89C']
+    assert store.count() == 3
+
+def test_delete_expired(store):
+    now = datetime.datetime.utcnow()
+    store.insert_many([('{:07d}'.format(i), 'http://www.example.com/',
+                        now - datetime.timedelta(minutes=i))
+                       for i in range(1, 6)] +
+                      [('7OuG89A', 'http://www.example.com/')])
+    assert store.delete_expired(now, 3) == ['0000005', '0000004', '0000003']
+    assert store.delete_expired(now, 3) == ['0000002', '0000001']
+    assert store.delete_expired(now, 3) == []
+    assert list(store.scan_keys()) == ['7OuG89A']
+    assert store.insert_if_absent('0000001', 'http://www.foobar.com/')
+
+def test_core__round_trip(app):
+    key = core.shorten_url('http://www.example.com')
+    assert core.shorten_url('http://www.example.com') == key
+    assert core.lengthen_url(key) == 'http://www.example.com'
+    keys = core.shorten_urls(['http://www.example.com', 'http://www.foobar.com/'])
+    assert keys[0] == key
+    assert core.lengthen_url(keys[1]) == 'http://www.foobar.com/'
+
+def test_core__expiry(app):
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    permanent = core.shorten_url('http://www.example.com')
+    key = core.shorten_url('http://www.example.com', expires_at)
+    assert key != permanent
+    assert core.shorten_url('http://www.example.com', expires_at) not in (key, permanent)
+    assert core.lengthen_url(key) == 'http://www.example.com'
+    assert core.shorten_url('http://www.example.com') == permanent
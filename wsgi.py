@@ -0,0 +1,13 @@
+'''The production entry point.
+
+Unlike main, this module creates the application with the production
+configuration, and never touches the database schema, which is migrated by
+the release step (see the Procfile). Gunicorn imports it once, in its
+master process, before forking the workers (see gunicorn.conf.py).
+'''
+
+from config import ProductionConfig
+from app import create_app
+
+
+app = create_app(ProductionConfig)